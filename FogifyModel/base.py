@@ -163,6 +163,51 @@ class Network(BaseModel):
         return self.firewall_rules
 
 
+class Monitoring(BaseModel):
+    """
+    This class is the intermediate model of the monitoring section, i.e., the sampling interval (in seconds) of all
+    services and the overrides per node type (nodes) and per service (services). A rule is either an interval or an
+    object of interval, adaptive, max_interval, threshold and metrics. Adaptive rules double the interval (up to
+    max_interval) while the values of the selected metrics are stable.
+    """
+    PROPERTIES = ('interval', 'adaptive', 'max_interval', 'threshold', 'metrics')
+    nodes = {}
+    services = {}
+
+    @property
+    def default_rule(self):
+        return self.get_rule(self.__dict__)
+
+    @classmethod
+    def get_rule(cls, rule) -> dict:
+        if rule is None: return {}
+        if type(rule) in (int, float): rule = {'interval': rule}
+        res = {key: rule[key] for key in cls.PROPERTIES if key in rule}
+        for key in ('interval', 'max_interval'):
+            # the agents' schedule ticks in whole seconds, thus the whole floats (e.g., 5.0) are accepted as ints
+            if type(res.get(key)) == float and res[key].is_integer(): res[key] = int(res[key])
+        if 'adaptive' in res: res['adaptive'] = str(res['adaptive']).lower() == 'true'
+        return res
+
+    def get_service_rule(self, topology) -> dict:
+        """ The rule of a topology's service (the service rules override the node rules and both override the default) """
+        res = self.default_rule
+        res.update(self.get_rule(self.nodes.get(topology.node)))
+        res.update(self.get_rule(self.services.get(topology.service)))
+        res.update(self.get_rule(self.services.get(topology.service_name)))
+        return res
+
+    def validate(self):
+        rules = [self.__dict__] + list(self.nodes.values()) + list(self.services.values())
+        for rule in [self.get_rule(rule) for rule in rules]:
+            for key in ('interval', 'max_interval'):
+                if key in rule and not (type(rule[key]) == int and rule[key] > 0):
+                    raise Monitoring.ModelValidationException(
+                        "Model Error: the monitoring %s should be a positive whole number of seconds" % key)
+            if 'metrics' in rule and type(rule['metrics']) != list:
+                raise Monitoring.ModelValidationException("Model Error: the monitoring metrics should be a list")
+
+
 class Topology(object):
     """ This class represents a topology object capable to be translated to the underlying container orchestrator"""
 
@@ -212,6 +257,7 @@ class FogifyModel(object):
         self.nodes = [Node(i) for i in fogify['nodes']] if 'nodes' in fogify else []
         self.networks = [Network(i) for i in fogify['networks']] if 'networks' in fogify else []
         self.deployment = Deployment({"topology": fogify['topology']}) if 'topology' in fogify else None
+        self.monitoring = Monitoring(fogify['monitoring']) if 'monitoring' in fogify else Monitoring()
 
     @property
     def all_networks(self):
@@ -295,3 +341,8 @@ class FogifyModel(object):
                                                                     i['from_node'] == fognode.service_name]
 
         return res
+
+    def generate_monitoring_rules(self):
+        return {"default": self.monitoring.default_rule,
+                "services": {fognode.service_name: self.monitoring.get_service_rule(fognode)
+                             for fognode in self.topology}}
@@ -1,5 +1,6 @@
 import copy
 import datetime
+import json
 import logging
 import os
 import time
@@ -9,6 +10,11 @@ import pandas as pd
 import requests
 import yaml
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 class ExceptionFogifySDK(Exception):
     pass
@@ -17,6 +23,9 @@ class ExceptionFogifySDK(Exception):
 FOGIFY_FILE = "fogified-docker-compose.yaml"
 TOPOLOGY_URL = "/topology/"
 MONITORING_URL = "/monitorings/"
+MSGPACK = 'application/x-msgpack'
+COLUMNAR_JSON = 'application/vnd.fogify.columnar+json'
+TOPOLOGY_VERSION_HEADER = 'X-Fogify-Topology-Version'
 
 
 class FogifySDK(object):
@@ -99,7 +108,9 @@ class FogifySDK(object):
         url = self.get_url(TOPOLOGY_URL)
         self.clean_metrics()
         self.clean_annotations()
-        response = requests.post(url, files={"file": self.upload_file()}, headers={}).json()
+        response = requests.post(url, files={"file": self.upload_file()}, headers={})
+        version = response.headers.get(TOPOLOGY_VERSION_HEADER)
+        response = response.json()
 
         if not ('message' in response and response['message'].upper() == "OK"):
             raise ExceptionFogifySDK("The deployment is failed (%s)" % str(response))
@@ -113,10 +124,10 @@ class FogifySDK(object):
         count = 0
         current_iteration = 0
         while (count < total and current_iteration < timeout):
-            time.sleep(5)
-            response = requests.get(url, headers={})
+            response, elapsed = self.__wait_for_topology(url, version, timeout - current_iteration)
             if response.status_code != 200:
                 raise ExceptionFogifySDK("The deployment is failed (%s)" % str(response.json()))
+            version = response.headers.get(TOPOLOGY_VERSION_HEADER)
             response = response.json()
             new_count = 0
             for i in response:
@@ -124,7 +135,7 @@ class FogifySDK(object):
             dif = new_count - count
             pbar.update(dif)
             count = new_count
-            current_iteration += 5
+            current_iteration += elapsed
 
         pbar.close()
         if current_iteration > timeout:
@@ -138,7 +149,9 @@ class FogifySDK(object):
         response = requests.delete(url)
         if response.status_code != 200:
             raise ExceptionFogifySDK("Server error ( %s )" % str(response.json()))
-        response = requests.get(url, headers={}).json()
+        response = requests.get(url, headers={})
+        version = response.headers.get(TOPOLOGY_VERSION_HEADER)
+        response = response.json()
         total = 0
         for i in response:
             total += len(response[i])
@@ -148,15 +161,16 @@ class FogifySDK(object):
         count = total
         current_iteration = 0
         while (count > 0 and current_iteration < timeout):
-            time.sleep(5)
-            response = requests.get(url, headers={}).json()
+            response, elapsed = self.__wait_for_topology(url, version, timeout - current_iteration)
+            version = response.headers.get(TOPOLOGY_VERSION_HEADER)
+            response = response.json()
             new_count = 0
             for i in response:
                 new_count += len(response[i])
             dif = count - new_count
             pbar.update(dif)
             count = new_count
-            current_iteration += 5
+            current_iteration += elapsed
         self.data = {}
         pbar.close()
         if current_iteration > timeout:
@@ -164,25 +178,96 @@ class FogifySDK(object):
 
         return {"message": "The %s services are undeployed" % str(total)}
 
-    def get_metrics(self, service: str = None, from_timestamp: str = None, to_timestamp: str = None):
+    @staticmethod
+    def __wait_for_topology(url: str, version, remaining: float):
+        """
+        Waits for the next state of the deployment. If the controller returned the version of the topology, the
+        request waits until the deployment changes (long-poll), otherwise the topology is retrieved after 5 seconds.
+        :return: The response and the elapsed seconds
+        """
+        if isinstance(version, (str, int)) and str(version).isnumeric():
+            started = time.time()
+            response = requests.get(url, params={'version': version, 'wait': max(1, min(int(remaining), 30))},
+                                    headers={})
+            return response, time.time() - started
+        time.sleep(5)
+        return requests.get(url, headers={}), 5
+
+    def get_metrics(self, service: str = None, from_timestamp: str = None, to_timestamp: str = None,
+                    after: str = None):
+        """
+        Retrieves the monitoring metrics
+        :param after: The cursor of a previous call (an empty string retrieves all metrics). With a cursor, only the
+        metrics that the agents collected after the previous call are retrieved and appended to the local data
+        """
         query = ""
         query += "from_timestamp=" + str(
             int(datetime.datetime.timestamp(from_timestamp))) + "&" if from_timestamp else ""
         query += "to_timestamp=" + str(int(datetime.datetime.timestamp(to_timestamp))) + "&" if to_timestamp else ""
+        query += "after=" + after + "&" if after is not None else ""
         query += "service=" + service if service else ""
-        if hasattr(self, 'data') and service in self.data:
+        if after is not None:
+            # the cursor-based retrieval asks for columns (msgpack or json), which are loaded directly to dataframes
+            formats = ([MSGPACK] if msgpack is not None else []) + [COLUMNAR_JSON, 'application/json;q=0.5']
+            resp = self.__decode(requests.get(self.get_url(MONITORING_URL) + "?" + query,
+                                              headers={'Accept': ", ".join(formats)}))
+        else:
             resp = requests.get(self.get_url(MONITORING_URL) + "?" + query).json()
-            resp[service] = resp.get(service, [])
-            intervals = [i['count'] for i in self.data.get(service, [])]
-            for i in resp[service]:
-                if i['count'] not in intervals:
-                    self.data[service].append(i)
+        if 'Error' in resp: raise ExceptionFogifySDK(resp['Error'])
+        if after is not None and 'cursor' in resp and ('data' in resp or 'columns' in resp):
+            self.cursor = resp['cursor']
+            data = self.__columns_to_frames(resp['columns']) if 'columns' in resp else self.__records_to_frames(
+                resp['data'])
+            if not after or not hasattr(self, 'data'): self.data = {}
+            self.__merge(data)
+        elif hasattr(self, 'data') and service in self.data:
+            data = self.__records_to_frames(resp)
+            self.__merge({service: data.get(service, pd.DataFrame())}, deduplicate=True)
         else:
-            self.data = requests.get(self.get_url(MONITORING_URL) + "?" + query).json()
-            for i in self.data:
-                self.data[i].sort(key=lambda k: k['count'])
+            self.data = {}
+            self.__merge(self.__records_to_frames(resp))
         return self
 
+    def __merge(self, data: dict, deduplicate: bool = False):
+        """
+        Appends the retrieved dataframes to the local data (a dataframe per instance, in the order of the counts)
+        :param deduplicate: If it is set, the retrieved records that the local data already include are skipped
+        """
+        for instance, frame in data.items():
+            if instance in self.data and not frame.empty:
+                if deduplicate: frame = frame[~frame['count'].isin(self.data[instance]['count'])]
+                frame = pd.concat([self.data[instance], frame], ignore_index=True)
+            elif instance in self.data:
+                continue
+            self.data[instance] = frame.sort_values(by="count", ignore_index=True) if 'count' in frame else frame
+
+    @staticmethod
+    def __decode(response):
+        content_type = response.headers.get('Content-Type') if hasattr(response, 'headers') else None
+        if isinstance(content_type, str) and content_type.startswith(MSGPACK):
+            return msgpack.unpackb(response.content, raw=False)
+        return response.json()
+
+    @staticmethod
+    def __columns_to_frames(columns: dict) -> dict:
+        """ Builds a dataframe per instance from the columnar response ({"count", "timestamp", "metrics"}) """
+        return {instance: pd.DataFrame(dict(obj['metrics'], count=obj['count'],
+                                            timestamp=pd.to_datetime(obj['timestamp'], unit='s')))
+                for instance, obj in columns.items()}
+
+    @staticmethod
+    def __records_to_frames(data: dict) -> dict:
+        """
+        Builds a dataframe per instance from the json records, with naive timestamps like the frames of the columnar
+        responses
+        """
+        res = {}
+        for instance, records in data.items():
+            frame = pd.DataFrame.from_records(records)
+            if 'timestamp' in frame: frame['timestamp'] = pd.to_datetime(frame['timestamp']).dt.tz_localize(None)
+            res[instance] = frame
+        return res
+
     def get_network_packets_from(self, service: str, from_timestamp: str = None, to_timestamp: str = None,
                                  packet_type: str = None):
         query = ""
@@ -198,22 +283,84 @@ class FogifySDK(object):
 
         return res
 
-    def get_metrics_from(self, service: str):
-        if hasattr(self, 'data') and service in self.data:
+    def get_metrics_from(self, service: str, metrics: list = None):
+        """
+        Returns the metrics of an instance as a dataframe
+        :param metrics: If it is set, only these metrics (names or patterns, e.g. network_rx_*) are retrieved, without
+        updating the locally stored metrics
+        """
+        if metrics:
+            query = "service=%s&metrics=%s" % (service, ",".join(metrics))
+            data = requests.get(self.get_url(MONITORING_URL) + "?" + query).json()
+            res = pd.DataFrame.from_records(data.get(service, []))
+            if res.empty: return res
+            res.timestamp = pd.to_datetime(res['timestamp']).dt.tz_localize(None)
+            res.set_index('timestamp', inplace=True)
+            return res.sort_values(by="count")
+        if hasattr(self, 'data') and getattr(self, 'cursor', None):
+            self.get_metrics(after=self.cursor)
+        elif hasattr(self, 'data') and service in self.data and not self.data[service].empty:
             self.get_metrics(service=service,
-                             from_timestamp=datetime.datetime.strptime(self.data[service][-1]['timestamp'],
-                                                                       "%a, %d %b %Y %H:%M:%S %Z") - datetime.timedelta(
-                                 milliseconds=100))
+                             from_timestamp=self.data[service]['timestamp'].iloc[-1].to_pydatetime() -
+                                            datetime.timedelta(milliseconds=100))
         else:
-            self.get_metrics()
-        res = pd.DataFrame.from_records(self.data[service])
-        res.timestamp = pd.to_datetime(res['timestamp']).dt.tz_localize(None)
-        res.set_index('timestamp', inplace=True)
-        return res.sort_values(by="count")
+            self.get_metrics(after="")
+        if service not in self.data or self.data[service].empty: return pd.DataFrame()
+        return self.data[service].set_index('timestamp')
+
+    def get_aggregated_metrics(self, metrics: list, bucket: int = 60, funcs: list = ['mean'],
+                               group_by: str = 'instance', service: str = None, from_timestamp: str = None,
+                               to_timestamp: str = None):
+        """
+        Retrieves metrics that the agents aggregate per time bucket, instead of the raw samples
+        :param metrics: The names (or patterns, e.g. network_rx_*) of the metrics
+        :param bucket: The width of the buckets in seconds (0 aggregates the whole time window)
+        :param funcs: The aggregate functions (mean, min, max, sum, count, rate and percentiles, e.g. p95)
+        :param group_by: Groups the samples by 'instance' or by 'service'
+        :return: A dataframe with the group, the bucket's timestamp and a <metric>_<func> column per metric/function
+        """
+        query = "metrics=%s&bucket=%s&funcs=%s&group_by=%s" % (",".join(metrics), bucket, ",".join(funcs), group_by)
+        query += "&from_timestamp=" + str(int(datetime.datetime.timestamp(from_timestamp))) if from_timestamp else ""
+        query += "&to_timestamp=" + str(int(datetime.datetime.timestamp(to_timestamp))) if to_timestamp else ""
+        query += "&service=" + service if service else ""
+        data = requests.get(self.get_url(MONITORING_URL) + "aggregate/?" + query).json()
+        if "Error" in data:
+            raise ExceptionFogifySDK(data["Error"])
+        res = pd.DataFrame.from_records(
+            [dict(record, **{group_by: group}) for group in data for record in data[group]])
+        if res.empty: return res
+        res.timestamp = pd.to_datetime(res['timestamp'], unit='s')
+        return res.set_index([group_by, 'timestamp']).sort_index()
+
+    def stream_metrics(self, service: str = None, metrics: list = None, timeout: float = None):
+        """
+        Subscribes to the live monitoring stream. The agents push the samples of every monitoring tick to the
+        controller, which forwards them to the subscribers, thus the samples arrive one tick after their collection
+        :param service: If it is set, only the samples of this service (or instance) are streamed
+        :param metrics: If it is set, only these metrics (names or patterns, e.g. network_rx_*) are streamed
+        :param timeout: The seconds to wait for the next event before the iteration stops (by default, it waits forever)
+        :return: An iterator of samples, i.e., dictionaries of instance, count, timestamp and the metrics
+        """
+        query = "service=" + service + "&" if service else ""
+        query += "metrics=" + ",".join(metrics) if metrics else ""
+        response = requests.get(self.get_url(MONITORING_URL) + "stream/?" + query, stream=True, timeout=timeout,
+                                headers={'Accept': 'text/event-stream'})
+        if not response.ok:
+            raise ExceptionFogifySDK("The monitoring stream is not available")
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"): continue
+                message = json.loads(line[len("data:"):])
+                sample = dict(message['record'], instance=message['instance'])
+                sample['timestamp'] = datetime.datetime.utcfromtimestamp(sample['timestamp'])
+                yield sample
+        finally:
+            response.close()
 
     def clean_metrics(self):
         if hasattr(self, 'data'):
             del self.data
+        self.cursor = None
         return requests.delete(self.get_url(MONITORING_URL)).json()
 
     def horizontal_scaling_up(self, instance_type: str, num_of_instances: int = 1):
@@ -452,7 +599,11 @@ class FogifySDK(object):
 
     def plot(self, ax, service: str = None, metric: str = None, func=None, label: str = None, duration: dict = {},
              style: dict = {}):
-        df = self.get_metrics_from(service)
+        if metric is None: raise ExceptionFogifySDK("The metric of the plot is not set")
+        # the locally stored metrics are updated with their cursor, otherwise only the plotted metric is retrieved
+        df = self.get_metrics_from(service, metrics=None if hasattr(self, 'data') else [metric])
+        if df.empty or metric not in df.columns: return self
+        df = df.reset_index()
         df.timestamp = pd.to_datetime(df['timestamp'])
         if 'from' in duration:
             df = df[df.timestamp >= duration['from']]
@@ -182,6 +182,7 @@ class TestAPIs(InitializationTest):
         self.assertEqual(count_col, 3)
 
         self.assertEqual(len(self.fogify.data), 2)
+        self.assertEqual(list(self.fogify.data[SERVICE__1_1]['count']), [1])
 
         metrics = self.fogify.get_metrics_from(SERVICE__2_1)
         count_row = metrics.shape[0]
@@ -202,6 +203,127 @@ class TestAPIs(InitializationTest):
         self.assertEqual(count_row, 2)
         self.assertEqual(count_col, 3)
 
+    @mock.patch('requests.get')
+    def test_get_metrics_with_cursor(self, mock_get):
+        timestamp = time.strftime(TIME_FORMAT, datetime.utcnow().utctimetuple())
+        monitoring_object = {"cursor": "node-1:2", "data": {
+            SERVICE__2_1: [{"count": 2, "metric-1": 5, "timestamp": timestamp},
+                           {"count": 1, "metric-1": 4, "timestamp": timestamp}]}}
+        mock_get.return_value = Mock(ok=True)
+        mock_get.return_value.json.return_value = monitoring_object
+        metrics = self.fogify.get_metrics_from(SERVICE__2_1)
+        self.assertEqual(metrics.shape[0], 2)
+        self.assertEqual(list(metrics['count']), [1, 2])
+        self.assertEqual(self.fogify.cursor, "node-1:2")
+        self.assertTrue(mock_get.call_args[0][0].endswith("?after=&"))
+
+        monitoring_object = {"cursor": "node-1:3", "data": {
+            SERVICE__2_1: [{"count": 3, "metric-1": 6, "timestamp": timestamp}]}}
+        mock_get.return_value.json.return_value = monitoring_object
+        metrics = self.fogify.get_metrics_from(SERVICE__2_1)
+        self.assertEqual(metrics.shape[0], 3)
+        self.assertEqual(list(self.fogify.data[SERVICE__2_1]['metric-1']), [4, 5, 6])
+        self.assertEqual(self.fogify.cursor, "node-1:3")
+        self.assertTrue(mock_get.call_args[0][0].endswith("?after=node-1:2&"))
+
+    @mock.patch('requests.get')
+    def test_get_metrics_with_columns(self, mock_get):
+        now = time.time()
+        monitoring_object = {"cursor": "node-1:2", "columns": {
+            SERVICE__2_1: {"count": [1, 2], "timestamp": [now - 5, now], "metrics": {"metric-1": [4, None]}}}}
+        mock_get.return_value = Mock(ok=True)
+        mock_get.return_value.headers = {'Content-Type': 'application/vnd.fogify.columnar+json'}
+        mock_get.return_value.json.return_value = monitoring_object
+        metrics = self.fogify.get_metrics_from(SERVICE__2_1)
+        self.assertTrue('application/vnd.fogify.columnar+json' in mock_get.call_args[1]['headers']['Accept'])
+        self.assertEqual(metrics.shape, (2, 2))
+        self.assertEqual(list(metrics['count']), [1, 2])
+
+        monitoring_object = {"cursor": "node-1:3", "columns": {
+            SERVICE__2_1: {"count": [3], "timestamp": [now + 5], "metrics": {"metric-1": [6], "metric-2": [1]}}}}
+        mock_get.return_value.json.return_value = monitoring_object
+        metrics = self.fogify.get_metrics_from(SERVICE__2_1)
+        self.assertEqual(metrics.shape, (3, 3))
+        self.assertEqual(list(metrics['metric-1'].fillna(0)), [4, 0, 6])
+        self.assertEqual(self.fogify.cursor, "node-1:3")
+
+    @mock.patch('requests.get')
+    def test_get_metrics_with_columns_and_records(self, mock_get):
+        now = time.time()
+        mock_get.return_value = Mock(ok=True)
+        mock_get.return_value.headers = {'Content-Type': 'application/vnd.fogify.columnar+json'}
+        mock_get.return_value.json.return_value = {"cursor": "node-1:2", "columns": {
+            SERVICE__2_1: {"count": [1, 2], "timestamp": [now - 5, now], "metrics": {"metric-1": [4, 5]}}}}
+        self.fogify.get_metrics(after="")
+
+        timestamp = time.strftime(TIME_FORMAT, datetime.utcfromtimestamp(now + 5).utctimetuple())
+        mock_get.return_value.json.return_value = {SERVICE__2_1: [{"count": 2, "metric-1": 5, "timestamp": timestamp},
+                                                                  {"count": 3, "metric-1": 6, "timestamp": timestamp}]}
+        self.fogify.get_metrics(service=SERVICE__2_1)
+        metrics = self.fogify.data[SERVICE__2_1]
+        self.assertEqual(list(metrics['count']), [1, 2, 3])
+        self.assertEqual(list(metrics['metric-1']), [4, 5, 6])
+        self.assertTrue(metrics['timestamp'].is_monotonic_increasing)
+
+    @mock.patch('requests.get')
+    def test_get_metrics_from_with_projection(self, mock_get):
+        timestamp = time.strftime(TIME_FORMAT, datetime.utcnow().utctimetuple())
+        monitoring_object = {SERVICE__2_1: [{"count": 2, "metric-1": 6, "timestamp": timestamp},
+                                            {"count": 1, "metric-1": 5, "timestamp": timestamp}]}
+        mock_get.return_value = Mock(ok=True)
+        mock_get.return_value.json.return_value = monitoring_object
+        metrics = self.fogify.get_metrics_from(SERVICE__2_1, metrics=["metric-1"])
+        self.assertTrue(mock_get.call_args[0][0].endswith("?service=%s&metrics=metric-1" % SERVICE__2_1))
+        self.assertEqual(metrics.shape, (2, 2))
+        self.assertEqual(list(metrics['count']), [1, 2])
+        self.assertFalse(hasattr(self.fogify, 'data'))
+
+    @mock.patch('requests.get')
+    def test_plot_without_metrics(self, mock_get):
+        ax = Mock()
+        mock_get.return_value = Mock(ok=True)
+        mock_get.return_value.json.return_value = {}
+        self.assertIs(self.fogify.plot(ax, SERVICE__2_1, "metric-1"), self.fogify)
+        self.assertTrue(mock_get.call_args[0][0].endswith("?service=%s&metrics=metric-1" % SERVICE__2_1))
+        self.assertRaises(ExceptionFogifySDK, self.fogify.plot, ax, SERVICE__2_1)
+
+        mock_get.return_value.json.return_value = {"cursor": "node-1:2", "data": {}}
+        self.fogify.get_metrics(after="")
+        self.assertIs(self.fogify.plot(ax, SERVICE__2_1, "metric-1"), self.fogify)
+        self.assertTrue(mock_get.call_args[0][0].endswith("?after=node-1:2&"))
+        self.assertFalse(ax.method_calls)
+
+    @mock.patch('requests.get')
+    def test_get_aggregated_metrics(self, mock_get):
+        aggregation_object = {"service-2": [{"timestamp": 60, "cpu_mean": 0.5, "cpu_p95": 0.9},
+                                            {"timestamp": 0, "cpu_mean": 0.2, "cpu_p95": 0.3}]}
+        mock_get.return_value = Mock(ok=True)
+        mock_get.return_value.json.return_value = aggregation_object
+        metrics = self.fogify.get_aggregated_metrics(["cpu"], bucket=60, funcs=["mean", "p95"], group_by="service")
+        self.assertTrue("metrics=cpu&bucket=60&funcs=mean,p95&group_by=service" in mock_get.call_args[0][0])
+        self.assertEqual(metrics.shape, (2, 2))
+        self.assertEqual(list(metrics['cpu_mean']), [0.2, 0.5])
+
+        mock_get.return_value.json.return_value = {"Error": "The functions p200 are not supported"}
+        with self.assertRaises(ExceptionFogifySDK):
+            self.fogify.get_aggregated_metrics(["cpu"], funcs=["p200"])
+
+    @mock.patch('requests.get')
+    def test_stream_metrics(self, mock_get):
+        mock_get.return_value = Mock(ok=True)
+        mock_get.return_value.iter_lines.return_value = iter([
+            'retry: 1000', '', ': keep-alive', '',
+            'data: {"node": "node-1", "instance": "%s", "record": {"count": 3, "timestamp": 60, "cpu": 0.5}}'
+            % SERVICE__2_1,
+            ''])
+        samples = list(self.fogify.stream_metrics(service="service-2", metrics=["cpu"]))
+        self.assertTrue(mock_get.call_args[0][0].endswith("/monitorings/stream/?service=service-2&metrics=cpu"))
+        self.assertEqual(len(samples), 1)
+        self.assertEqual(samples[0]['instance'], SERVICE__2_1)
+        self.assertEqual(samples[0]['cpu'], 0.5)
+        self.assertEqual(samples[0]['timestamp'], datetime(1970, 1, 1, 0, 1))
+        mock_get.return_value.close.assert_called_once()
+
     @mock.patch('requests.get')
     def test_get_network_packets_from(self, mock_get):
         packets_object = {"res": [
@@ -304,6 +426,25 @@ class TestAPIs(InitializationTest):
         mock_get.return_value.json.return_value = {}
         self.assertDictEqual(self.fogify.undeploy(), {"message": "The 0 services are undeployed"})
 
+    @mock.patch('time.sleep')
+    @mock.patch.object(FogifySDK, 'clean_annotations')
+    @mock.patch.object(FogifySDK, 'clean_metrics')
+    @mock.patch('requests.post')
+    @mock.patch('requests.get')
+    def test_deploy_long_poll(self, mock_get, mock_post, mock_clean_metrics, mock_clean_annotations, mock_sleep):
+        mock_post.return_value = Mock(ok=True, status_code=200, headers={"X-Fogify-Topology-Version": "1"})
+        mock_post.return_value.json.return_value = {"message": "OK", "networks": {},
+            "swarm": {"services": {"service-1": {"deploy": {"replicas": 2}}}}}
+        deploying = Mock(ok=True, status_code=200, headers={"X-Fogify-Topology-Version": "2"})
+        deploying.json.return_value = {"service-1": ["service-1.1"]}
+        deployed = Mock(ok=True, status_code=200, headers={"X-Fogify-Topology-Version": "3"})
+        deployed.json.return_value = {"service-1": ["service-1.1", "service-1.2"]}
+        mock_get.side_effect = [deploying, deployed]
+        self.assertDictEqual(self.fogify.deploy(), {"message": "The services are deployed ( {'service-1': 2} )"})
+        mock_sleep.assert_not_called()
+        self.assertEqual(mock_get.call_args_list[0][1]['params']['version'], "1")
+        self.assertEqual(mock_get.call_args_list[1][1]['params']['version'], "2")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,11 +2,17 @@ import os
 
 from flask_sqlalchemy import SQLAlchemy
 
+from agent.database import create_read_only_engine, get_database_writer
 from connectors import get_connector
 from utils.async_task import AsyncTask
+from utils.container_registry import ContainerRegistry
 from utils.host_info import HostInfo
+from utils.instrumentation import install_metrics_endpoint
 from utils.logging import FogifyLogger
 from utils.network import NetworkController
+from utils.statsd import get_statsd_listener
+from utils.streaming import get_metric_publisher
+from utils.wire_format import install_compression
 
 logger = FogifyLogger(__name__)
 
@@ -16,6 +22,7 @@ class Agent(object):
    the agent's API, monitoring thread and docker's listener"""
 
     db = None
+    db_writer = None
 
     def __init__(self, args, app):
         """
@@ -27,9 +34,11 @@ class Agent(object):
 
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
 
-        Agent.db = SQLAlchemy(app)
+        # The sessions of the agent read through read-only connections, while the writes go through the db_writer
+        Agent.db = SQLAlchemy(app, session_options={'bind': create_read_only_engine(db_path)})
         if os.path.exists(db_path): os.remove(db_path)
         os.mknod(db_path)
+        Agent.db_writer = get_database_writer(Agent.db.engine).start()
 
         app.config['UPLOAD_FOLDER'] = "/current_agent/"
         os.environ['UPLOAD_FOLDER'] = "/current_agent/"
@@ -37,8 +46,11 @@ class Agent(object):
             os.mkdir(os.getcwd() + app.config['UPLOAD_FOLDER'])
 
         connector = get_connector()
+        container_registry = ContainerRegistry()
         app.config['CONNECTOR'] = connector
-        app.config['NETWORK_CONTROLLER'] = NetworkController(connector)
+        app.config['CONTAINER_REGISTRY'] = container_registry
+        app.config['NETWORK_CONTROLLER'] = NetworkController(connector, container_registry=container_registry)
+        AsyncTask(container_registry, 'listen', []).start()
         node_labels = {}
 
         if 'LABELS' in os.environ:
@@ -49,24 +61,42 @@ class Agent(object):
         connector.inject_labels(node_labels, HOST_IP=os.environ['HOST_IP'] if 'HOST_IP' in os.environ else None)
 
         from utils.monitoring import MetricCollector
-        from agent.views import MonitoringAPI, ActionsAPI, TopologyAPI, DistributionAPI, SnifferAPI
+        from agent.storage import get_metric_storage
+        from agent.views import MonitoringAPI, AggregationAPI, ActionsAPI, TopologyAPI, DistributionAPI, SnifferAPI, \
+            ContainerMetricsAPI
 
         # Add the api routes
         app.add_url_rule('/topology/', view_func=TopologyAPI.as_view('Topology'))
         app.add_url_rule('/monitorings/', view_func=MonitoringAPI.as_view('Monitoring'))
+        app.add_url_rule('/monitorings/aggregate/', view_func=AggregationAPI.as_view('Aggregation'))
+        app.add_url_rule('/metrics/containers/', view_func=ContainerMetricsAPI.as_view('ContainerMetrics'))
         app.add_url_rule('/actions/', view_func=ActionsAPI.as_view('Action'))
         app.add_url_rule('/packets/', view_func=SnifferAPI.as_view('Packet'))
         app.add_url_rule('/generate-network-distribution/<string:name>/',
                          view_func=DistributionAPI.as_view('NetworkDistribution'))
+        install_metrics_endpoint(app)
+        install_compression(app)
         logger.info("Agent routes are installed")
         # The thread that runs the monitoring agent
-        metric_controller = MetricCollector()
-        metric_controller_task = AsyncTask(metric_controller, 'start_monitoring', [args.agent_ip, connector, 5])
+        metric_storage = get_metric_storage()
+        app.config['METRIC_STORAGE'] = metric_storage
+        metric_storage.start_compaction()
+        statsd_listener = get_statsd_listener(container_registry, connector.instance_name)
+        if statsd_listener:
+            AsyncTask(statsd_listener, 'listen', []).start()
+        metric_publisher = get_metric_publisher()
+        if metric_publisher:
+            AsyncTask(metric_publisher, 'run', []).start()
+        metric_controller = MetricCollector(container_registry, metric_storage, statsd_listener, metric_publisher)
+        app.config['METRIC_COLLECTOR'] = metric_controller
+        interval = os.environ.get('MONITORING_INTERVAL', '')
+        interval = int(interval) if interval.isnumeric() and int(interval) > 0 else 5
+        metric_controller_task = AsyncTask(metric_controller, 'start_monitoring', [args.agent_ip, connector, interval])
         metric_controller_task.start()
         logger.info("Monitoring process is started")
 
         # The thread that inspect containers and apply network QoS
-        network_controller = NetworkController(connector)
+        network_controller = NetworkController(connector, container_registry=container_registry)
         network_controller_task = AsyncTask(network_controller, 'listen', [])
         network_controller_task.start()
         logger.info("Agent network controller is started")
@@ -0,0 +1,112 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+from sqlalchemy import create_engine, event
+
+from utils.instrumentation import metrics as instrumentation
+from utils.logging import FogifyLogger
+
+logger = FogifyLogger(__name__)
+
+WRITER_PRAGMAS = ('PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL', 'PRAGMA busy_timeout=5000',
+                  'PRAGMA temp_store=MEMORY', 'PRAGMA cache_size=-8000')
+READER_PRAGMAS = ('PRAGMA busy_timeout=5000', 'PRAGMA temp_store=MEMORY')
+
+
+def set_pragmas(engine, pragmas):
+    """ Applies the pragmas to every new connection of the engine """
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def create_read_only_engine(db_path: str):
+    """
+    Returns an engine with read-only connections to the agent's database. In WAL mode, the readers do not block on
+    the writer (and vice versa), since they read the last committed snapshot.
+    """
+    engine = create_engine('sqlite:///file:%s?mode=ro&uri=true' % db_path,
+                           connect_args={'check_same_thread': False})
+    set_pragmas(engine, READER_PRAGMAS)
+    return engine
+
+
+class DatabaseWriter(object):
+    """
+    The single writer of the agent's database. The threads of the agent (monitoring, sniffer, network QoS, API)
+    submit their writes as jobs, i.e., functions of a connection, to a bounded queue. The writer thread drains up to
+    `batch_size` jobs at a time and commits them in one transaction (group commit). If the batch fails, its jobs are
+    retried one by one, so a faulty job does not discard the rest.
+    """
+
+    def __init__(self, engine, queue_size: int = 1000, batch_size: int = 64):
+        self.engine = engine
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.thread = threading.Thread(target=self.run, name='database-writer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, job, wait: bool = False):
+        """
+        Enqueues a write. The call blocks while the queue is full.
+        :param job: A function that receives a connection and executes the write
+        :param wait: If it is True, the call returns after the job is committed
+        :return: The job's result if the caller waits, otherwise a future of the job's result
+        """
+        future = Future()
+        self.jobs.put((job, future))
+        return future.result() if wait else future
+
+    def run(self):
+        connection = self.engine.connect()
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            instrumentation.set_gauge('fogify_database_queue_depth', self.jobs.qsize())
+            instrumentation.set_gauge('fogify_database_batch_size', len(batch))
+            try:
+                with instrumentation.timer('fogify_database_commit_duration_seconds'):
+                    self.__commit(connection, batch)
+            except Exception:
+                logger.warning("A batch of %s writes failed, its writes are retried one by one" % len(batch),
+                               exc_info=True)
+                for job in batch:
+                    try:
+                        self.__commit(connection, [job])
+                    except Exception as e:
+                        logger.warning("The database write was failed", exc_info=True)
+                        job[1].set_exception(e)
+
+    @staticmethod
+    def __commit(connection, batch):
+        results = []
+        with connection.begin():
+            for job, _ in batch:
+                results.append(job(connection))
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+def get_database_writer(engine):
+    """
+    Returns the writer of the agent's database based on the agent's environment variables
+    """
+    queue_size = os.environ.get('DATABASE_QUEUE_SIZE', '')
+    batch_size = os.environ.get('DATABASE_BATCH_SIZE', '')
+    set_pragmas(engine, WRITER_PRAGMAS)
+    return DatabaseWriter(engine,
+                          queue_size=int(queue_size) if queue_size.isnumeric() else 1000,
+                          batch_size=int(batch_size) if batch_size.isnumeric() and int(batch_size) > 0 else 64)
@@ -1,11 +1,13 @@
 import logging
+import threading
 
+from sqlalchemy import func, and_, null
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import relationship
 
 from .agent import Agent
 
 db = Agent.db
+writer = Agent.db_writer
 
 
 class Status(db.Model):
@@ -15,34 +17,122 @@ class Status(db.Model):
     name = db.Column(db.String(50), primary_key=True)
     value = db.Column(db.String(50))
 
+    @classmethod
+    def upsert(cls, connection, value, name="counter"):
+        connection.execute(Status.__table__.insert().prefix_with('OR REPLACE'), {'name': name, 'value': value})
+
+    @classmethod
+    def value_of(cls, name="counter"):
+        return db.session.query(Status.value).filter_by(name=name).scalar()
+
     @classmethod
     def update_config(cls, value, name="counter"):
         try:
-            status = Status(name=name, value=value)
-            db.session.merge(status)
-            db.session.commit()
+            writer.submit(lambda connection: cls.upsert(connection, value, name), wait=True)
         except SQLAlchemyError:
             logging.info("update_config was failed to update the database")
-            db.session.rollback()
 
     @classmethod
     def remove_all(cls):
         try:
-            db.session.query(Status).delete()
-            db.session.commit()
+            writer.submit(lambda connection: connection.execute(Status.__table__.delete()), wait=True)
         except SQLAlchemyError:
             logging.info("remove_all was failed to remove the status db")
-            db.session.rollback()
 
 
-class Metric(db.Model):
+class NameDictionary(object):
     """
-    Metric is combination of a metric name and a measurement at a specific timestamp
+    Maps the repeated names of the monitoring storage (instances, metrics) to integer ids. The mapping is cached in
+    memory, so the writers and the readers translate names without extra queries.
     """
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    metric_name = db.Column(db.String(250))
+    name = db.Column(db.String(250), unique=True, nullable=False)
+
+    @classmethod
+    def __load(cls):
+        if cls._ids is None:
+            cls._ids = {row.name: row.id for row in db.session.query(cls.id, cls.name)}
+            cls._names = {value: key for key, value in cls._ids.items()}
+
+    @classmethod
+    def ids(cls) -> dict:
+        with cls._lock:
+            cls.__load()
+            return cls._ids
+
+    @classmethod
+    def names(cls) -> dict:
+        with cls._lock:
+            cls.__load()
+            return cls._names
+
+    @classmethod
+    def reserve_ids(cls, connection, names) -> dict:
+        """
+        Returns the ids of the names and inserts the missing names in the writer's current transaction.
+        The new names are cached only after the transaction is committed (see commit_reserved_ids).
+        :param connection: The connection of the database writer
+        :param names: An iterable of names
+        :return: A dictionary of name to id
+        """
+        ids = cls.ids()
+        res = {}
+        for name in names:
+            if name in ids:
+                res[name] = ids[name]
+            elif name not in res:
+                # an earlier write of the same batch may have inserted the name
+                res[name] = connection.execute(
+                    db.select([cls.__table__.c.id]).where(cls.__table__.c.name == name)).scalar()
+                if res[name] is None:
+                    res[name] = connection.execute(cls.__table__.insert(), {'name': name}).inserted_primary_key[0]
+        return res
+
+    @classmethod
+    def commit_reserved_ids(cls, reserved: dict):
+        with cls._lock:
+            cls.__load()
+            cls._ids.update(reserved)
+            cls._names.update({value: key for key, value in reserved.items()})
+
+
+class Instance(NameDictionary, db.Model):
+    """ The dictionary of the monitored instances' names """
+    _ids, _names, _lock = None, None, threading.Lock()
+
+
+class MetricName(NameDictionary, db.Model):
+    """ The dictionary of the dynamic metrics' names (per network and user-defined metrics) """
+    _ids, _names, _lock = None, None, threading.Lock()
+
+
+class Metric(db.Model):
+    """
+    A dynamic metric (network or user-defined) of a record. The metric's name is encoded with its MetricName id,
+    thus each value costs only three numeric fields.
+    """
+    record_id = db.Column(db.Integer, db.ForeignKey('record.id'), primary_key=True)
+    metric_id = db.Column(db.Integer, db.ForeignKey('metric_name.id'), primary_key=True)
     value = db.Column(db.Float())
-    record_id = db.Column(db.Integer, db.ForeignKey('record.id'))
+    __table_args__ = {'sqlite_with_rowid': False}
+
+
+class Rollup(db.Model):
+    """
+    The aggregated values (min, max, mean, last) of an instance's metric in a time bucket of a specific resolution.
+    Rollups replace the raw samples that are older than the configured age.
+    """
+    instance_id = db.Column(db.Integer, db.ForeignKey('instance.id'), primary_key=True)
+    resolution = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.DateTime(), primary_key=True)
+    metric_id = db.Column(db.Integer, db.ForeignKey('metric_name.id'), primary_key=True)
+    count = db.Column(db.Integer())
+    samples = db.Column(db.Integer())
+    min = db.Column(db.Float())
+    max = db.Column(db.Float())
+    mean = db.Column(db.Float())
+    last = db.Column(db.Float())
+    __table_args__ = (db.Index('rollup_bucket', bucket), {'sqlite_with_rowid': False})
 
 
 class Packet(db.Model):
@@ -58,29 +148,129 @@ class Packet(db.Model):
     src_port = db.Column(db.String(250))
     dest_port = db.Column(db.String(250))
 
+    @classmethod
+    def bulk_insert(cls, packets: list):
+        """ Enqueues the packets' rows to the database writer """
+        if packets: return writer.submit(lambda connection: connection.execute(Packet.__table__.insert(), packets))
+
+    @classmethod
+    def delete_all(cls):
+        writer.submit(lambda connection: connection.execute(Packet.__table__.delete()), wait=True)
+
 
 class Record(db.Model):
     """
-    It represents the monitoring measurement. A measurement is connected with multiple Records.
+    It represents the monitoring measurement of an instance at a monitoring tick. The built-in metrics are stored as
+    columns of the record, while the dynamic metrics are stored as Metric rows.
     """
-    id = db.Column(db.String(250), primary_key=True)
-    instance_name = db.Column(db.String(250))
-    timestamp = db.Column(db.DateTime())
-    metrics = relationship("Metric", backref='record')
+    DEFAULT_METRICS = ('cpu', 'cpu_util', 'memory', 'memory_util', 'disk_bytes')
+
+    id = db.Column(db.Integer, primary_key=True)
+    instance_id = db.Column(db.Integer, db.ForeignKey('instance.id'))
     count = db.Column(db.Integer())
-    __table_args__ = (db.Index('timestamp_service', timestamp.desc(), instance_name),)
+    timestamp = db.Column(db.DateTime())
+    cpu = db.Column(db.Float())
+    cpu_util = db.Column(db.Float())
+    memory = db.Column(db.Float())
+    memory_util = db.Column(db.Float())
+    disk_bytes = db.Column(db.Float())
+    __table_args__ = (db.Index('timestamp_instance', timestamp.desc(), instance_id),
+                      db.Index('instance_count', instance_id, count),)
 
-    def get_metric_by_name(self, name: str) -> Metric:
-        for i in self.metrics:
-            if i.metric_name == name:
-                return i
+    __next_id = None
+    __id_lock = threading.Lock()
 
-    def __init__(self, **kwargs):
-        instance_name = kwargs.get('instance_name', '')
-        count = kwargs.get('count', '')
-        kwargs['id'] = f"{instance_name}-{count}"
-        super(Record, self).__init__(**kwargs)
+    @classmethod
+    def allocate_ids(cls, size: int) -> int:
+        """
+        Reserves a range of record ids, so a monitoring tick can insert its records and their metrics with
+        executemany statements without reading back the generated keys.
+        :param size: The number of the ids
+        :return: The first id of the range
+        """
+        with cls.__id_lock:
+            if cls.__next_id is None:
+                cls.__next_id = (db.session.query(func.max(Record.id)).scalar() or 0) + 1
+            first = cls.__next_id
+            cls.__next_id += size
+            return first
+
+    @classmethod
+    def stream(cls, *criteria, columns: tuple = DEFAULT_METRICS, metric_ids: list = None, batch_size: int = 1000):
+        """
+        Returns the records that match the criteria, along with their dynamic metrics, from one joined query whose
+        rows are fetched in batches, so the memory of the caller does not grow with the size of the result
+        :param criteria: The filters of the records
+        :param columns: The built-in metrics that are returned
+        :param metric_ids: The ids of the dynamic metrics that are returned (None returns all of them)
+        :param batch_size: The number of the rows that are fetched at a time
+        :return: A generator of (instance id, record as dictionary) pairs
+        """
+        selected = [getattr(cls, name) for name in columns]
+        if metric_ids is not None and not metric_ids:
+            query = db.session.query(cls.id, cls.instance_id, cls.count, cls.timestamp, *selected, null(), null())
+        else:
+            join_condition = Metric.record_id == cls.id
+            if metric_ids is not None: join_condition = and_(join_condition, Metric.metric_id.in_(metric_ids))
+            query = db.session.query(cls.id, cls.instance_id, cls.count, cls.timestamp, *selected, Metric.metric_id,
+                                     Metric.value).outerjoin(Metric, join_condition)
+        query = query.filter(*criteria).order_by(cls.id).execution_options(stream_results=True).yield_per(batch_size)
+        metric_names = MetricName.names()
+        current_id, instance_id, record = None, None, None
+        for row in query:
+            if row[0] != current_id:
+                if record is not None: yield instance_id, record
+                current_id, instance_id = row[0], row[1]
+                record = {name: value for name, value in zip(columns, row[4:-2]) if value is not None}
+                record['count'] = row[2]
+                record['timestamp'] = row[3]
+            if row[-2] is not None:
+                record[metric_names.get(row[-2])] = row[-1]
+        if record is not None: yield instance_id, record
 
+    @classmethod
+    def bulk_insert(cls, samples: list, counter=None):
+        """
+        Enqueues a batch of samples, along with the updated counter, to the database writer. They are stored in one
+        transaction.
+        :param samples: A list of (instance name, count, timestamp, {metric name: value}) tuples
+        :param counter: The counter of the monitoring tick (if it is None, the counter is not updated)
+        :return: A future of the write
+        """
+        first_id = cls.allocate_ids(len(samples))
+        future = writer.submit(lambda connection: cls.__insert(connection, samples, counter, first_id))
+        future.add_done_callback(cls.__on_insert)
+        return future
+
+    @classmethod
+    def __on_insert(cls, future):
+        if future.exception() is not None:
+            logging.warning("bulk_insert was failed to store the monitoring tick")
+            return
+        instance_ids, metric_ids = future.result()
+        Instance.commit_reserved_ids(instance_ids)
+        MetricName.commit_reserved_ids(metric_ids)
+
+    @classmethod
+    def __insert(cls, connection, samples, counter, record_id):
+        instance_ids = Instance.reserve_ids(connection, {sample[0] for sample in samples})
+        metric_ids = MetricName.reserve_ids(
+            connection, {name for sample in samples for name in sample[3] if name not in cls.DEFAULT_METRICS})
+        records, metrics = [], []
+        for instance_name, count, timestamp, values in samples:
+            record = dict.fromkeys(cls.DEFAULT_METRICS)
+            record.update(id=record_id, instance_id=instance_ids[instance_name], count=count, timestamp=timestamp)
+            for name, value in values.items():
+                if name in cls.DEFAULT_METRICS:
+                    record[name] = value
+                else:
+                    metrics.append(dict(record_id=record_id, metric_id=metric_ids[name], value=value))
+            records.append(record)
+            record_id += 1
+        if records: connection.execute(Record.__table__.insert(), records)
+        if metrics: connection.execute(Metric.__table__.insert(), metrics)
+        if counter is not None: Status.upsert(connection, str(counter))
+        return instance_ids, metric_ids
 
 
 db.create_all()
@@ -0,0 +1,501 @@
+import calendar
+import fnmatch
+import math
+import os
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from array import array
+from datetime import datetime, timezone
+
+from sqlalchemy import or_
+from sqlalchemy.exc import SQLAlchemyError
+
+from agent.models import Status, Record, Metric, Instance, MetricName, Rollup, db, writer
+from utils.async_task import AsyncTask
+from utils.logging import FogifyLogger
+
+logger = FogifyLogger(__name__)
+
+NAN = float('nan')
+
+
+def to_epoch(timestamp: datetime) -> float:
+    """ Returns the epoch of a datetime. Naive datetimes are considered as UTC, as the agent stores them. """
+    if timestamp.tzinfo is not None: return timestamp.timestamp()
+    return calendar.timegm(timestamp.timetuple()) + timestamp.microsecond / 1000000
+
+
+def from_epoch(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+
+
+def is_selected(name: str, metrics: list = None) -> bool:
+    """ Checks if a metric is selected by a list of names or patterns of names (None selects all metrics) """
+    return metrics is None or any(fnmatch.fnmatchcase(name, metric) for metric in metrics)
+
+
+def bucket_start(timestamp: datetime, resolution: int) -> datetime:
+    epoch = to_epoch(timestamp)
+    return from_epoch(epoch - epoch % resolution)
+
+
+class RollupBucket(object):
+    """ Accumulates the values of a metric that fall in the same time bucket """
+
+    def __init__(self):
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.samples = 0
+        self.last = None
+        self.count = None
+
+    def add(self, count, min_value, max_value, mean, last, samples=1):
+        """ Adds a raw value (min, max, mean and last are the same) or the aggregations of a finer bucket """
+        self.min = min_value if self.min is None else min(self.min, min_value)
+        self.max = max_value if self.max is None else max(self.max, max_value)
+        self.sum += mean * samples
+        self.samples += samples
+        if self.count is None or count >= self.count:
+            self.count, self.last = count, last
+
+    def to_row(self, instance_id, resolution, bucket, metric_id):
+        return dict(instance_id=instance_id, resolution=resolution, bucket=bucket, metric_id=metric_id,
+                    count=self.count, samples=self.samples, min=self.min, max=self.max,
+                    mean=self.sum / self.samples, last=self.last)
+
+
+class MetricStorage(ABC):
+    """
+    The storage engine of the agent's monitoring samples. A sample is a tuple of
+    (instance name, count, timestamp, {metric name: value}).
+    """
+
+    @abstractmethod
+    def get_counter(self) -> int:
+        """
+        Returns the counter of the last stored monitoring tick
+        """
+        pass
+
+    @abstractmethod
+    def store(self, samples: list, counter: int):
+        """
+        Stores the samples of a monitoring tick
+        :param samples: A list of samples
+        :param counter: The counter of the monitoring tick
+        """
+        pass
+
+    @abstractmethod
+    def query(self, from_timestamp: datetime = None, to_timestamp: datetime = None, service: str = None,
+              rollup: str = 'mean', since_count: int = None, metrics: list = None):
+        """
+        Returns the stored samples that fall in a (exclusive) time window
+        :param from_timestamp: The start of the window
+        :param to_timestamp: The end of the window
+        :param service: The name of an instance
+        :param rollup: The aggregation (min, max, mean, last) that represents the rolled-up samples
+        :param since_count: If it is set, only the samples of the later monitoring ticks are returned
+        :param metrics: The names (or patterns) of the returned metrics (None returns all metrics)
+        :return: A generator of (instance name, record as dictionary) pairs
+        """
+        pass
+
+    @abstractmethod
+    def clear(self):
+        """
+        Removes all samples and resets the counter
+        """
+        pass
+
+    def start_compaction(self):
+        """
+        Starts the background compaction of the storage (if the storage supports it)
+        """
+        pass
+
+    epoch = None
+
+    def get_epoch(self) -> str:
+        """
+        Returns the identifier of the counter's lifetime. It changes when the agent restarts or the counter is reset,
+        thus a cursor of another epoch does not correspond to the stored samples.
+        """
+        if self.epoch is None: self.reset_epoch()
+        return self.epoch
+
+    def reset_epoch(self):
+        self.epoch = uuid.uuid4().hex
+
+    def get_retention(self) -> dict:
+        """
+        Returns which raw samples the storage no longer returns as they were stored, thus a copy of them (e.g., the
+        controller's cache) has to be reconciled
+        :return: {"compacted_before": the epoch before which the samples are rolled up (or None),
+        "oldest_counts": {instance name: the count of the oldest kept sample} for the instances that evicted samples}
+        """
+        return dict(compacted_before=None, oldest_counts={})
+
+
+class DatabaseMetricStorage(MetricStorage):
+    """
+    Stores the monitoring samples to the agent's SQLite database. When the rollup is enabled, a background
+    compaction replaces the samples that are older than `rollup_after` seconds with 1-minute buckets and the 1-minute
+    buckets that are older than `coarse_rollup_after` seconds with 10-minute buckets. Queries return every part
+    of the window in the finest resolution that is still stored.
+    """
+
+    FINE_RESOLUTION = 60
+    COARSE_RESOLUTION = 600
+    ROLLUPS = ('min', 'max', 'mean', 'last')
+
+    def __init__(self, rollup_after: int = None, coarse_rollup_after: int = None, compaction_interval: int = 60):
+        self.rollup_after = rollup_after
+        self.coarse_rollup_after = coarse_rollup_after
+        self.compaction_interval = compaction_interval
+        self.counter = None  # the counter of the last tick, as the writer may have not committed it yet
+        self.compacted_before = None  # the cutoff of the last rollup of the raw samples
+
+    def get_counter(self) -> int:
+        if self.counter is None:
+            count = Status.value_of("counter")
+            self.counter = 0 if count is None else int(count)
+        return self.counter
+
+    def store(self, samples: list, counter: int = None):
+        if counter is not None: self.counter = counter
+        Record.bulk_insert(samples, counter)
+
+    def query(self, from_timestamp: datetime = None, to_timestamp: datetime = None, service: str = None,
+              rollup: str = 'mean', since_count: int = None, metrics: list = None):
+        rollup_metric_ids, record_metric_ids = None, None
+        if metrics is not None:
+            selected = {name: metric_id for name, metric_id in MetricName.ids().items() if is_selected(name, metrics)}
+            rollup_metric_ids = list(selected.values())
+            record_metric_ids = [metric_id for name, metric_id in selected.items()
+                                 if name not in Record.DEFAULT_METRICS]
+        if self.rollup_after:
+            yield from self.__query_rollups(from_timestamp, to_timestamp, service, rollup, since_count,
+                                            rollup_metric_ids)
+        criteria = []
+        if since_count is not None:
+            criteria.append(Record.count > since_count)
+        if from_timestamp:
+            criteria.append(Record.timestamp > from_timestamp)
+        if to_timestamp:
+            criteria.append(Record.timestamp < to_timestamp)
+        if service:
+            criteria.append(Record.instance_id == Instance.ids().get(service))
+        instance_names = Instance.names()
+        columns = tuple(name for name in Record.DEFAULT_METRICS if is_selected(name, metrics))
+        for instance_id, record in Record.stream(*criteria, columns=columns, metric_ids=record_metric_ids):
+            yield instance_names.get(instance_id), record
+
+    def __query_rollups(self, from_timestamp, to_timestamp, service, rollup, since_count, metric_ids):
+        rollup = rollup if rollup in self.ROLLUPS else 'mean'
+        query = Rollup.query
+        if metric_ids is not None:
+            query = query.filter(Rollup.metric_id.in_(metric_ids))
+        if since_count is not None:
+            query = query.filter(Rollup.count > since_count)
+        if from_timestamp:
+            # the bucket that contains the start of the window is included
+            query = query.filter(or_(*(
+                (Rollup.resolution == resolution) & (Rollup.bucket >= bucket_start(from_timestamp, resolution))
+                for resolution in (self.FINE_RESOLUTION, self.COARSE_RESOLUTION))))
+        if to_timestamp:
+            query = query.filter(Rollup.bucket < to_timestamp)
+        if service:
+            query = query.filter(Rollup.instance_id == Instance.ids().get(service))
+        query = query.order_by(Rollup.instance_id, Rollup.bucket, Rollup.resolution)
+        instance_names, metric_names = Instance.names(), MetricName.names()
+        current_key, record = None, None
+        for row in query:
+            key = (row.instance_id, row.resolution, row.bucket)
+            if key != current_key:
+                if record: yield instance_names.get(current_key[0]), record
+                current_key, record = key, dict(count=row.count, timestamp=row.bucket, resolution=row.resolution)
+            record[metric_names.get(row.metric_id)] = getattr(row, rollup)
+        if record: yield instance_names.get(current_key[0]), record
+
+    def clear(self):
+        def delete_all(connection):
+            for table in (Metric.__table__, Record.__table__, Rollup.__table__):
+                connection.execute(table.delete())
+            Status.upsert(connection, '0')  # remove the counter
+
+        self.counter = 0
+        writer.submit(delete_all, wait=True)
+        self.reset_epoch()
+
+    def start_compaction(self):
+        if not self.rollup_after: return
+        AsyncTask(self, 'compact_periodically', [self.compaction_interval]).start()
+        logger.info(f"Monitoring rollup is enabled for samples older than {self.rollup_after} seconds")
+
+    def compact_periodically(self, interval: int):
+        while True:
+            time.sleep(interval)
+            try:
+                self.compact()
+            except Exception:
+                logger.warning("The compaction of the monitoring data failed", exc_info=True)
+
+    def compact(self):
+        """ Rolls up the raw samples and the fine buckets that are older than the configured ages """
+        now = datetime.utcnow()
+        cutoff = self.__cutoff(now, self.rollup_after, self.FINE_RESOLUTION)
+        self.__rollup_records(cutoff)
+        if self.coarse_rollup_after:
+            self.__rollup_buckets(self.__cutoff(now, self.coarse_rollup_after, self.COARSE_RESOLUTION))
+        self.compacted_before = to_epoch(cutoff)
+
+    def get_retention(self) -> dict:
+        return dict(compacted_before=self.compacted_before, oldest_counts={})
+
+    @staticmethod
+    def __cutoff(now: datetime, age: int, resolution: int) -> datetime:
+        """ Only complete buckets are rolled up, thus the cutoff is aligned to the resolution """
+        epoch = to_epoch(now) - age
+        return from_epoch(epoch - epoch % resolution)
+
+    def __rollup_records(self, cutoff: datetime):
+        buckets = {}
+        for instance_id, record in Record.stream(Record.timestamp < cutoff):
+            bucket = bucket_start(record['timestamp'], self.FINE_RESOLUTION)
+            for name, value in record.items():
+                if name in ('count', 'timestamp') or value is None: continue
+                key = (instance_id, bucket, name)
+                if key not in buckets: buckets[key] = RollupBucket()
+                buckets[key].add(record['count'], value, value, value, value)
+        if not buckets: return
+        old_records = db.select([Record.id]).where(Record.timestamp < cutoff)
+        self.__replace(buckets, self.FINE_RESOLUTION, [
+            Metric.__table__.delete().where(Metric.record_id.in_(old_records)),
+            Record.__table__.delete().where(Record.timestamp < cutoff)])
+
+    def __rollup_buckets(self, cutoff: datetime):
+        buckets = {}
+        metric_names = MetricName.names()
+        query = Rollup.query.filter(Rollup.resolution == self.FINE_RESOLUTION, Rollup.bucket < cutoff)
+        for row in query:
+            key = (row.instance_id, bucket_start(row.bucket, self.COARSE_RESOLUTION), metric_names.get(row.metric_id))
+            if key not in buckets: buckets[key] = RollupBucket()
+            buckets[key].add(row.count, row.min, row.max, row.mean, row.last, row.samples)
+        if not buckets: return
+        self.__replace(buckets, self.COARSE_RESOLUTION, [Rollup.__table__.delete().where(
+            (Rollup.resolution == self.FINE_RESOLUTION) & (Rollup.bucket < cutoff))])
+
+    def __replace(self, buckets: dict, resolution: int, deletions: list):
+        """ Inserts the buckets and removes the rolled-up rows in one transaction """
+
+        def replace(connection):
+            metric_ids = MetricName.reserve_ids(connection, {name for _, _, name in buckets})
+            rows = [bucket.to_row(instance_id, resolution, start, metric_ids[name]) for (instance_id, start, name), bucket
+                    in buckets.items()]
+            connection.execute(Rollup.__table__.insert(), rows)
+            for deletion in deletions:
+                connection.execute(deletion)
+            return metric_ids
+
+        try:
+            MetricName.commit_reserved_ids(writer.submit(replace, wait=True))
+        except SQLAlchemyError:
+            logger.warning("The rolled-up monitoring data were not stored", exc_info=True)
+
+
+class RingBuffer(object):
+    """
+    The recent samples of an instance in preallocated numeric columns of a fixed capacity. When the buffer is full,
+    a new sample overwrites the oldest one. Writing a sample does not allocate memory (except for the first sample
+    of a new metric) and reading a time window slices the columns.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = array('d', [0.0]) * capacity
+        self.counts = array('q', [0]) * capacity
+        self.columns = {}
+        self.start = 0
+        self.size = 0
+        self.evicted = False
+
+    def append(self, count: int, timestamp: float, metrics: dict, keep_evicted: bool = False):
+        """
+        Writes a sample to the buffer
+        :return: The evicted (count, timestamp, metrics) sample, if keep_evicted is enabled and the buffer is full
+        """
+        evicted = None
+        index = (self.start + self.size) % self.capacity
+        if self.size == self.capacity:
+            if keep_evicted: evicted = self.__sample(index)
+            self.start = (self.start + 1) % self.capacity
+            self.evicted = True
+        else:
+            self.size += 1
+        self.timestamps[index] = timestamp
+        self.counts[index] = count
+        for name, column in self.columns.items():
+            column[index] = metrics.get(name, NAN)
+        for name in metrics:
+            if name in self.columns: continue
+            column = array('d', [NAN]) * self.capacity
+            column[index] = metrics[name]
+            self.columns[name] = column
+        return evicted
+
+    def __sample(self, index: int):
+        metrics = {name: column[index] for name, column in self.columns.items() if not math.isnan(column[index])}
+        return self.counts[index], from_epoch(self.timestamps[index]), metrics
+
+    def oldest_timestamp(self):
+        return self.timestamps[self.start] if self.size else None
+
+    def oldest_count(self):
+        return self.counts[self.start] if self.size else None
+
+    def __position(self, values: array, target, inclusive: bool) -> int:
+        """ Binary search of a timestamp (or a count) over the logical (oldest to newest) positions of the buffer """
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            value = values[(self.start + middle) % self.capacity]
+            if value < target or (inclusive and value == target):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __slices(self, low: int, high: int):
+        """ Translates a logical range to the (at most two) physical slices of the columns """
+        if low >= high: return []
+        first, last = (self.start + low) % self.capacity, (self.start + high - 1) % self.capacity
+        if first <= last: return [(first, last + 1)]
+        return [(first, self.capacity), (0, last + 1)]
+
+    def window(self, from_timestamp: float = None, to_timestamp: float = None, since_count: int = None,
+               metrics: list = None):
+        """
+        Copies the samples of an (exclusive) time window
+        :param metrics: The names (or patterns) of the copied columns (None copies all columns)
+        :return: The counts, the timestamps and the metrics' columns of the window
+        """
+        low = 0 if from_timestamp is None else self.__position(self.timestamps, from_timestamp, True)
+        if since_count is not None: low = max(low, self.__position(self.counts, since_count, True))
+        high = self.size if to_timestamp is None else self.__position(self.timestamps, to_timestamp, False)
+        slices = self.__slices(low, high)
+        counts, timestamps = array('q'), array('d')
+        selected = {name: column for name, column in self.columns.items() if is_selected(name, metrics)}
+        columns = {name: array('d') for name in selected}
+        for first, last in slices:
+            counts.extend(self.counts[first:last])
+            timestamps.extend(self.timestamps[first:last])
+            for name, column in selected.items():
+                columns[name].extend(column[first:last])
+        return counts, timestamps, columns
+
+    @staticmethod
+    def to_records(counts, timestamps, columns):
+        for i in range(len(counts)):
+            record = {name: column[i] for name, column in columns.items() if not math.isnan(column[i])}
+            record['count'] = counts[i]
+            record['timestamp'] = from_epoch(timestamps[i])
+            yield record
+
+
+class RingBufferMetricStorage(MetricStorage):
+    """
+    Keeps the most recent samples of each instance in memory (RingBuffer), so the memory of the agent is bounded
+    by the retention. Optionally, the evicted samples are spilled to the database.
+    """
+
+    def __init__(self, capacity: int, spill: DatabaseMetricStorage = None):
+        self.capacity = capacity
+        self.spill = spill
+        self.buffers = {}
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def get_counter(self) -> int:
+        return self.counter
+
+    def store(self, samples: list, counter: int):
+        evicted = []
+        with self.lock:
+            for instance_name, count, timestamp, metrics in samples:
+                buffer = self.buffers.get(instance_name)
+                if buffer is None:
+                    buffer = self.buffers[instance_name] = RingBuffer(self.capacity)
+                sample = buffer.append(count, to_epoch(timestamp), metrics, self.spill is not None)
+                if sample: evicted.append((instance_name,) + sample)
+            self.counter = counter
+        if evicted: self.spill.store(evicted)
+
+    def query(self, from_timestamp: datetime = None, to_timestamp: datetime = None, service: str = None,
+              rollup: str = 'mean', since_count: int = None, metrics: list = None):
+        from_epoch_timestamp = to_epoch(from_timestamp) if from_timestamp else None
+        to_epoch_timestamp = to_epoch(to_timestamp) if to_timestamp else None
+        with self.lock:
+            windows = []
+            for instance_name, buffer in self.buffers.items():
+                if service and instance_name != service: continue
+                spilled = buffer.evicted and (from_epoch_timestamp is None or
+                                              from_epoch_timestamp < buffer.oldest_timestamp()) and (
+                                  since_count is None or since_count < buffer.oldest_count())
+                window = buffer.window(from_epoch_timestamp, to_epoch_timestamp, since_count, metrics)
+                windows.append((instance_name, spilled, window))
+        for instance_name, spilled, window in windows:
+            if spilled and self.spill:
+                yield from self.spill.query(from_timestamp, to_timestamp, instance_name, rollup, since_count,
+                                            metrics)
+            for record in RingBuffer.to_records(*window):
+                yield instance_name, record
+
+    def clear(self):
+        with self.lock:
+            self.buffers = {}
+            self.counter = 0
+        if self.spill: self.spill.clear()
+        self.reset_epoch()
+
+    def get_retention(self) -> dict:
+        # the evicted samples of a spilling storage are still returned from the database
+        if self.spill: return self.spill.get_retention()
+        with self.lock:
+            oldest_counts = {instance_name: buffer.oldest_count() for instance_name, buffer in self.buffers.items()
+                             if buffer.evicted}
+        return dict(compacted_before=None, oldest_counts=oldest_counts)
+
+    def start_compaction(self):
+        if self.spill: self.spill.start_compaction()
+
+
+def get_metric_storage() -> MetricStorage:
+    """
+    Returns the storage engine of the monitoring samples based on the agent's environment variables
+    """
+    rollup_after = os.environ.get('MONITORING_ROLLUP_AFTER', '')
+    coarse_rollup_after = os.environ.get('MONITORING_COARSE_ROLLUP_AFTER', '')
+    compaction_interval = os.environ.get('MONITORING_COMPACTION_INTERVAL', '')
+    rollup_after = int(rollup_after) if rollup_after.isnumeric() and int(rollup_after) > 0 else None
+    coarse_rollup_after = int(coarse_rollup_after) if coarse_rollup_after.isnumeric() else None
+    if rollup_after and coarse_rollup_after:
+        # the 1-minute buckets of a complete 10-minute bucket have to exist before they are rolled up again
+        minimum = rollup_after + DatabaseMetricStorage.COARSE_RESOLUTION
+        if coarse_rollup_after < minimum:
+            logger.warning(f"MONITORING_COARSE_ROLLUP_AFTER is raised to {minimum} seconds "
+                           f"(MONITORING_ROLLUP_AFTER + {DatabaseMetricStorage.COARSE_RESOLUTION})")
+            coarse_rollup_after = minimum
+    database_storage = DatabaseMetricStorage(
+        rollup_after=rollup_after, coarse_rollup_after=coarse_rollup_after,
+        compaction_interval=int(compaction_interval) if compaction_interval.isnumeric() else 60)
+    if os.environ.get('MONITORING_STORAGE', 'database').lower() != 'memory':
+        return database_storage
+    retention = os.environ.get('MONITORING_RETENTION', '')
+    capacity = int(retention) if retention.isnumeric() and int(retention) > 0 else 720
+    spill = database_storage if os.environ.get('MONITORING_SPILL', '').lower() == 'true' else None
+    logger.info(f"Monitoring samples are kept in memory (retention: {capacity} samples per instance)")
+    return RingBufferMetricStorage(capacity, spill)
@@ -7,12 +7,15 @@ from datetime import datetime
 
 import docker
 from flask import current_app as app
-from flask import request
+from flask import request, Response, stream_with_context, json as flask_json
 from flask.views import MethodView
 
-from agent.models import Status, Record, Metric, Packet
-from utils.monitoring import MetricCollector
+from agent.models import Packet
+from agent.storage import to_epoch
+from utils.aggregation import Aggregation, parse_arguments
+from utils.instrumentation import CONTENT_TYPE, render_container_metrics
 from utils.network import NetworkController
+from utils.wire_format import Columns, accepted_columnar_format, columnar_response
 
 
 class SnifferAPI(MethodView):
@@ -20,8 +23,10 @@ class SnifferAPI(MethodView):
 
     def ip_to_info_helper(self, ip):
         if ip not in self.ip_to_info:
-            ip_to_info = Status.query.filter_by(value=ip).first()
-            self.ip_to_info[ip] = ip_to_info.name.split("|") if ip_to_info else None
+            container_and_network = app.config['CONTAINER_REGISTRY'].find_by_ip(ip)
+            if not container_and_network: return None
+            container, network = container_and_network
+            self.ip_to_info[ip] = [container.name, network]
         return self.ip_to_info[ip]
 
     def get(self):
@@ -33,13 +38,11 @@ class SnifferAPI(MethodView):
     def __transform_record(self, record):
         src_obj = self.ip_to_info_helper(record['src_ip'])
         dest_obj = self.ip_to_info_helper(record['dest_ip'])
-        record['src_instance'] = src_obj[0].replace("monitoring_network_cache:fogify_", "") if src_obj else record[
-            'src_ip']
-        record['dest_instance'] = dest_obj[0].replace("monitoring_network_cache:fogify_", "") if dest_obj else record[
-            'dest_ip']
-        record['network'] = None if src_obj is None else src_obj[2]
+        record['src_instance'] = src_obj[0].replace("fogify_", "", 1) if src_obj else record['src_ip']
+        record['dest_instance'] = dest_obj[0].replace("fogify_", "", 1) if dest_obj else record['dest_ip']
+        record['network'] = None if src_obj is None else src_obj[1]
         if record['network'] is None:
-            record['network'] = None if dest_obj is None else dest_obj[2]
+            record['network'] = None if dest_obj is None else dest_obj[1]
         return record
 
     def __compute_get_query(self):
@@ -64,42 +67,102 @@ class SnifferAPI(MethodView):
         return from_timestamp, packet_type, service, to_timestamp
 
     def delete(self):
-        Packet.query.delete()
+        Packet.delete_all()
         return {"message": "The packets are empty now"}
 
 
 class MonitoringAPI(MethodView):
     """ With this API, agents return the monitored data or remove them. """
 
+    STREAM_CHUNK_SIZE = 500  # records per chunk of a streamed response
+
     def get(self):
         try:
+            since_count = self.__since_count()
+            cursor = {'count': since_count}
+            records = self.__track(self.__query(since_count), cursor)
+            if self.is_stream_requested():
+                return Response(stream_with_context(self.__stream(records, cursor)),
+                                mimetype='application/x-ndjson')
+            columnar_format = accepted_columnar_format(request.headers.get('Accept'))
+            if columnar_format:
+                columns = Columns()
+                for instance_name, record in records:
+                    count, timestamp = record.pop('count'), record.pop('timestamp')
+                    columns.append(instance_name, count, to_epoch(timestamp), record)
+                res = {"columns": columns.columns}
+                if since_count is not None: res.update(cursor=cursor['count'], **self.__epoch())
+                return columnar_response(res, columnar_format)
             res = {}
-            query = self.__compute_get_query()
-            for r in query.all():
-                if r.instance_name not in res: res[r.instance_name] = []
-                temp = self.__transform_record(r)
-                res[r.instance_name].append(temp)
-            return res
+            for instance_name, record in records:
+                if instance_name not in res: res[instance_name] = []
+                res[instance_name].append(record)
+            if since_count is None: return res
+            return dict(cursor=cursor['count'], data=res, **self.__epoch())
         except Exception as e:
             logging.error("An error occurred on monitoring view. The metrics did not retrieved.", exc_info=True)
             return {"Error": "{0}".format(e)}
 
-    def __transform_record(self, r):
-        temp = {i.metric_name: i.value for i in r.metrics}
-        temp['count'] = r.count
-        temp['timestamp'] = r.timestamp
-        return temp
+    @staticmethod
+    def is_stream_requested():
+        return request.args.get('stream', '').lower() == 'true' or \
+               'application/x-ndjson' in request.headers.get('Accept', '')
+
+    @staticmethod
+    def __since_count():
+        """
+        Returns the cursor of the request. A cursor ahead of the storage's counter is from before a clean up of the
+        metrics, thus all the records are returned.
+        """
+        since_count = request.args.get('since_count')
+        if since_count is None: return None
+        since_count = int(since_count) if since_count.isnumeric() else 0
+        return since_count if since_count <= app.config['METRIC_STORAGE'].get_counter() else 0
+
+    @staticmethod
+    def __epoch():
+        """ The epoch of the counter and the retention of the storage, which the controller's cache reconciles """
+        storage = app.config['METRIC_STORAGE']
+        return dict(epoch=storage.get_epoch(), retention=storage.get_retention())
+
+    @staticmethod
+    def __track(records, cursor: dict):
+        """ Keeps the count of the last monitoring tick that the records include """
+        for instance_name, record in records:
+            if cursor['count'] is not None and record['count'] > cursor['count']: cursor['count'] = record['count']
+            yield instance_name, record
+
+    def __stream(self, records, cursor: dict):
+        """
+        Yields the records as newline-delimited json objects of {"instance": ..., "record": ...}, in chunks. If the
+        request has a cursor, the last line is the next cursor ({"cursor": ...}).
+        """
+        lines = []
+        try:
+            for instance_name, record in records:
+                lines.append(flask_json.dumps({'instance': instance_name, 'record': record}))
+                if len(lines) == self.STREAM_CHUNK_SIZE:
+                    yield "\n".join(lines) + "\n"
+                    lines = []
+            if cursor['count'] is not None: lines.append(flask_json.dumps({'cursor': cursor['count']}))
+        except Exception as e:
+            logging.error("An error occurred on monitoring view. The metrics did not retrieved.", exc_info=True)
+            lines.append(flask_json.dumps({"Error": "{0}".format(e)}))
+        if lines: yield "\n".join(lines) + "\n"
 
-    def __compute_get_query(self):
-        query = Record.query
+    def __query(self, since_count: int = None):
+        storage = app.config['METRIC_STORAGE']
         from_timestamp, service, to_timestamp = self.__retrieve_requests_parameters()
-        if from_timestamp:
-            query = query.filter(Record.timestamp > datetime.fromtimestamp(int(from_timestamp)))
-        if to_timestamp:
-            query = query.filter(Record.timestamp < datetime.fromtimestamp(int(to_timestamp)))
-        if service:
-            query = query.filter(Record.instance_name == service)
-        return query
+        return storage.query(from_timestamp=datetime.fromtimestamp(int(from_timestamp)) if from_timestamp else None,
+                             to_timestamp=datetime.fromtimestamp(int(to_timestamp)) if to_timestamp else None,
+                             service=service, rollup=request.args.get('rollup', 'mean'), since_count=since_count,
+                             metrics=self.selected_metrics())
+
+    @staticmethod
+    def selected_metrics():
+        """ The comma-separated names (or patterns, e.g. network_rx_*) of the metrics parameter """
+        metrics = request.args.get('metrics')
+        return [metric for metric in metrics.split(',') if metric] if metrics else None
 
     def __retrieve_requests_parameters(self):
         from_timestamp = request.args.get('from_timestamp')
@@ -108,34 +171,71 @@ class MonitoringAPI(MethodView):
         return from_timestamp, service, to_timestamp
 
     def delete(self):
-        Record.query.delete()
-        Metric.query.delete()
-        MetricCollector.clean_cache_ip()
-        Status.update_config('0')  # remove the counter
+        app.config['METRIC_STORAGE'].clear()
         return {"message": "The monitorings are empty now"}
 
 
+class AggregationAPI(MethodView):
+    """
+    Agents summarize their monitoring records per time bucket. With partial=true, the response includes the
+    mergeable partial aggregates that the controller combines with the ones of the other agents.
+    """
+
+    def get(self):
+        try:
+            metrics, bucket, funcs, group_by = parse_arguments(request.args)
+            from_timestamp = request.args.get('from_timestamp')
+            to_timestamp = request.args.get('to_timestamp')
+            records = app.config['METRIC_STORAGE'].query(
+                from_timestamp=datetime.fromtimestamp(int(from_timestamp)) if from_timestamp else None,
+                to_timestamp=datetime.fromtimestamp(int(to_timestamp)) if to_timestamp else None,
+                service=request.args.get('service'), rollup=request.args.get('rollup', 'mean'), metrics=metrics)
+            aggregation = Aggregation(metrics, bucket, group_by)
+            for instance_name, record in records:
+                aggregation.add(instance_name, to_epoch(record['timestamp']), record)
+            if request.args.get('partial', '').lower() == 'true':
+                return {"partials": aggregation.to_dict()}
+            return aggregation.results(funcs)
+        except Exception as e:
+            logging.error("An error occurred on aggregation view. The metrics did not aggregated.", exc_info=True)
+            return {"Error": "{0}".format(e)}
+
+
+class ContainerMetricsAPI(MethodView):
+    """ Exposes the last sample of every emulated instance in the Prometheus text format """
+
+    def get(self):
+        latest_samples = app.config['METRIC_COLLECTOR'].latest_samples
+        return Response(render_container_metrics(latest_samples), mimetype=None, content_type=CONTENT_TYPE)
+
+
 class TopologyAPI(MethodView):
     """ Fogify Controller communicate with the agents through this API to apply network rules or to clean a deployment """
 
     def delete(self):
         network_controller = app.config['NETWORK_CONTROLLER']
         network_controller.remove_cached_data()
+        app.config['METRIC_COLLECTOR'].set_rules({}, app.config['CONNECTOR'].path)
         os.putenv('EMULATION_IS_RUNNING', 'FALSE')
         return {"message": "The topology is down."}
 
     def post(self):
         network_controller = app.config['NETWORK_CONTROLLER']
-        connector = app.config['CONNECTOR']
         if 'file' in request.data:
             file = request.data['file']
             file = json.loads(file)
             network_controller.save_network_rules(file)
             return {"message": "OK"}
+        elif 'monitoring' in request.data:
+            app.config['METRIC_COLLECTOR'].set_rules(json.loads(request.data['monitoring']),
+                                                     app.config['CONNECTOR'].path)
+            return {"message": "OK"}
         else:
             network_rules = network_controller.read_network_rules
             os.putenv('EMULATION_IS_RUNNING', 'TRUE')
-            infos = connector.get_local_containers_infos()
+            container_registry = app.config['CONTAINER_REGISTRY']
+            infos = [{'service_name': container.service, 'container_id': container.id,
+                      'container_name': container.service} for container in container_registry.running()]
             for info in infos:
                 threading.Thread(target=NetworkController.apply_network_qos_for_event,
                     args=(network_controller, info, network_rules, False)).start()
@@ -221,11 +321,12 @@ class ActionsAPI(MethodView):
 
     def post(self):
         client = docker.from_env()
+        container_registry = app.config['CONTAINER_REGISTRY']
         instances = []
         obj_json = request.get_json()
 
         for instance in obj_json['instances']:
-            instances += [i for i in client.containers.list() if i.name.find(instance) > -1]
+            instances += [client.containers.get(i.id) for i in container_registry.find_by_name(instance)]
 
         commands = obj_json['commands']
 
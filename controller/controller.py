@@ -2,7 +2,17 @@ import os
 
 from flask_sqlalchemy import SQLAlchemy
 
+from connectors import get_connector_class
+from utils.async_task import AsyncTask
+from utils.deployment import DeploymentState
+
+from utils.instrumentation import install_metrics_endpoint
+from utils.inter_communication import add_unreachable_agents_header
 from utils.logging import FogifyLogger
+from utils.metric_cache import get_metric_cache
+from utils.placement import get_placement_index
+from utils.streaming import get_metric_broker
+from utils.wire_format import install_compression
 logger = FogifyLogger(__name__)
 
 
@@ -28,17 +38,31 @@ class Controller(object):
         app.config['UPLOAD_FOLDER'] = "/current_infrastructure/"
         os.environ['UPLOAD_FOLDER'] = "/current_infrastructure/"
 
+        app.config['METRIC_BROKER'] = get_metric_broker()
+        app.config['PLACEMENT_INDEX'] = get_placement_index()
+        app.config['METRIC_CACHE'] = get_metric_cache()
+
+        deployment_state = DeploymentState(get_connector_class())
+        app.config['DEPLOYMENT_STATE'] = deployment_state
+        AsyncTask(deployment_state, 'listen', []).start()
+        AsyncTask(deployment_state, 'poll', []).start()
+
         from controller.views import TopologyAPI, MonitoringAPI, ActionsAPI, ControlAPI, AnnotationAPI, DistributionAPI, \
-            SnifferAPI
+            SnifferAPI, AggregationAPI, MetricStreamAPI
 
         # Introduce the routes of the API
         app.add_url_rule('/topology/', view_func=TopologyAPI.as_view('Topology'))
         app.add_url_rule('/monitorings/', view_func=MonitoringAPI.as_view('Monitoring'))
+        app.add_url_rule('/monitorings/aggregate/', view_func=AggregationAPI.as_view('Aggregation'))
+        app.add_url_rule('/monitorings/stream/', view_func=MetricStreamAPI.as_view('MetricStream'))
         app.add_url_rule('/packets/', view_func=SnifferAPI.as_view('Packets'))
         app.add_url_rule('/annotations/', view_func=AnnotationAPI.as_view('Annotations'))
         app.add_url_rule('/actions/<string:action_type>/', view_func=ActionsAPI.as_view('Action'))
         app.add_url_rule('/control/<string:service>/', view_func=ControlAPI.as_view('control'))
         app.add_url_rule('/generate-network-distribution/<string:name>/',
                          view_func=DistributionAPI.as_view('NetworkDistribution'))
+        install_metrics_endpoint(app)
+        install_compression(app)
+        app.after_request(add_unreachable_agents_header)
         logger.info("Controller routes are installed")
         self.app = app
@@ -1,28 +1,63 @@
 import logging
 import os
 import time
+from functools import wraps
+from urllib.parse import urlencode
 
 import yaml
 from flask import current_app as app
-from flask import request
+from flask import request, Response, stream_with_context
 from flask.views import MethodView
 from flask_api import exceptions
 
 from FogifyModel.actions import StressAction, VerticalScalingAction, CommandAction
 from FogifyModel.base import FogifyModel
 from FogifyModel.base import Network
-from connectors import get_connector_class, get_connector
+from connectors import get_connector
 from controller.models import Status, Annotation
+from utils.aggregation import Aggregation, parse_arguments
 from utils.async_task import AsyncTask
+from utils.deployment import DeploymentState, STATUS_HEADER, VERSION_HEADER
 from utils.inter_communication import Communicator
 from utils.logging import FogifyLogger
 from utils.network import NetworkController
-
-ConnectorClass = get_connector_class()
+from utils.wire_format import accepted_columnar_format, columnar_response
 
 logger = FogifyLogger(__name__)
 
 
+def get_communicator() -> Communicator:
+    """ Returns a communicator that sends the filtered queries only to the agents that host the service """
+    return Communicator(get_connector(), placement=app.config['PLACEMENT_INDEX'])
+
+
+def check_status(option: str):
+    """
+    A decorator that evaluates if there is a running Fogify topology (like the connector's check_status), but the
+    answer comes from the controller's deployment state instead of counting the services
+    :param option: "available" or "running"
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            state = app.config['DEPLOYMENT_STATE']
+            if option == 'available' and not state.is_available():
+                raise exceptions.APIException('The system has a deployed instance.')
+            if option == 'running' and not state.is_running():
+                raise exceptions.APIException('The system is available.')
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def deployment_headers(state: DeploymentState) -> dict:
+    version, status, _ = state.snapshot()
+    return {VERSION_HEADER: str(version), STATUS_HEADER: status}
+
+
 class AnnotationAPI(MethodView):
     """ Stores and returns the capture action's timestamps for a deployment"""
 
@@ -37,25 +72,43 @@ class AnnotationAPI(MethodView):
 class TopologyAPI(MethodView):
     """ This class is responsible for topology deployment API calls"""
 
+    MAX_WAIT = 30  # seconds that a long-poll of the deployment waits for a change
+
     def get(self):
-        """ Returns the current status of the fogify deployment"""
-        infrastructure_status = Status.query.filter_by(name="infrastructure").first()
-        if infrastructure_status and infrastructure_status.value == 'error':
+        """
+        Returns the current status of the fogify deployment from the controller's deployment state. If the request
+        has the version of a previous response (version parameter), the response waits until the deployment changes
+        or the wait parameter (in seconds) expires (long-poll). If too many long-polls are already waiting, the
+        response is returned immediately without the version header, thus the client falls back to polling.
+        """
+        state = app.config['DEPLOYMENT_STATE']
+        version, wait = request.args.get('version', ''), request.args.get('wait', '')
+        snapshot = state.wait(int(version), min(int(wait), self.MAX_WAIT) if wait.isnumeric() else self.MAX_WAIT) \
+            if version.isnumeric() else state.snapshot()
+        headers = {}
+        if snapshot is None:
+            snapshot = state.snapshot()
+        else:
+            headers[VERSION_HEADER] = str(snapshot[0])
+        version, status, deployment = snapshot
+        if status == DeploymentState.ERROR:
             raise exceptions.APIException('The deployment is failed. Please check the logs of the Fogify Controller.')
-        connector = get_connector()
-        return connector.return_deployment()
+        headers[STATUS_HEADER] = status
+        return deployment, headers
 
-    @ConnectorClass.check_status("running")
+    @check_status("running")
     def delete(self):
         """ Remove a Fogify deployment"""
         Status.update_config('submit_delete')
         Annotation.create(Annotation.TYPES.STOP.value)
         connector = get_connector()
-        t = AsyncTask(self, 'remove', [connector])
+        state = app.config['DEPLOYMENT_STATE']
+        state.update(status=DeploymentState.UNDEPLOYING)
+        t = AsyncTask(self, 'remove', [connector, app.config['PLACEMENT_INDEX'], state])
         t.start()
-        return {"message": "The topology is down."}
+        return {"message": "The topology is down."}, deployment_headers(state)
 
-    @ConnectorClass.check_status("available")
+    @check_status("available")
     def post(self):
         """ Introduce a new deployment to the fogify"""
 
@@ -77,44 +130,63 @@ class TopologyAPI(MethodView):
             controller_response = connector.generate_files()
             yaml.dump(controller_response, open(path + "fogified-swarm.yaml", 'w'), default_flow_style=False)
             networks = model.generate_network_rules()
+            monitoring = model.generate_monitoring_rules()
         except Exception:
             logging.error("An error occurred on monitoring view. The metrics did not retrieved.", exc_info=True)
             raise exceptions.APIException("Fogify could not generate the orchestrator files."
                                           "Please check your fogify model again.")
 
         yaml.dump(networks, open(path + "fogified-network.yaml", 'w'), default_flow_style=False)
+        yaml.dump(monitoring, open(path + "fogified-monitoring.yaml", 'w'), default_flow_style=False)
         time.sleep(1)
-        t = AsyncTask(self, 'submission', [connector, path, model.all_networks])
+        app.config['PLACEMENT_INDEX'].invalidate()
+        state = app.config['DEPLOYMENT_STATE']
+        state.update(status=DeploymentState.DEPLOYING)
+        t = AsyncTask(self, 'submission', [connector, path, model.all_networks, app.config['PLACEMENT_INDEX'], state])
         t.start()
 
-        return {"message": "OK", "swarm": controller_response, "networks": networks}
+        return {"message": "OK", "swarm": controller_response, "networks": networks}, deployment_headers(state)
 
-    def remove(self, connector):
+    def remove(self, connector, placement, state):
         """ A utility function that destroys a topology """
-        connector.down()
+        try:
+            connector.down()
+        finally:
+            state.refresh()
+            state.update(status=DeploymentState.AVAILABLE)
+        placement.reset()
         Communicator(connector).agents__notify_emulation_deleted()
 
         Annotation.create(Annotation.TYPES.UNDEPLOY.value)
 
-    def submission(self, connector, path, networks):
+    def submission(self, connector, path, networks, placement, state):
         """ A utility function that deploys a topology """
-        file = open(path + "fogified-network.yaml", 'r')
-        obj = yaml.safe_load(file)
+        try:
+            file = open(path + "fogified-network.yaml", 'r')
+            obj = yaml.safe_load(file)
 
-        Communicator(connector).agents__forward_network_file(obj)
-        for network in networks:
-            connector.create_network(network)
+            Communicator(connector).agents__forward_network_file(obj)
+            file = open(path + "fogified-monitoring.yaml", 'r')
+            Communicator(connector).agents__forward_monitoring_rules(yaml.safe_load(file))
+            for network in networks:
+                connector.create_network(network)
 
-        # submit the current deployment
-        try:
+            # submit the current deployment
             connector.deploy()
             time.sleep(3)  # wait to disseminate the information of starting container to hosts
         except Exception:
             logging.error("An error occured in the deployment.", exc_info=True)
             Status.update_config('error')
+            state.refresh()
+            state.update(status=DeploymentState.ERROR)
             return
-        Communicator(connector).agents__notify_emulation_started()
-        Status.update_config('running')
+        placement.invalidate()
+        try:
+            Communicator(connector).agents__notify_emulation_started()
+        finally:
+            Status.update_config('running')
+            state.refresh()
+            state.update(status=DeploymentState.RUNNING)
         Annotation.create(Annotation.TYPES.DEPLOY.value)
 
 
@@ -123,6 +195,7 @@ class MonitoringAPI(MethodView):
 
     def delete(self):
         """ Removes the stored monitoring data """
+        if app.config['METRIC_CACHE']: app.config['METRIC_CACHE'].clear()
         return Communicator(get_connector()).agents__delete_metrics()
 
     def get(self):
@@ -132,12 +205,71 @@ class MonitoringAPI(MethodView):
             from_timestamp = request.args.get('from_timestamp')
             to_timestamp = request.args.get('to_timestamp')
             service = request.args.get('service')
+            rollup = request.args.get('rollup')
+            cursor = request.args.get('after')
+            metrics = request.args.get('metrics')
             query += "from_timestamp=" + from_timestamp + "&" if from_timestamp else ""
             query += "to_timestamp=" + to_timestamp + "&" if to_timestamp else ""
-            query += "service=" + service if service else ""
+            query += "service=" + service + "&" if service else ""
+            query += "rollup=" + rollup + "&" if rollup else ""
+            query += "metrics=" + metrics if metrics else ""
+
+            if request.args.get('stream', '').lower() == 'true' or \
+                    'application/x-ndjson' in request.headers.get('Accept', ''):
+                lines = get_communicator().agents__stream_metrics(query, cursor, service)
+                return Response((line + b"\n" for line in lines), mimetype='application/x-ndjson')
+            columnar_format = accepted_columnar_format(request.headers.get('Accept'))
+            if columnar_format:
+                res = get_communicator().agents__get_metric_columns(query, cursor, service)
+                return columnar_response(res, columnar_format)
+            if cursor is None and app.config['METRIC_CACHE']:
+                return get_communicator().agents__get_cached_metrics(app.config['METRIC_CACHE'], query, service)
+            return get_communicator().agents__get_metrics(query, cursor, service)
 
-            return Communicator(get_connector()).agents__get_metrics(query)
+        except Exception as e:
+            return {"Error": "{0}".format(e)}
+
+
+class MetricStreamAPI(MethodView):
+    """
+    The live stream of the monitoring samples. The agents push the samples of every monitoring tick and the
+    subscribers receive them as server-sent events
+    """
+
+    def get(self):
+        """ Subscribes to the samples of all instances, or of a service or instance (service) and selected metrics """
+        metrics = request.args.get('metrics')
+        metrics = [metric for metric in metrics.split(',') if metric] if metrics else None
+        broker = app.config['METRIC_BROKER']
+        subscription = broker.subscribe(request.args.get('service'), metrics)
+        if subscription is None:
+            return {"Error": "The monitoring stream has already %s subscribers" % broker.max_subscribers}, 503
+        lines = broker.stream(subscription)
+        return Response(stream_with_context(lines), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
+    def post(self):
+        """ Receives the samples of an agent's monitoring tick """
+        broker = app.config['METRIC_BROKER']
+        broker.publish(request.get_json())
+        return {"subscribers": broker.subscribers}
+
+
+class AggregationAPI(MethodView):
+    """ This class returns the aggregated monitoring data, e.g., the per minute mean and p95 of a metric """
+
+    def get(self):
+        """
+        Merges the partial aggregates of the agents. The parameters are the metrics (names or patterns), the
+        bucket's width in seconds (0 summarizes the whole window), the functions (mean, min, max, sum, count, rate,
+        pNN), the grouping (instance or service) and the filters of the monitoring API.
+        """
+        try:
+            metrics, bucket, funcs, group_by = parse_arguments(request.args)
+            query = urlencode([(key, value) for key, value in request.args.items(multi=True) if key != 'partial'])
+            aggregation = get_communicator().agents__get_aggregates(
+                query, Aggregation(metrics, bucket, group_by), request.args.get('service'))
+            return aggregation.results(funcs)
         except Exception as e:
             return {"Error": "{0}".format(e)}
 
@@ -181,6 +313,7 @@ class ActionsAPI(MethodView):
             Annotation.create(Annotation.TYPES.H_SCALE_DOWN.value, instance_names=params['instance_type'],
                               params=f"Num of instances: {str(instances)}")
         connector.scale(params['instance_type'], service_count)
+        app.config['PLACEMENT_INDEX'].invalidate()
 
     def vertical_scaling(self, params):
         vaction = VerticalScalingAction(**params['action'])
@@ -247,7 +380,7 @@ class ActionsAPI(MethodView):
         if action_type == "command": commands["command"] = self.command(params)
         if action_type == "links": commands["links"] = self.links(params)
 
-        Communicator(get_connector()).agents__perform_action(commands, **params)
+        get_communicator().agents__perform_action(commands, **params)
 
         return {"message": "OK"}
 
@@ -267,7 +400,7 @@ class ControlAPI(MethodView):
     def post(self, service):
         commands, res = {'links': {'network': 'all'}}, []
         for instance_type in service.split("|"):
-            res.append(Communicator(get_connector()).agents__perform_action(commands, instance_type=instance_type))
+            res.append(get_communicator().agents__perform_action(commands, instance_type=instance_type))
         return {"message": "OK"}
 
 
@@ -313,7 +446,7 @@ class SnifferAPI(MethodView):
             query += "to_timestamp=" + to_timestamp + "&" if to_timestamp else ""
             query += "service=" + service if service else ""
             query += "packet_type=" + packet_type if packet_type else ""
-            return Communicator(get_connector()).agents__get_packets(query)
+            return get_communicator().agents__get_packets(query, service)
         except Exception as e:
             logging.error("The system could not return the sniffer's data.", exc_info=True)
             return {"Error": "{0}".format(e)}
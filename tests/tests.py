@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils.monitoring import CgroupHandler
+
+CONTAINER_ID = "0123456789abcdef"
+PID = 4242
+NET_DEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:     100       1    0    0    0     0          0         0      100       1    0    0    0     0       0          0
+  eth0:    2000      20    0    0    0     0          0         0     3000      30    0    0    0     0       0          0
+"""
+
+
+class FakeContainer(object):
+    id = CONTAINER_ID
+    name = "fogify_service-1.1"
+    pid = PID
+    limits = {"memory": 0, "cpu": 0}
+
+
+class FakeRegistry(object):
+
+    def running(self):
+        return [FakeContainer()]
+
+
+class TestCgroupHandler(unittest.TestCase):
+    """ The cgroup backend against fake procfs and cgroupfs trees """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.proc_path = os.path.join(self.root, "proc")
+        self.cgroup_path = os.path.join(self.root, "cgroup")
+        self.write(os.path.join(self.proc_path, "meminfo"), "MemTotal:        2048 kB\n")
+        self.write(os.path.join(self.proc_path, str(PID), "net", "dev"), NET_DEV)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    @staticmethod
+    def write(path: str, content: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def handler(self) -> CgroupHandler:
+        return CgroupHandler("fogify", client=object(), container_registry=FakeRegistry(),
+                             proc_path=self.proc_path, cgroup_path=self.cgroup_path)
+
+    def create_v1_tree(self):
+        container = "docker/" + CONTAINER_ID
+        self.write(os.path.join(self.cgroup_path, "cpu,cpuacct", container, "cpuacct.usage"), "5000\n")
+        self.write(os.path.join(self.cgroup_path, "memory", container, "memory.usage_in_bytes"), "1024\n")
+        self.write(os.path.join(self.cgroup_path, "blkio", container, "blkio.throttle.io_service_bytes"),
+                   "8:0 Read 10\n8:0 Write 300\nTotal 310\n")
+
+    def assert_stats(self, handler: CgroupHandler, cpu: float, memory: float, written: float):
+        handler.retrieve_docker_metrics()
+        stats = handler.get_metrics()[CONTAINER_ID]["stats"][-1]
+        self.assertEqual(stats["cpu"]["usage"]["total"], cpu)
+        self.assertEqual(stats["memory"]["usage"], memory)
+        self.assertEqual(stats["filesystem"][0]["usage"], written)
+        self.assertListEqual(stats["network"]["interfaces"], [{"name": "eth0", "rx_bytes": 2000, "tx_bytes": 3000}])
+
+    def test_v1(self):
+        self.create_v1_tree()
+        self.write(os.path.join(self.proc_path, str(PID), "cgroup"),
+                   "4:memory:/docker/%s\n3:cpu,cpuacct:/docker/%s\n2:blkio:/docker/%s\n" % ((CONTAINER_ID,) * 3))
+        self.assert_stats(self.handler(), 5000.0, 1024.0, 300.0)
+
+    def test_hybrid(self):
+        """ The unified hierarchy of a hybrid host has no controllers, thus the v1 hierarchies are used """
+        self.create_v1_tree()
+        os.makedirs(os.path.join(self.cgroup_path, "unified", "docker", CONTAINER_ID))
+        self.write(os.path.join(self.proc_path, str(PID), "cgroup"),
+                   "4:memory:/docker/%s\n3:cpu,cpuacct:/docker/%s\n2:blkio:/docker/%s\n0::/docker/%s\n" % (
+                       (CONTAINER_ID,) * 4))
+        self.assert_stats(self.handler(), 5000.0, 1024.0, 300.0)
+
+    def test_v2(self):
+        container = os.path.join(self.cgroup_path, "system.slice", "docker-%s.scope" % CONTAINER_ID)
+        self.write(os.path.join(self.cgroup_path, "cgroup.controllers"), "cpu io memory\n")
+        self.write(os.path.join(container, "cpu.stat"), "usage_usec 7\nuser_usec 5\n")
+        self.write(os.path.join(container, "memory.current"), "2048\n")
+        self.write(os.path.join(container, "io.stat"), "8:0 rbytes=10 wbytes=400 rios=1 wios=2\n")
+        self.write(os.path.join(self.proc_path, str(PID), "cgroup"), "0::/\n")
+        self.assert_stats(self.handler(), 7000.0, 2048.0, 400.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,11 +12,11 @@ class Cache(object):
     @staticmethod
     def get(key, value_from_json=True):
         from agent.models import Status
-        res = Status.query.filter_by(name=key).first()
+        res = Status.value_of(key)
         if not res: return None
         if value_from_json:
-            return json.loads(res.value)
-        return res.value
+            return json.loads(res)
+        return res
 
     @staticmethod
     def memoize(func):
@@ -0,0 +1,209 @@
+import fnmatch
+import math
+import re
+
+REPLICA_SUFFIX = re.compile(r'[._]\d+$')
+PERCENTILE = re.compile(r'^p(\d{1,2}(\.\d+)?)$')
+FUNCTIONS = ('mean', 'min', 'max', 'sum', 'count', 'rate')
+
+
+def service_of(instance_name: str) -> str:
+    """ Returns the service of an instance, i.e., its name without the replica's number (e.g. service-1.2) """
+    return REPLICA_SUFFIX.sub('', instance_name)
+
+
+def is_valid_function(func: str) -> bool:
+    return func in FUNCTIONS or PERCENTILE.match(func) is not None
+
+
+def parse_arguments(args) -> tuple:
+    """
+    Parses the arguments of an aggregation request
+    :param args: The request's arguments
+    :return: The metrics, the bucket's width (in seconds), the functions and the grouping
+    """
+    metrics = [metric for metric in args.get('metrics', '').split(',') if metric]
+    if not metrics: raise ValueError("The metrics parameter is required")
+    bucket = args.get('bucket', '60')
+    if not bucket.isnumeric(): raise ValueError("The bucket should be a number of seconds")
+    funcs = [func for func in args.get('funcs', 'mean').split(',') if func]
+    invalid = [func for func in funcs if not is_valid_function(func)]
+    if invalid: raise ValueError("The functions %s are not supported" % ", ".join(invalid))
+    group_by = args.get('group_by', 'instance')
+    if group_by not in ('instance', 'service'): raise ValueError("The group_by should be instance or service")
+    return metrics, int(bucket), funcs, group_by
+
+
+class PartialAggregate(object):
+    """
+    The mergeable summary of a metric's values in a time bucket. Agents compute the partial aggregates of their
+    instances and the controller merges them, so the raw samples never leave the agents.
+    Percentiles are estimated from a summary of at most `MAX_POINTS` weighted values and rates are computed
+    per instance (from the first and the last counter value of the bucket) and are summed over the instances.
+    """
+
+    MAX_POINTS = 100
+
+    def __init__(self):
+        self.n = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.points = []  # [value, weight] pairs
+        self.rates = {}  # instance -> [first timestamp, first value, last timestamp, last value]
+
+    def add(self, value: float, timestamp: float = None, instance: str = None):
+        self.n += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.points.append([value, 1])
+        if len(self.points) > 2 * self.MAX_POINTS: self.__compress()
+        if timestamp is None: return
+        rate = self.rates.get(instance)
+        if rate is None:
+            self.rates[instance] = [timestamp, value, timestamp, value]
+        elif timestamp < rate[0]:
+            rate[0], rate[1] = timestamp, value
+        elif timestamp > rate[2]:
+            rate[2], rate[3] = timestamp, value
+
+    def merge(self, other):
+        self.n += other.n
+        self.sum += other.sum
+        if other.min is not None: self.min = other.min if self.min is None else min(self.min, other.min)
+        if other.max is not None: self.max = other.max if self.max is None else max(self.max, other.max)
+        self.points.extend(other.points)
+        if len(self.points) > 2 * self.MAX_POINTS: self.__compress()
+        for instance, other_rate in other.rates.items():
+            rate = self.rates.get(instance)
+            if rate is None:
+                self.rates[instance] = list(other_rate)
+                continue
+            if other_rate[0] < rate[0]: rate[0], rate[1] = other_rate[0], other_rate[1]
+            if other_rate[2] > rate[2]: rate[2], rate[3] = other_rate[2], other_rate[3]
+        return self
+
+    def __compress(self):
+        """ Replaces the points with MAX_POINTS points of (almost) equal weights """
+        self.points.sort(key=lambda point: point[0])
+        total = sum(weight for _, weight in self.points)
+        step = total / self.MAX_POINTS
+        compressed, value_sum, weight_sum = [], 0.0, 0
+        for value, weight in self.points:
+            value_sum += value * weight
+            weight_sum += weight
+            if weight_sum >= step:
+                compressed.append([value_sum / weight_sum, weight_sum])
+                value_sum, weight_sum = 0.0, 0
+        if weight_sum: compressed.append([value_sum / weight_sum, weight_sum])
+        self.points = compressed
+
+    def percentile(self, percent: float):
+        if not self.points: return None
+        points = sorted(self.points, key=lambda point: point[0])
+        rank = percent / 100 * (sum(weight for _, weight in points) - 1)
+        seen = 0
+        for value, weight in points:
+            seen += weight
+            if seen > rank: return value
+        return points[-1][0]
+
+    def rate(self):
+        """ The per second increase of a counter metric (the counter resets are ignored) """
+        rates = [(last - first) / (last_timestamp - first_timestamp)
+                 for first_timestamp, first, last_timestamp, last in self.rates.values()
+                 if last_timestamp > first_timestamp and last >= first]
+        return sum(rates) if rates else None
+
+    def result(self, func: str):
+        if func == 'mean': return self.sum / self.n if self.n else None
+        if func == 'min': return self.min
+        if func == 'max': return self.max
+        if func == 'sum': return self.sum
+        if func == 'count': return self.n
+        if func == 'rate': return self.rate()
+        percentile = PERCENTILE.match(func)
+        if percentile: return self.percentile(float(percentile.group(1)))
+        return None
+
+    def to_dict(self) -> dict:
+        return {'n': self.n, 'sum': self.sum, 'min': self.min, 'max': self.max, 'points': self.points,
+                'rates': self.rates}
+
+    @classmethod
+    def from_dict(cls, obj: dict):
+        res = cls()
+        res.n, res.sum, res.min, res.max = obj['n'], obj['sum'], obj['min'], obj['max']
+        res.points, res.rates = obj['points'], obj['rates']
+        return res
+
+
+class Aggregation(object):
+    """
+    Groups the monitoring records by instance (or service) and time bucket, and summarizes the selected metrics
+    of each group with PartialAggregates. The partial results of many agents are combined with `merge`.
+    """
+
+    def __init__(self, metrics: list, bucket: int = 60, group_by: str = 'instance'):
+        self.metrics = metrics
+        self.bucket = bucket
+        self.group_by = group_by
+        self.groups = {}  # group -> bucket -> metric -> PartialAggregate
+        self.__metric_names = {}
+
+    def __is_selected(self, name: str) -> bool:
+        """ The selected metrics can be names or patterns of names (e.g. network_rx_*) """
+        if name not in self.__metric_names:
+            self.__metric_names[name] = any(fnmatch.fnmatchcase(name, metric) for metric in self.metrics)
+        return self.__metric_names[name]
+
+    def add(self, instance_name: str, timestamp: float, record: dict):
+        """
+        Adds a monitoring record
+        :param instance_name: The name of the record's instance
+        :param timestamp: The epoch of the record
+        :param record: The record as a dictionary of metric to value
+        """
+        group = service_of(instance_name) if self.group_by == 'service' else instance_name
+        bucket = int(timestamp - timestamp % self.bucket) if self.bucket else 0
+        buckets = self.groups.setdefault(group, {})
+        metrics = buckets.setdefault(bucket, {})
+        for name, value in record.items():
+            if name in ('count', 'timestamp') or not isinstance(value, (int, float)) or math.isnan(value): continue
+            if not self.__is_selected(name): continue
+            if name not in metrics: metrics[name] = PartialAggregate()
+            metrics[name].add(value, timestamp, instance_name)
+        if not metrics: del buckets[bucket]
+        if not buckets: del self.groups[group]
+
+    def merge(self, partials: dict):
+        """ Merges the partial results (see to_dict) of another aggregation """
+        for group, buckets in partials.items():
+            for bucket, metrics in buckets.items():
+                current = self.groups.setdefault(group, {}).setdefault(int(bucket), {})
+                for name, partial in metrics.items():
+                    partial = PartialAggregate.from_dict(partial)
+                    current[name] = current[name].merge(partial) if name in current else partial
+        return self
+
+    def to_dict(self) -> dict:
+        return {group: {bucket: {name: partial.to_dict() for name, partial in metrics.items()}
+                        for bucket, metrics in buckets.items()} for group, buckets in self.groups.items()}
+
+    def results(self, funcs: list) -> dict:
+        """
+        Computes the aggregate functions
+        :param funcs: A list of functions (mean, min, max, sum, count, rate, pNN)
+        :return: A dictionary of group to a list of records of {"timestamp": <bucket's start>, "<metric>_<func>": ...}
+        """
+        res = {}
+        for group, buckets in self.groups.items():
+            res[group] = []
+            for bucket in sorted(buckets):
+                record = {'timestamp': bucket}
+                for name, partial in buckets[bucket].items():
+                    for func in funcs:
+                        record['%s_%s' % (name, func)] = partial.result(func)
+                res[group].append(record)
+        return res
@@ -0,0 +1,223 @@
+import threading
+import time
+
+import docker
+
+from utils.docker_manager import ContainerNetworkNamespace, get_container_ip_property, get_ip_from_network_object
+from utils.logging import FogifyLogger
+
+logger = FogifyLogger(__name__)
+
+SERVICE_LABELS = ('com.docker.compose.service', 'com.docker.swarm.service.name')
+FOGIFY_LABELS = {'com.docker.compose.project': 'fogify', 'com.docker.stack.namespace': 'fogify'}
+
+
+def is_fogify_event(event: dict) -> bool:
+    """ Checks if a docker event concerns a container of the fogify project (compose) or stack (swarm) """
+    attributes = event.get('Actor', {}).get('Attributes', {})
+    return any(attributes.get(label) == value for label, value in FOGIFY_LABELS.items())
+
+
+class ContainerInfo(object):
+    """ The metadata of a running container that the agent needs at every monitoring tick """
+
+    def __init__(self, container):
+        attrs = container.attrs
+        self.id = container.id
+        self.name = container.name
+        self.pid = attrs.get('State', {}).get('Pid')
+        labels = attrs.get('Config', {}).get('Labels') or {}
+        self.service = labels.get(SERVICE_LABELS[0]) or labels.get(SERVICE_LABELS[1])
+        self.merged_dir = (attrs.get('GraphDriver') or {}).get('Data', {}).get('MergedDir')
+        self.limits = dict(memory=attrs['HostConfig']['Memory'], cpu=attrs['HostConfig']['NanoCpus'])
+        networks = attrs.get('NetworkSettings', {}).get('Networks') or {}
+        self.networks = {network: get_ip_from_network_object(networks[network]) for network in networks}
+        self.interfaces = {}
+
+    @property
+    def ips_to_networks(self):
+        return {ip: network for network, ip in self.networks.items()}
+
+    def get_interface_ip(self, interface: str):
+        """
+        Returns the ip of a container's interface. The interface is resolved once inside the container's network
+        namespace and is kept until the container's network changes.
+        :param interface: The name of the interface inside the container (e.g. eth0)
+        :return: The ip of the interface or None
+        """
+        if interface in self.interfaces: return self.interfaces[interface]
+        ip = None
+        with ContainerNetworkNamespace(self.id, self.pid):
+            eth_ip = get_container_ip_property(interface)
+        if eth_ip:
+            ip = eth_ip[eth_ip.find("inet ") + len("inet "):eth_ip.rfind("/")]
+        self.interfaces[interface] = ip
+        return ip
+
+
+class ContainerRegistry(object):
+    """
+    The agent-wide inventory of the running fogify containers, keyed by the container id and indexed by name, service,
+    pid and ip. The registry subscribes once to the docker event stream (see `listen`) and keeps the inventory up to
+    date (container start/die/destroy and network connect/disconnect), while the other subsystems of the agent
+    (monitoring, network QoS, sniffer, actions) look the containers up instead of listing them through the docker API
+    and register listeners for the events. Without the event stream, the entries are fetched at their first use.
+    """
+
+    INVALIDATING_EVENTS = {('container', 'start'), ('container', 'die'), ('container', 'destroy'),
+                           ('network', 'connect'), ('network', 'disconnect')}
+
+    def __init__(self, client=None, prefix: str = 'fogify_'):
+        self.client = client
+        self.prefix = prefix
+        self.containers = {}
+        self.names, self.services, self.pids, self.ips = {}, {}, {}, {}
+        self.listeners = []
+        self.is_listening = False
+        self.lock = threading.Lock()
+
+    def get_client(self):
+        if self.client is None:
+            self.client = docker.from_env()
+        return self.client
+
+    def get(self, container_id: str) -> ContainerInfo:
+        """ Returns the metadata of a container or None if the container is not a fogify container """
+        info = self.containers.get(container_id)
+        if info: return info
+        info = ContainerInfo(self.get_client().containers.get(container_id))
+        if not info.name.startswith(self.prefix): return None
+        with self.lock:
+            self.__add(info)
+        return info
+
+    def __add(self, info: ContainerInfo):
+        self.__remove(info.id)
+        self.containers[info.id] = info
+        self.names[info.name] = info
+        if info.pid: self.pids[info.pid] = info
+        if info.service: self.services.setdefault(info.service, {})[info.id] = info
+        for network, ip in info.networks.items():
+            if ip: self.ips[ip] = (info, network)
+
+    def __remove(self, container_id: str):
+        info = self.containers.pop(container_id, None)
+        if not info: return
+        if self.names.get(info.name) is info: del self.names[info.name]
+        if self.pids.get(info.pid) is info: del self.pids[info.pid]
+        if info.service in self.services:
+            self.services[info.service].pop(info.id, None)
+            if not self.services[info.service]: del self.services[info.service]
+        for ip in info.networks.values():
+            if ip in self.ips and self.ips[ip][0] is info: del self.ips[ip]
+
+    def invalidate(self, container_id: str):
+        with self.lock:
+            self.__remove(container_id)
+
+    def clear(self):
+        with self.lock:
+            self.containers = {}
+            self.names, self.services, self.pids, self.ips = {}, {}, {}, {}
+
+    def refresh(self):
+        """ Synchronizes the inventory with the running fogify containers (one sparse docker API call) """
+        running = set()
+        for container in self.get_client().containers.list(sparse=True):
+            names = container.attrs.get('Names') or []
+            if not (names and names[0].lstrip("/").startswith(self.prefix)): continue
+            running.add(container.id)
+            if container.id in self.containers: continue
+            try:
+                self.get(container.id)
+            except docker.errors.NotFound:
+                running.discard(container.id)
+        with self.lock:
+            for container_id in set(self.containers) - running:
+                self.__remove(container_id)
+
+    def running(self) -> list:
+        """ Returns the running fogify containers (the docker API is called only if the registry does not listen) """
+        if not self.is_listening: self.refresh()
+        return list(self.containers.values())
+
+    def find_by_name(self, name: str) -> list:
+        """ Returns the containers whose name contains the given name (e.g. an instance or a service name) """
+        if name in self.names: return [self.names[name]]
+        return [info for info in self.running() if info.name.find(name) > -1]
+
+    def find_by_service(self, service: str) -> list:
+        if not self.is_listening: self.refresh()
+        return list(self.services.get(service, {}).values())
+
+    def find_by_pid(self, pid: int):
+        return self.pids.get(pid)
+
+    def pid_of(self, container_id: str):
+        """ Returns the pid of a container, if the container is known, otherwise None """
+        info = self.containers.get(container_id)
+        return info.pid if info else None
+
+    def find_by_ip(self, ip: str):
+        """
+        Returns the container and the network that an ip belongs to
+        :param ip: The ip of the container in an emulated network
+        :return: A tuple of (ContainerInfo, network name) or None
+        """
+        return self.ips.get(ip)
+
+    def add_listener(self, listener):
+        """
+        Registers a function that is called with every docker event, after the inventory is updated
+        :param listener: A function of the decoded docker event
+        """
+        self.listeners.append(listener)
+
+    def handle_event(self, event: dict):
+        """
+        Updates the inventory based on a docker event
+        :param event: The decoded docker event
+        """
+        key = (event.get('Type'), event.get('Action', event.get('status')))
+        if key not in self.INVALIDATING_EVENTS: return
+        if key[0] == 'network':
+            container_id = event.get('Actor', {}).get('Attributes', {}).get('container')
+        else:
+            container_id = event.get('id')
+        if not container_id: return
+        is_known = container_id in self.containers
+        self.invalidate(container_id)
+        if key in {('container', 'die'), ('container', 'destroy')} or not self.is_listening: return
+        if key[0] == 'network' and not is_known: return
+        name = event.get('Actor', {}).get('Attributes', {}).get('name', '')
+        if key[0] == 'container' and not name.startswith(self.prefix): return
+        try:
+            self.get(container_id)
+        except docker.errors.NotFound:
+            return
+
+    def listen(self):
+        """
+        The long-running method that consumes the docker event stream, keeps the inventory up to date and notifies
+        the listeners. The stream is re-opened (and the inventory is re-synchronized) if it fails.
+        """
+        while True:
+            try:
+                events = self.get_client().events(decode=True)
+                self.refresh()
+                self.is_listening = True
+                logger.info("The container registry listens docker socket.")
+                for event in events:
+                    try:
+                        self.handle_event(event)
+                    except Exception:
+                        logger.warning("The container registry did not handle the event %s" % event, exc_info=True)
+                    for listener in self.listeners:
+                        try:
+                            listener(event)
+                        except Exception:
+                            logger.error("An error occurred in a container listener.", exc_info=True)
+            except Exception:
+                logger.error("The docker event stream of the container registry failed.", exc_info=True)
+            self.is_listening = False
+            time.sleep(1)
@@ -0,0 +1,123 @@
+import threading
+import time
+
+import docker
+
+from utils.container_registry import FOGIFY_LABELS
+from utils.logging import FogifyLogger
+
+logger = FogifyLogger(__name__)
+
+VERSION_HEADER = 'X-Fogify-Topology-Version'
+STATUS_HEADER = 'X-Fogify-Deployment-Status'
+# the events that change the deployed services (the rest, e.g., exec or health status events, are ignored)
+DEPLOYMENT_EVENTS = {'container': ('start', 'die', 'destroy'), 'service': ('create', 'update', 'remove')}
+
+
+class DeploymentState(object):
+    """
+    The controller's in-memory state machine of the deployment (available -> deploying -> running -> undeploying ->
+    available, or error). The deployed services (the connector's `return_deployment`) are refreshed on the docker
+    events of the fogify containers and services, and periodically while a deployment or an undeployment is in
+    progress, since the tasks of the remote swarm nodes do not emit events at the manager. Every change increases the
+    version, thus the clients long-poll (see `wait`) for the next version instead of polling the connector. A
+    long-poll holds a worker thread of the controller, thus at most `max_waiters` long-polls wait concurrently.
+    """
+
+    AVAILABLE = 'available'
+    DEPLOYING = 'deploying'
+    RUNNING = 'running'
+    UNDEPLOYING = 'undeploying'
+    ERROR = 'error'
+    TRANSITIONS = (DEPLOYING, UNDEPLOYING)
+
+    def __init__(self, connector_class, refresh_interval: float = 1, max_waiters: int = 4):
+        self.connector_class = connector_class
+        self.refresh_interval = refresh_interval
+        self.max_waiters = max_waiters
+        self.waiters = 0
+        self.status = self.AVAILABLE
+        self.deployment = {}
+        self.version = 0
+        self.condition = threading.Condition()
+
+    @property
+    def instances(self) -> int:
+        return sum(len(instances) for instances in self.deployment.values())
+
+    def snapshot(self) -> tuple:
+        """ Returns the version, the status and the deployed services """
+        with self.condition:
+            return self.version, self.status, self.deployment
+
+    def update(self, status: str = None, deployment: dict = None):
+        with self.condition:
+            changed = False
+            if status is not None and status != self.status:
+                self.status, changed = status, True
+            if deployment is not None and deployment != self.deployment:
+                self.deployment, changed = deployment, True
+            if not changed: return
+            self.version += 1
+            self.condition.notify_all()
+
+    def refresh(self):
+        """ Retrieves the deployed services from the connector """
+        try:
+            self.update(deployment=self.connector_class.return_deployment())
+        except Exception:
+            logger.warning("The deployment state is not refreshed.", exc_info=True)
+
+    def wait(self, version: int, timeout: float) -> tuple:
+        """
+        Blocks until the version of the state differs from the client's version or the timeout expires (long-poll)
+        :param version: The version that the client has already seen
+        :param timeout: The maximum seconds to wait
+        :return: The snapshot of the state or None if `max_waiters` long-polls are already waiting
+        """
+        with self.condition:
+            if self.version == version and self.waiters >= self.max_waiters: return None
+            self.waiters += 1
+            try:
+                self.condition.wait_for(lambda: self.version != version, timeout)
+            finally:
+                self.waiters -= 1
+        return self.snapshot()
+
+    def is_available(self) -> bool:
+        with self.condition:
+            return self.status not in self.TRANSITIONS and self.instances < 1
+
+    def is_running(self) -> bool:
+        with self.condition:
+            return self.status != self.UNDEPLOYING and self.instances > 0
+
+    @staticmethod
+    def is_fogify_event(event: dict) -> bool:
+        if event.get('Action') not in DEPLOYMENT_EVENTS.get(event.get('Type'), ()): return False
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        if any(attributes.get(label) == value for label, value in FOGIFY_LABELS.items()): return True
+        return event.get('Type') == 'service' and attributes.get('name', '').startswith('fogify')
+
+    def listen(self):
+        """ The long-running method that refreshes the state on the docker events of the fogify containers/services """
+        filters = {'type': list(DEPLOYMENT_EVENTS),
+                   'event': sorted({action for actions in DEPLOYMENT_EVENTS.values() for action in actions})}
+        while True:
+            try:
+                events = docker.from_env().events(decode=True, filters=filters)
+                self.refresh()
+                self.update(status=self.RUNNING if self.instances > 0 and self.status == self.AVAILABLE else None)
+                for event in events:
+                    if self.is_fogify_event(event): self.refresh()
+            except Exception:
+                logger.error("The docker event stream of the deployment state failed.", exc_info=True)
+            time.sleep(1)
+
+    def poll(self):
+        """ The long-running method that refreshes the state while a deployment or an undeployment is in progress """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.status in self.TRANSITIONS)
+            self.refresh()
+            time.sleep(self.refresh_interval)
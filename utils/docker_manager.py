@@ -4,6 +4,7 @@ import subprocess
 
 from nsenter import Namespace
 
+from utils.instrumentation import metrics as instrumentation
 from utils.logging import FogifyLogger
 
 
@@ -13,11 +14,15 @@ logger = FogifyLogger(__name__)
 
 class ContainerNetworkNamespace(Namespace):
 
-    def __init__(self, container_id: str):
+    def __init__(self, container_id: str, pid: int = None):
         proc = os.environ["NAMESPACE_PATH"] if "NAMESPACE_PATH" in os.environ else "/proc/"
-        pid = self.get_pid_from_container(container_id)
+        pid = pid if pid else self.get_pid_from_container(container_id)
         Namespace.__init__(self, proc + "/" + str(pid) + "/ns/net", 'net')
 
+    def __enter__(self):
+        with instrumentation.timer('fogify_namespace_entry_duration_seconds'):
+            return Namespace.__enter__(self)
+
     def get_pid_from_container(self, container_id: str):
         try:
             res = subprocess.getoutput("docker inspect %s --format '{{.State.Pid}}' " % container_id)
@@ -0,0 +1,200 @@
+import re
+import threading
+import time
+from functools import wraps
+
+from flask import Response, g, request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+INVALID_NAME_CHARACTERS = re.compile(r'[^a-zA-Z0-9_]')
+NETWORK_METRIC = re.compile(r'^network_(rx|tx)_(rate_)?(.+)$')
+CONTAINER_COUNTERS = {'cpu'}
+
+
+class Metrics(object):
+    """
+    The self-instrumentation of a Fogify process, i.e., counters, gauges and timers (histograms of durations in seconds)
+    with optional labels. The values are kept in memory and are exposed in the Prometheus text format by the
+    `/metrics/` endpoint (see `install_metrics_endpoint`).
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.descriptions = {}  # name -> (type, help)
+        self.counters = {}  # name -> {labels: value}
+        self.gauges = {}
+        self.timers = {}  # name -> {labels: [bucket counts..., count, sum]}
+        self.lock = threading.Lock()
+
+    def describe(self, name: str, metric_type: str, description: str):
+        self.descriptions[name] = (metric_type, description)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = self.__key(labels)
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[self.__key(labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self.__key(labels)
+        with self.lock:
+            values = self.timers.setdefault(name, {})
+            observations = values.get(key)
+            if observations is None: observations = values[key] = [0] * (len(self.buckets) + 2)
+            for i, bucket in enumerate(self.buckets):
+                if seconds <= bucket: observations[i] += 1
+            observations[-2] += 1
+            observations[-1] += seconds
+
+    def timer(self, name: str, **labels):
+        """ A context manager (or decorator) that observes the duration of a block """
+        return Timer(self, name, labels)
+
+    @staticmethod
+    def __key(labels: dict) -> tuple:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    @staticmethod
+    def __labels(key: tuple, extra: tuple = ()) -> str:
+        pairs = key + extra
+        if not pairs: return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, label_value(value)) for name, value in pairs)
+
+    def __header(self, name: str, metric_type: str) -> list:
+        described_type, description = self.descriptions.get(name, (metric_type, None))
+        lines = ['# HELP %s %s' % (name, description)] if description else []
+        return lines + ['# TYPE %s %s' % (name, described_type)]
+
+    def render(self) -> str:
+        """ Returns the metrics in the Prometheus text format """
+        lines = []
+        with self.lock:
+            for name, values in sorted(self.counters.items()):
+                lines += self.__header(name, 'counter')
+                lines += ['%s%s %s' % (name, self.__labels(key), value) for key, value in values.items()]
+            for name, values in sorted(self.gauges.items()):
+                lines += self.__header(name, 'gauge')
+                lines += ['%s%s %s' % (name, self.__labels(key), value) for key, value in values.items()]
+            for name, values in sorted(self.timers.items()):
+                lines += self.__header(name, 'histogram')
+                for key, observations in values.items():
+                    for bucket, count in zip(self.buckets, observations):
+                        lines.append('%s_bucket%s %s' % (name, self.__labels(key, (('le', str(bucket)),)), count))
+                    lines.append('%s_bucket%s %s' % (name, self.__labels(key, (('le', '+Inf'),)), observations[-2]))
+                    lines.append('%s_count%s %s' % (name, self.__labels(key), observations[-2]))
+                    lines.append('%s_sum%s %s' % (name, self.__labels(key), observations[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self.lock:
+            self.counters, self.gauges, self.timers = {}, {}, {}
+
+
+class Timer(object):
+
+    def __init__(self, metrics: Metrics, name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Timer(self.metrics, self.name, self.labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+metrics = Metrics()
+metrics.describe('fogify_api_request_duration_seconds', 'histogram', 'The latency of the API handlers')
+metrics.describe('fogify_monitoring_stage_duration_seconds', 'histogram',
+                 'The duration of the monitoring stages (fetch, compute, store) of a tick')
+metrics.describe('fogify_monitoring_tick_delay_seconds', 'gauge', 'How late the last monitoring tick started')
+metrics.describe('fogify_monitoring_sampled_instances', 'gauge', 'The number of the instances sampled at the last tick')
+metrics.describe('fogify_monitoring_errors_total', 'counter', 'The instances whose metrics were not computed')
+metrics.describe('fogify_qos_stage_duration_seconds', 'histogram',
+                 'The duration of the network QoS stages (adapters, general rules, link commands, firewall)')
+metrics.describe('fogify_namespace_entry_duration_seconds', 'histogram', 'The duration of a network namespace entry')
+metrics.describe('fogify_qos_applications_total', 'counter', 'The network QoS applications per service')
+metrics.describe('fogify_sniffer_buffer_depth', 'gauge', 'The captured packets waiting in the sniffer buffer')
+metrics.describe('fogify_sniffer_flush_duration_seconds', 'histogram', 'The duration of a sniffer buffer flush')
+metrics.describe('fogify_sniffer_flushed_packets_total', 'counter', 'The packets flushed from the sniffer buffer')
+metrics.describe('fogify_database_queue_depth', 'gauge', 'The writes waiting in the queue of the database writer')
+metrics.describe('fogify_database_commit_duration_seconds', 'histogram', 'The duration of a group commit')
+metrics.describe('fogify_database_batch_size', 'gauge', 'The number of the writes of the last group commit')
+
+
+def label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_container_metrics(latest_samples: dict) -> str:
+    """
+    Renders the last sample of every emulated instance in the Prometheus text format. The metrics are named
+    fogify_container_<metric> and are labeled by instance and service, while the network metrics are
+    fogify_container_network_<rx|tx>_bytes (or _bytes_per_second for their rates) with a network label.
+    :param latest_samples: A dictionary of instance name to (service, timestamp, {metric: value})
+    :return: The exposition text
+    """
+    families = {}  # name -> (type, [lines])
+    for instance_name, (service, timestamp, values) in sorted(latest_samples.items()):
+        labels = 'instance="%s",service="%s"' % (label_value(instance_name), label_value(service))
+        values = dict(values, last_sample_timestamp_seconds=timestamp.timestamp())
+        for metric, value in values.items():
+            if not isinstance(value, (int, float)): continue
+            network = NETWORK_METRIC.match(metric)
+            if network and network.group(2):
+                name, metric_type = 'fogify_container_network_%s_bytes_per_second' % network.group(1), 'gauge'
+                metric_labels = '%s,network="%s"' % (labels, label_value(network.group(3)))
+            elif network:
+                name, metric_type = 'fogify_container_network_%s_bytes' % network.group(1), 'counter'
+                metric_labels = '%s,network="%s"' % (labels, label_value(network.group(3)))
+            else:
+                name = 'fogify_container_' + INVALID_NAME_CHARACTERS.sub('_', metric)
+                metric_type, metric_labels = 'counter' if metric in CONTAINER_COUNTERS else 'gauge', labels
+            families.setdefault(name, (metric_type, []))[1].append('%s{%s} %s' % (name, metric_labels, float(value)))
+    lines = []
+    for name, (metric_type, samples) in sorted(families.items()):
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        lines += samples
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_response() -> Response:
+    return Response(metrics.render(), mimetype=None, content_type=CONTENT_TYPE)
+
+
+def install_metrics_endpoint(app):
+    """
+    Exposes the process' metrics at /metrics/ and measures the latency of every API handler
+    :param app: The flask application of the agent or the controller
+    """
+
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    def observe_latency(response):
+        started = g.pop('request_started', None)
+        if started is not None and request.url_rule is not None:
+            metrics.observe('fogify_api_request_duration_seconds', time.perf_counter() - started,
+                            endpoint=request.url_rule.rule, method=request.method, status=response.status_code)
+        return response
+
+    app.before_request(start_timer)
+    app.after_request(observe_latency)
+    app.add_url_rule('/metrics/', 'Metrics', metrics_response)
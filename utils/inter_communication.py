@@ -1,15 +1,126 @@
 import json
 import os
 import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from enum import Enum
 
 import requests
+from flask import g, has_request_context
+from requests.adapters import HTTPAdapter
 
 from connectors.base import BasicConnector
+from utils.aggregation import Aggregation
+from utils.instrumentation import metrics as instrumentation
+from utils.metric_cache import MetricCache
+from utils.placement import PlacementIndex
+from utils.wire_format import Columns, requested_formats, loads
 from utils.logging import FogifyLogger
 
 logger = FogifyLogger(__name__)
 
+UNREACHABLE_AGENTS_HEADER = 'X-Fogify-Unreachable-Agents'
+
+instrumentation.describe('fogify_agent_requests_failed_total', 'counter',
+                         'The controller requests that did not reach an agent or timed out')
+
+
+class AgentPool(object):
+    """
+    Sends the controller's requests to the agents concurrently through a bounded thread pool. Every agent has its own
+    persistent session (the connections are reused) and every request has a connect and a read timeout, so a call to
+    all agents takes the time of the slowest agent and a stuck agent is reported instead of blocking the controller.
+    A call to all agents returns after `deadline` seconds at most, even if an agent keeps sending a slow response.
+    """
+
+    def __init__(self, workers: int = 16, connect_timeout: float = 3, read_timeout: float = 60, deadline: float = 90):
+        self.workers = workers
+        self.timeout = (connect_timeout, read_timeout)
+        self.deadline = deadline
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='agent-pool')
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, host: str) -> requests.Session:
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = self.sessions[host] = requests.Session()
+                session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=self.workers))
+            return session
+
+    def request(self, method: str, host: str, url: str, **kwargs) -> requests.Response:
+        """ Sends a request to the agent of the host through the agent's session """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(host).request(method, url, **kwargs)
+
+    def fan_out(self, nodes: dict, call) -> tuple:
+        """
+        Calls all agents concurrently
+        :param nodes: A dictionary of node name to the host of its agent
+        :param call: A function of (node name, host) that performs the requests to an agent and returns its result
+        :return: A tuple of the results ({node name: result}, in the order of the nodes) and the unreachable agents
+        ({node name: reason})
+        """
+        futures = {node: self.executor.submit(call, node, host) for node, host in nodes.items()}
+        wait(futures.values(), timeout=self.deadline)
+        results, unreachable = {}, {}
+        for node, future in futures.items():
+            if not future.done():
+                future.cancel()
+                logger.error('The agent of node %s did not respond in %s seconds' % (node, self.deadline))
+                unreachable[node] = 'deadline exceeded'
+                continue
+            try:
+                results[node] = future.result()
+            except requests.exceptions.RequestException as e:
+                logger.error('The agent of node %s is unreachable (%s)' % (node, e))
+                unreachable[node] = str(e)
+            except ValueError as e:
+                logger.error('The agent of node %s returned an invalid response' % node, exc_info=True)
+                unreachable[node] = str(e)
+        if unreachable: report_unreachable_agents(unreachable)
+        return results, unreachable
+
+
+def report_unreachable_agents(unreachable: dict):
+    """ Keeps the unreachable agents of the current API request, they are reported in the response's headers """
+    instrumentation.increment('fogify_agent_requests_failed_total', len(unreachable))
+    if not has_request_context(): return
+    reported = g.setdefault('unreachable_agents', [])
+    reported += [node for node in unreachable if node not in reported]
+
+
+def add_unreachable_agents_header(response):
+    """ Adds the agents that did not respond to the current request in the response's headers (partial results) """
+    unreachable = g.pop('unreachable_agents', None)
+    if unreachable: response.headers[UNREACHABLE_AGENTS_HEADER] = ",".join(unreachable)
+    return response
+
+
+_agent_pool = None
+_agent_pool_lock = threading.Lock()
+
+
+def get_agent_pool() -> AgentPool:
+    """
+    Returns the shared pool of the controller based on its environment variables (AGENT_POOL_SIZE,
+    AGENT_CONNECT_TIMEOUT, AGENT_TIMEOUT and AGENT_DEADLINE in seconds)
+    """
+    global _agent_pool
+    with _agent_pool_lock:
+        if _agent_pool is None:
+            workers = os.environ.get('AGENT_POOL_SIZE', '')
+            connect_timeout = os.environ.get('AGENT_CONNECT_TIMEOUT', '')
+            read_timeout = os.environ.get('AGENT_TIMEOUT', '')
+            deadline = os.environ.get('AGENT_DEADLINE', '')
+            _agent_pool = AgentPool(workers=int(workers) if workers.isnumeric() and int(workers) > 0 else 16,
+                                     connect_timeout=int(connect_timeout) if connect_timeout.isnumeric() else 3,
+                                     read_timeout=int(read_timeout) if read_timeout.isnumeric() else 60,
+                                     deadline=int(deadline) if deadline.isnumeric() and int(deadline) > 0 else 90)
+        return _agent_pool
+
+
 class Communicator(object):
     """
     This class encapsulates all necessary API calls that are need to be performed between the Fogify Controller and
@@ -20,15 +131,36 @@ class Communicator(object):
         agent_action = 'http://%s:5500/actions/'
         agent_topology = 'http://%s:5500/topology/'
         controller_link_updates = 'http://%s:5000/control/%s/'
+        controller_metric_stream = 'http://%s:5000/monitorings/stream/'
         agent_packet = 'http://%s:5500/packets/'
         agent_metrics = 'http://%s:5500/monitorings/'
+        agent_aggregation = 'http://%s:5500/monitorings/aggregate/'
         agent_distribution = 'http://%s:5500/generate-network-distribution/%s/'
 
-    def __init__(self, connector: BasicConnector = None):
+    def __init__(self, connector: BasicConnector = None, pool: AgentPool = None, placement: PlacementIndex = None):
         self.connector = connector
+        self.pool = pool if pool else get_agent_pool()
+        self.placement = placement
+        self.unreachable_agents = {}
+
+    def __nodes(self, service: str = None, exact: bool = True) -> dict:
+        """
+        Returns the nodes of the agents, only the nodes that host the service if the placement index knows it (see
+        PlacementIndex.nodes_of for the exact parameter)
+        """
+        nodes = self.connector.get_nodes()
+        if not service or self.placement is None: return nodes
+        hosting_nodes = self.placement.nodes_of(self.connector, service, exact)
+        if hosting_nodes is None: return nodes
+        return {node: host for node, host in nodes.items() if node in hosting_nodes}
+
+    def __fan_out(self, nodes: dict, call) -> dict:
+        results, self.unreachable_agents = self.pool.fan_out(nodes, call)
+        return results
 
     def __instance_ids(self, instance_id: str = None, instance_type: str = None):
         docker_instances = self.connector.get_all_instances()
+        if self.placement is not None: self.placement.update(self.connector, docker_instances)
 
         if instance_id in docker_instances:
             return {docker_instances[instance_id]: [instance_id]}
@@ -45,38 +177,217 @@ class Communicator(object):
 
     def agents__perform_action(self, commands: dict = {}, instance_id: str = None, instance_type: str = None, **kwargs):
         selected_instances = self.__instance_ids(instance_id, instance_type)
-        res = {}
-        for i in selected_instances:
 
-            res.update(requests.post(self.URLs.agent_action.value % socket.gethostbyname(i),
-                json={'instances': selected_instances[i], 'commands': commands},
-                headers={'Content-Type': "application/json"}).json())
-            logger.info(f"Commands {commands} are performed on {selected_instances[i]}({i})")
+        def perform_action(node, host):
+            r = self.pool.request('POST', host, self.URLs.agent_action.value % host,
+                                  json={'instances': selected_instances[node], 'commands': commands},
+                                  headers={'Content-Type': "application/json"}).json()
+            logger.info(f"Commands {commands} are performed on {selected_instances[node]}({node})")
+            return r
+
+        res = {}
+        for r in self.__fan_out({i: socket.gethostbyname(i) for i in selected_instances}, perform_action).values():
+            res.update(r)
         return res
 
     def agents__notify_emulation_deleted(self):
         return self.agents__delete(self.URLs.agent_topology.value, "topology")
 
-    def agents__notify_emulation_started(self):
+    def agents__post_topology(self, data: dict = None) -> dict:
+        """
+        Posts to the topology API of all agents
+        :param data: The form data of the request (e.g. the network file or the monitoring rules)
+        :return: A dictionary of the agents' hosts to their responses
+        """
         nodes = self.connector.get_nodes()
-        res = {}
-        for i in nodes:
-            res.update({nodes[i]: requests.post(self.URLs.agent_topology.value % nodes[i])})
-        return res
+        results = self.__fan_out(nodes, lambda node, host: self.pool.request(
+            'POST', host, self.URLs.agent_topology.value % host, data=data))
+        return {nodes[i]: r for i, r in results.items()}
+
+    def agents__notify_emulation_started(self):
+        return self.agents__post_topology()
 
     def agents__forward_network_file(self, network_file):
-        nodes = self.connector.get_nodes()
+        res = self.agents__post_topology({'file': json.dumps(network_file)})
+        return {host: r.json() for host, r in res.items()}
+
+    def agents__forward_monitoring_rules(self, monitoring_rules):
+        res = self.agents__post_topology({'monitoring': json.dumps(monitoring_rules)})
+        return {host: r.json() for host, r in res.items()}
+
+    def agents__get_metrics(self, query: str = None, cursor: str = None, service: str = None) -> dict:
+        """
+        Retrieves the monitoring records of all agents
+        :param query: The query string of the agents' monitoring API
+        :param cursor: The composite cursor of a previous call ("<node>:<count>,..."), an empty string fetches all
+        records. If it is set, the response is {"cursor": <next composite cursor>, "data": {...}}
+        :param service: The service (or instance) filter of the query, only the agents that host it are queried
+        :return: The records grouped by instance
+        """
+        nodes = self.__nodes(service)
+        counts = self.parse_cursor(cursor) if cursor is not None else None
+
+        def get_records(node, host):
+            str_url = self.URLs.agent_metrics.value % host
+            str_url = str_url + "?since_count=%s&" % counts.get(node, 0) if counts is not None else str_url + "?"
+            str_url = str_url + query if query else str_url
+            r = self.pool.request('GET', host, str_url).json()
+            logger.info(f"GET http request for the agent at {host}({node}) is executed")
+            return r
+
         res = {}
+        for i, r in self.__fan_out(nodes, get_records).items():
+            if counts is not None:
+                if 'cursor' not in r or 'data' not in r:
+                    logger.error(f"The agent at {nodes[i]}({i}) did not return its records ({r})")
+                    continue
+                counts[i], r = r['cursor'], r['data']
+            for key, value in r.items():
+                if isinstance(value, list):
+                    res.setdefault(key, []).extend(value)
+                else:
+                    res[key] = value  # e.g., the error of an agent
+        return res if cursor is None else {"cursor": self.format_cursor(counts), "data": res}
+
+    def agents__get_cached_metrics(self, cache: MetricCache, query: str = None, service: str = None) -> dict:
+        """
+        Retrieves the monitoring records of all agents through the controller's cache, i.e., only the records after
+        the cached counter of each agent are pulled. The cached records of an unreachable agent are still returned.
+        :param cache: The metric cache of the controller
+        :param query: The query string of the agents' monitoring API
+        :param service: The service (or instance) filter of the query, only the agents that host it are queried
+        :return: The records grouped by instance
+        """
+        nodes = self.__nodes(service)
+        cached_query = cache.query(query or "")
+
+        def get_records(node, host, since_count):
+            str_url = self.URLs.agent_metrics.value % host + "?since_count=%s" % since_count
+            str_url = str_url + "&" + query if query else str_url
+            r = self.pool.request('GET', host, str_url).json()
+            logger.info(f"GET http request for the agent at {host}({node}) is executed")
+            return r
+
+        def get_delta(node, host):
+            r = get_records(node, host, cached_query.counts.get(node, 0))
+            if cached_query.is_stale(node, r.get('epoch'), r.get('retention')):
+                # the agent restarted, its metrics were removed or it rolled up the cached records
+                r = get_records(node, host, 0)
+            return r
+
+        with cached_query.lock:
+            pulled = 0
+            for i, r in self.__fan_out(nodes, get_delta).items():
+                if 'cursor' not in r or 'data' not in r:
+                    logger.error(f"The agent at {nodes[i]}({i}) did not return its records ({r})")
+                    continue
+                pulled += cached_query.update(i, r['cursor'], r['data'], r.get('epoch'), r.get('retention'))
+            res = cached_query.merged(list(nodes))
+        cache.pulled(pulled)
+        return res
+
+    def agents__stream_metrics(self, query: str = None, cursor: str = None, service: str = None):
+        """
+        Retrieves the monitoring records of the agents as newline-delimited json, one agent after the other, without
+        loading whole responses in memory
+        :param query: The query string of the agents' monitoring API
+        :param cursor: The composite cursor of a previous call. If it is set, each agent returns only the records
+        after its own count and the last line is the next composite cursor ({"cursor": ...})
+        :param service: The service (or instance) filter of the query, only the agents that host it are queried
+        :return: A generator of json lines ({"instance": ..., "record": ...})
+        """
+        nodes = self.__nodes(service)
+        counts = self.parse_cursor(cursor) if cursor is not None else None
         for i in nodes:
-            res.update({nodes[i]: requests.post(self.URLs.agent_topology.value % nodes[i],
-                                                data={'file': json.dumps(network_file)}).json()})
+            str_url = self.URLs.agent_metrics.value % nodes[i] + "?stream=true"
+            str_url = str_url + "&since_count=%s" % counts.get(i, 0) if counts is not None else str_url
+            str_url = str_url + "&" + query if query else str_url
+            try:
+                with self.pool.request('GET', nodes[i], str_url, stream=True,
+                                       headers={'Accept': 'application/x-ndjson'}) as r:
+                    for line in r.iter_lines():
+                        if not line: continue
+                        if counts is not None:
+                            # the trailer of the agent's stream is the only line without an instance
+                            obj = json.loads(line)
+                            if 'instance' not in obj and 'cursor' in obj:
+                                counts[i] = obj['cursor']
+                                continue
+                        yield line
+                logger.info(f"GET http request for the agent at {nodes[i]}({i}) is streamed")
+            except requests.exceptions.RequestException:
+                logger.error('The agent of node %s is offline' % i, exc_info=True)
+                report_unreachable_agents({i: 'offline'})
+            except ValueError:
+                logger.error('The agent of node %s returned an invalid stream' % i, exc_info=True)
+                report_unreachable_agents({i: 'invalid response'})
+        if counts is not None:
+            yield json.dumps({"cursor": self.format_cursor(counts)}).encode()
+
+    @staticmethod
+    def parse_cursor(cursor: str) -> dict:
+        """ Parses a composite cursor ("<node>:<count>,...") to a dictionary of node to count """
+        counts = {}
+        for part in cursor.split(","):
+            node, _, count = part.rpartition(":")
+            if node and count.isnumeric(): counts[node] = int(count)
+        return counts
+
+    @staticmethod
+    def format_cursor(counts: dict) -> str:
+        return ",".join("%s:%s" % (node, count) for node, count in counts.items())
+
+    def agents__get_metric_columns(self, query: str = None, cursor: str = None, service: str = None) -> dict:
+        """
+        Retrieves the monitoring records of all agents in columnar form (msgpack or json, see utils.wire_format)
+        :param query: The query string of the agents' monitoring API
+        :param cursor: The composite cursor of a previous call (see agents__get_metrics)
+        :param service: The service (or instance) filter of the query, only the agents that host it are queried
+        :return: {"columns": {...}} and the next composite cursor ("cursor") if a cursor is set
+        """
+        nodes = self.__nodes(service)
+        counts = self.parse_cursor(cursor) if cursor is not None else None
+
+        def get_columns(node, host):
+            str_url = self.URLs.agent_metrics.value % host
+            str_url = str_url + "?since_count=%s&" % counts.get(node, 0) if counts is not None else str_url + "?"
+            str_url = str_url + query if query else str_url
+            r = self.pool.request('GET', host, str_url, headers={'Accept': requested_formats()})
+            logger.info(f"GET http request for the agent at {host}({node}) is executed")
+            return loads(r.content, r.headers.get('Content-Type'))
+
+        columns = Columns()
+        for i, obj in self.__fan_out(nodes, get_columns).items():
+            if 'columns' not in obj:
+                logger.error(f"The agent at {nodes[i]}({i}) did not return columns ({obj})")
+                continue
+            columns.update(Columns(obj['columns']))
+            if counts is not None and 'cursor' in obj: counts[i] = obj['cursor']
+        res = {"columns": columns.columns}
+        if counts is not None: res["cursor"] = self.format_cursor(counts)
         return res
 
-    def agents__get_metrics(self, query: str = None) -> list:
-        return self.agents__get(self.URLs.agent_metrics.value, query)
+    def agents__get_aggregates(self, query: str, aggregation: Aggregation, service: str = None) -> Aggregation:
+        """
+        Merges the partial aggregates of all agents
+        :param query: The query string of the agents' aggregation API
+        :param aggregation: The aggregation that the partial aggregates are merged into
+        :param service: The service (or instance) filter of the query, only the agents that host it are queried
+        :return: The aggregation
+        """
+        nodes = self.__nodes(service)
+        results = self.__fan_out(nodes, lambda node, host: self.pool.request(
+            'GET', host, self.URLs.agent_aggregation.value % host + "?partial=true&" + query).json())
+        for i, r in results.items():
+            if 'partials' in r:
+                aggregation.merge(r['partials'])
+            else:
+                logger.error(f"The agent at {nodes[i]}({i}) did not aggregate its metrics ({r})")
+        return aggregation
 
-    def agents__get_packets(self, query: str = None) -> list:
-        return self.agents__get(self.URLs.agent_packet.value, query, 'array')
+    def agents__get_packets(self, query: str = None, service: str = None) -> list:
+        # the agents filter the packets by any service whose name contains the given one
+        return self.agents__get(self.URLs.agent_packet.value, query, 'array', service, exact=False)
 
     def agents__delete_metrics(self):
         return self.agents__delete(self.URLs.agent_metrics.value, "metrics")
@@ -85,45 +396,37 @@ class Communicator(object):
         return self.agents__delete(self.URLs.agent_packet.value, "packets")
 
     def agents__delete(self, url: str, action_type: str):
-        nodes = self.connector.get_nodes()
-        res = {}
-        for i in nodes:
-            try:
-                r = requests.delete(url % nodes[i]).json()
-                logger.info(f"DELETE http request for the agent at {nodes[i]}({i}) is executed ({r})")
-                res.update(r)
-            except ConnectionError:
-                logger.error('The agent of node %s is offline' % i, exc_info=True)
+        def delete(node, host):
+            r = self.pool.request('DELETE', host, url % host).json()
+            logger.info(f"DELETE http request for the agent at {host}({node}) is executed ({r})")
+            return r
+
+        self.__fan_out(self.connector.get_nodes(), delete)
         return {"message": "The %s are empty now" % action_type}
 
-    def agents__get(self, url: URLs, query: str, type_='object'):
-        nodes = self.connector.get_nodes()
+    def agents__get(self, url: URLs, query: str, type_='object', service: str = None, exact: bool = True):
         is_response_object = type_ == 'object'
+
+        def get(node, host):
+            str_url = url % host
+            str_url = str_url + "?" + query if query else str_url
+            r = self.pool.request('GET', host, str_url).json()
+            logger.info(f"GET http request for the agent at {host}({node}) is executed")
+            return r
+
         res = {} if is_response_object else []
-        str_url = url
-        for i in nodes:
-            try:
-                str_url = str_url % nodes[i]
-                str_url = str_url + "?" + query if query != "" else str_url
-                r = requests.get(str_url).json()
-                if is_response_object:
-                    res.update(r)
-                else:
-                    res.extend(r)
-                logger.info(f"GET http request for the agent at {nodes[i]}({i}) is executed ({r})")
-            except ConnectionError:
-                logger.error('The agent of node %s is offline' % i, exc_info=True)
-            except ValueError:
-                logger.error('The agent of node %s is value error' % i, exc_info=True)
+        for r in self.__fan_out(self.__nodes(service, exact), get).values():
+            if is_response_object:
+                res.update(r)
+            else:
+                res.extend(r)
         return res if is_response_object else {'res': res}
 
     def agents__disseminate_net_distribution(self, name: str, file) -> dict:
-        nodes = self.connector.get_nodes()
-        res = {}
-        for i in nodes:
-            requests.post(self.URLs.agent_distribution.value % (nodes[i], name), files={'file': file})
-
-        return {"generated-distribution": res}
+        content = file.read()
+        self.__fan_out(self.connector.get_nodes(), lambda node, host: self.pool.request(
+            'POST', host, self.URLs.agent_distribution.value % (host, name), files={'file': (name + '.dist', content)}))
+        return {"generated-distribution": {}}
 
     def controller__link_updates(self, update_for_services_needed=None):
         if not update_for_services_needed: return
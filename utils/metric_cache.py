@@ -0,0 +1,125 @@
+import os
+import threading
+from collections import OrderedDict
+
+from utils.instrumentation import metrics as instrumentation
+from utils.logging import FogifyLogger
+
+logger = FogifyLogger(__name__)
+
+instrumentation.describe('fogify_metric_cache_records', 'gauge', 'The monitoring records of the controller\'s cache')
+instrumentation.describe('fogify_metric_cache_pulled_records_total', 'counter',
+                         'The monitoring records that the controller pulled from the agents into its cache')
+
+
+class CachedQuery(object):
+    """
+    The merged records of a monitoring query and the counter (and its epoch) of the last tick that was pulled from each
+    agent. The records are reconciled with the retention of the agents' storage, i.e., the cached records that an agent
+    evicted are dropped and the records of an agent that rolled up its samples are pulled again (see
+    MetricStorage.get_retention), thus the cache returns the same records as the agents.
+    """
+
+    def __init__(self):
+        self.counts = {}  # node -> count of the last pulled tick
+        self.epochs = {}  # node -> epoch of the agent's counter
+        self.compactions = {}  # node -> the agent's compacted_before at the last pull
+        self.records = {}  # node -> {instance name: [records]}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def is_stale(self, node: str, epoch: str = None, retention: dict = None) -> bool:
+        """ Checks if the cached records of an agent have to be pulled again (see update) """
+        if not self.counts.get(node): return False
+        compacted_before = (retention or {}).get('compacted_before')
+        return epoch != self.epochs.get(node) or compacted_before != self.compactions.get(node)
+
+    def update(self, node: str, count: int, data: dict, epoch: str = None, retention: dict = None) -> int:
+        """
+        Appends the records that an agent returned after the cached counter. If the agent's counter went backwards
+        (its metrics were removed or it was restarted), the agent returned all of its records, which replace the cached
+        ones. The same holds if the cached records are stale (the epoch of the agent's counter changed or the agent
+        rolled up more samples), since the caller pulled all of its records.
+        :return: The number of the appended records
+        """
+        retention = retention or {}
+        previous = self.counts.get(node)
+        if previous is None or count < previous or self.is_stale(node, epoch, retention):
+            self.size -= sum(len(records) for records in self.records.get(node, {}).values())
+            self.records[node] = {}
+        instances = self.records[node]
+        appended = 0
+        for instance_name, records in data.items():
+            instances.setdefault(instance_name, []).extend(records)
+            appended += len(records)
+        for instance_name, oldest_count in retention.get('oldest_counts', {}).items():
+            # the records are in the order of their counts, the agent evicted the ones before its oldest sample
+            records = instances.get(instance_name, [])
+            evicted = next((i for i, record in enumerate(records) if record.get('count', 0) >= oldest_count),
+                           len(records))
+            del records[:evicted]
+            self.size -= evicted
+        self.counts[node] = count
+        self.epochs[node] = epoch
+        self.compactions[node] = retention.get('compacted_before')
+        self.size += appended
+        return appended
+
+    def merged(self, nodes: list = None) -> dict:
+        """ Returns the records of the nodes (by default, of all nodes) grouped by instance """
+        res = {}
+        for node, instances in self.records.items():
+            if nodes is not None and node not in nodes: continue
+            for instance_name, records in instances.items():
+                res.setdefault(instance_name, []).extend(records)
+        return res
+
+
+class MetricCache(object):
+    """
+    The controller's cache of the monitoring records. The records of each query (the same filters) are kept per agent
+    along with the agent's counter, so a repeated query pulls from the agents only the records of the new monitoring
+    ticks and serves the rest from memory. When the cache exceeds `max_records`, the least recently used queries are
+    evicted.
+    """
+
+    def __init__(self, max_records: int = 100000):
+        self.max_records = max_records
+        self.queries = OrderedDict()  # query -> CachedQuery, from the least to the most recently used
+        self.lock = threading.Lock()
+
+    def query(self, query: str) -> CachedQuery:
+        with self.lock:
+            cached_query = self.queries.pop(query, None)
+            if cached_query is None: cached_query = CachedQuery()
+            self.queries[query] = cached_query
+            return cached_query
+
+    def pulled(self, records: int):
+        """
+        Evicts the least recently used queries if the cache is full after a pull of the agents' records. A query that
+        exceeds the cache by itself is evicted as well, thus it is pulled again from the agents on its next call.
+        """
+        instrumentation.increment('fogify_metric_cache_pulled_records_total', records)
+        with self.lock:
+            size = sum(cached_query.size for cached_query in self.queries.values())
+            while size > self.max_records and self.queries:
+                query, cached_query = self.queries.popitem(last=False)
+                size -= cached_query.size
+                logger.info("The cached records of the query '%s' are evicted" % query)
+        instrumentation.set_gauge('fogify_metric_cache_records', size)
+
+    def clear(self):
+        with self.lock:
+            self.queries = OrderedDict()
+        instrumentation.set_gauge('fogify_metric_cache_records', 0)
+
+
+def get_metric_cache():
+    """
+    Returns the metric cache of the controller based on its environment variables (METRIC_CACHE_MAX_RECORDS=0 disables
+    the cache)
+    """
+    max_records = os.environ.get('METRIC_CACHE_MAX_RECORDS', '')
+    max_records = int(max_records) if max_records.isnumeric() else 100000
+    return MetricCache(max_records) if max_records > 0 else None
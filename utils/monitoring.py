@@ -1,56 +1,100 @@
 import json
+import math
+import os
+import re
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import reduce
 from os.path import exists
-from time import sleep
+from time import sleep, time
+from typing import TYPE_CHECKING
 
 import dateutil.parser as p
 import docker
 import requests
+from requests.adapters import HTTPAdapter
 
-from agent.models import Status, Metric, db, Record
 from utils.async_task import AsyncTask
-from utils.docker_manager import get_container_ip_property, get_ip_from_network_object, ContainerNetworkNamespace
+from utils.container_registry import ContainerRegistry
+from utils.instrumentation import metrics as instrumentation
 from utils.logging import FogifyLogger
+from utils.statsd import StatsdListener
+from utils.streaming import MetricPublisher
+
+if TYPE_CHECKING:
+    from agent.storage import MetricStorage
 
 logger = FogifyLogger(__name__)
 
+CADVISOR_TIMESTAMP = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|[+-]\d{2}:\d{2})?$')
+CONTAINER_ID = re.compile(r'[0-9a-f]{64}')
 
-class cAdvisorHandler(object):
 
-    def __init__(self, ip, port, project, client=docker.from_env()):
-        self.ip = ip
-        self.port = port
+def parse_timestamp(timestamp: str) -> datetime:
+    """
+    Parses the RFC3339 (nanosecond) timestamps of cAdvisor without passing through the generic dateutil parser
+    :param timestamp: The timestamp string of a cAdvisor's stats object
+    :return: The timezone-aware datetime of the timestamp
+    """
+    match = CADVISOR_TIMESTAMP.match(timestamp)
+    if not match: return p.parse(timestamp)
+    seconds, fraction, zone = match.groups()
+    fraction = (fraction or "")[:6].ljust(6, "0")
+    zone = "+00:00" if zone in (None, "Z") else zone
+    return datetime.fromisoformat(f"{seconds}.{fraction}{zone}")
+
+
+class InstanceSample(object):
+    """ The cumulative counters of the last collected sample of an emulated instance """
+
+    def __init__(self, timestamp: datetime, cpu: float, disk: float, networks: dict, disk_written: float = 0.0):
+        self.timestamp = timestamp
+        self.cpu = cpu
+        self.disk = disk
+        self.networks = networks
+        self.disk_written = disk_written
+
+
+class StatsHandler(ABC):
+    """
+    The base class of the containers' statistics backends. A backend retrieves the last stats of the fogify containers
+    in the form of cAdvisor's stats (see `get_metrics`), so the metrics are computed in the same way for all backends.
+    """
+
+    def __init__(self, project, client=None, container_registry: ContainerRegistry = None):
         self.project = project
-        self.current_instance = None
         self.metrics = []
         self.machine = []
         self.instance_name = None
         self.current_instance = {}
-        self.retrieve_machine_info()
-        self.client = client
-
-    def retrieve_docker_metrics(self):
-        containers = [i for i in self.client.containers.list() if i.name.startswith("fogify_")]
-        res = {}
-        for container in containers:
-            try:
-                stats = self.get_stats_from_cadvisor(container)
-                res.update(stats)
-            except Exception:
-                logger.warning("Monitoring agent did not capture the metrics this time")
-                continue
-
-        self.metrics = res
-
-    def get_stats_from_cadvisor(self, container):
-        stats = requests.get("http://%s:%s/api/v2.0/stats/docker/%s" % (self.ip, self.port, container.id)).json()
-        key = f"/docker/{container.id}"
-        stats[key] = {"stats": stats[key], "aliases": [container.name], "id": container.id,
-            "limits": dict(memory=container.attrs['HostConfig']['Memory'],
-                           cpu=container.attrs['HostConfig']['NanoCpus'])}
-        return stats
-
+        self.previous_samples = {}
+        self.client = client if client else docker.from_env()
+        self.container_registry = container_registry if container_registry else ContainerRegistry(self.client)
+
+    def list_fogify_containers(self):
+        """ Returns the cached metadata of the running fogify containers from the agent's container registry """
+        return self.container_registry.running()
+
+    @abstractmethod
+    def retrieve_docker_metrics(self, containers: list = None):
+        """
+        Retrieves the stats of the fogify containers
+        :param containers: The containers to be sampled (by default, all running fogify containers)
+        """
+        pass
+
+    @abstractmethod
     def retrieve_machine_info(self):
-        self.machine = requests.get("http://%s:%s/api/v1.3/machine" % (self.ip, self.port)).json()
+        """
+        Retrieves the hardware information (e.g., the memory capacity) of the host
+        """
+        pass
+
+    @staticmethod
+    def container_info(container, stats):
+        return {"stats": stats, "aliases": [container.name], "id": container.id, "limits": container.limits}
 
     def set_current_instance_name(self, instance_name: str):
         self.instance_name = instance_name
@@ -73,35 +117,88 @@ class cAdvisorHandler(object):
     def get_last_stats_disk_usage(self):
         return float(self.get_last_stats()['filesystem'][0]['usage'])
 
+    def get_last_stats_disk_written(self):
+        """ The cumulative bytes that the container wrote to the block devices """
+        io_service_bytes = self.get_last_stats().get('diskio', {}).get('io_service_bytes', [])
+        return float(sum(device.get('stats', {}).get('Write', 0) for device in io_service_bytes))
+
     def get_last_stats_timestamp(self):
         return self.get_last_stats()['timestamp']
 
+    def get_last_stats_datetime(self):
+        return parse_timestamp(self.get_last_stats_timestamp())
+
     def get_last_stats_memory_usage(self):
         return float(self.get_last_stats()['memory']['usage'])
 
     def get_last_stats_memory_util(self):
         return 100 * self.get_last_stats_memory_usage() / self.get_mem_quota()
 
-    def get_last_saved_record(self, instance_name):
-        return Record.query.filter_by(instance_name=instance_name).order_by(Record.count.desc()).limit(1).first()
+    def get_previous_sample(self) -> InstanceSample:
+        return self.previous_samples.get(self.instance_name)
+
+    def save_current_sample(self):
+        """ Keeps the counters of the current instance's sample in order to compute the rates of the next one """
+        networks = {i['name']: (float(i['rx_bytes']), float(i['tx_bytes'])) for i in
+                    self.get_last_stats().get('network', {}).get('interfaces', [])}
+        self.previous_samples[self.instance_name] = InstanceSample(self.get_last_stats_datetime(),
+                                                                   self.get_last_stats_cpu_usage(),
+                                                                   self.get_last_stats_disk_usage(), networks,
+                                                                   self.get_last_stats_disk_written())
+
+    def remove_previous_samples(self, instance_names_to_keep):
+        """ Removes the samples of the instances that are not monitored anymore """
+        for instance_name in set(self.previous_samples) - set(instance_names_to_keep):
+            del self.previous_samples[instance_name]
 
     def get_last_stats_cpu_util(self):
-        record = self.get_last_saved_record(self.instance_name)
+        previous_sample = self.get_previous_sample()
+        cpu_usage = self.get_last_stats_cpu_usage()
 
-        if not record: return 0
-        last_cpu_record = record.get_metric_by_name("cpu")
+        # there is no previous sample or the container is restarted and its cpu counter is reset
+        if not previous_sample or cpu_usage < previous_sample.cpu: return 0
 
-        timedif = abs(self.millis_interval(p.parse(self.get_last_stats_timestamp()).replace(tzinfo=None),
-                                           record.timestamp.replace(tzinfo=None)))
+        timedif = abs(self.millis_interval(self.get_last_stats_datetime().replace(tzinfo=None),
+                                           previous_sample.timestamp.replace(tzinfo=None)))
         if timedif == 0: timedif = 1
 
-        rate = (float(self.get_last_stats_cpu_usage()) - float(last_cpu_record.value)) / timedif
+        rate = (cpu_usage - previous_sample.cpu) / timedif
         val = self.get_cpu_quota()
         cpu_util_val = 0
         if val:
             cpu_util_val = 100000 * float(rate / val)
         return cpu_util_val
 
+    def get_counter_rate(self, current: float, previous: float):
+        """
+        Computes the per second rate of a cumulative counter since the previous sample of the current instance. If
+        the counter is reset (e.g. the container is restarted), the increase is the current value of the counter.
+        :return: The rate or None if there is no previous sample
+        """
+        previous_sample = self.get_previous_sample()
+        if not previous_sample or previous is None: return None
+        seconds = (self.get_last_stats_datetime() - previous_sample.timestamp).total_seconds()
+        if seconds <= 0: return None
+        increase = current - previous if current >= previous else current
+        return increase / seconds
+
+    def get_last_stats_disk_write_rate(self):
+        previous_sample = self.get_previous_sample()
+        return self.get_counter_rate(self.get_last_stats_disk_written(),
+                                     previous_sample.disk_written if previous_sample else None)
+
+    def get_last_stats_network_rates(self, interface: dict):
+        """
+        The received and transmitted bytes per second of an interface
+        :param interface: The stats of the interface, i.e., {"name": ..., "rx_bytes": ..., "tx_bytes": ...}
+        :return: A tuple of (rx rate, tx rate) or (None, None) if the interface has no previous sample
+        """
+        previous_sample = self.get_previous_sample()
+        previous = previous_sample.networks.get(interface['name']) if previous_sample else None
+        if previous is None: return None, None
+        return (self.get_counter_rate(float(interface['rx_bytes']), previous[0]),
+                self.get_counter_rate(float(interface['tx_bytes']), previous[1]))
+
     def get_last_stats_networks(self):
         return self.get_last_stats()['network']['interfaces']
 
@@ -153,85 +250,453 @@ class cAdvisorHandler(object):
         return self.metrics
 
 
-class MetricCollector(object):
+class cAdvisorHandler(StatsHandler):
+    """
+    Retrieves the containers' statistics from cAdvisor. The statistics can be collected with one recursive request
+    for all docker containers (bulk), with pooled concurrent requests per container (concurrent) or with
+    one request per container at a time (serial).
+    """
 
-    def get_custom_metrics(self, instance, connector):
-        path = connector.get_host_data_path(instance['id'])
-        metrics = {}
+    BULK = "bulk"
+    CONCURRENT = "concurrent"
+    SERIAL = "serial"
 
-        if not (path and exists(path + "/fogify/metrics")): return []
+    def __init__(self, ip, port, project, client=docker.from_env(), collection_mode: str = None,
+                 pool_size: int = None, container_registry: ContainerRegistry = None):
+        StatsHandler.__init__(self, project, client, container_registry)
+        self.ip = ip
+        self.port = port
+        self.collection_mode = collection_mode if collection_mode else self.BULK
+        pool_size = pool_size if pool_size else 8
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.executor = ThreadPoolExecutor(max_workers=pool_size) if self.collection_mode == self.CONCURRENT else None
+        self.retrieve_machine_info()
 
-        with open(path + "/fogify/metrics") as json_file:
-            data = json.load(json_file)
-            for i in data:
-                if str(data[i]).isnumeric(): metrics[i] = float(data[i])
+    def retrieve_docker_metrics(self, containers: list = None):
+        """
+        Retrieves the stats of the fogify containers
+        :param containers: The containers to be sampled (by default, all running fogify containers)
+        """
+        containers = self.list_fogify_containers() if containers is None else containers
+        if self.collection_mode == self.BULK:
+            self.metrics = self.get_bulk_stats_from_cadvisor(containers)
+            return
+        if self.executor:
+            responses = self.executor.map(self.get_stats_from_cadvisor_safely, containers)
+        else:
+            responses = map(self.get_stats_from_cadvisor_safely, containers)
+        res = {}
+        for stats in responses:
+            res.update(stats)
+        self.metrics = res
+
+    def get_stats_from_cadvisor_safely(self, container):
+        try:
+            return self.get_stats_from_cadvisor(container)
+        except Exception:
+            logger.warning("Monitoring agent did not capture the metrics this time")
+            return {}
 
-        return [Metric(metric_name=metric, value=metrics[metric]) for metric in metrics]
+    def get_stats_from_cadvisor(self, container):
+        stats = self.session.get(
+            "http://%s:%s/api/v2.0/stats/docker/%s?count=1" % (self.ip, self.port, container.id)).json()
+        key = f"/docker/{container.id}"
+        stats[key] = self.container_info(container, stats[key])
+        return stats
 
-    def get_cache_ip(self, container_name, network_name):
-        search = "%{}%".format(container_name + "|" + network_name + "|")
-        conf = Status.query.filter(Status.name.like(search)).first()
-        if conf is not None: return conf.value
+    def get_bulk_stats_from_cadvisor(self, containers):
+        """
+        Retrieves the last stats of all docker containers with a single recursive request
+        :param containers: The fogify containers of the host
+        :return: The stats of the containers in the same form as the per-container requests
+        """
+        try:
+            stats = self.session.get("http://%s:%s/api/v2.0/stats/?type=docker&recursive=true&count=1" % (
+                self.ip, self.port)).json()
+        except Exception:
+            logger.warning("Monitoring agent did not capture the metrics this time", exc_info=True)
+            return {}
+        containers = {container.id: container for container in containers}
+        res = {}
+        for key, container_stats in stats.items():
+            container_id = CONTAINER_ID.search(key)
+            if not container_id or container_id.group(0) not in containers: continue
+            res[key] = self.container_info(containers[container_id.group(0)], container_stats)
+        return res
+
+    def retrieve_machine_info(self):
+        self.machine = self.session.get("http://%s:%s/api/v1.3/machine" % (self.ip, self.port)).json()
+
+
+class CgroupHandler(StatsHandler):
+    """
+    Reads the containers' statistics directly from the cgroup (v1 or v2) files and the procfs of the host, without
+    cAdvisor. The cgroup of a container is resolved from /proc/<pid>/cgroup and its files are read at every tick, i.e.,
+    the cpu usage (cpu.stat or cpuacct.usage), the memory usage (memory.current or memory.usage_in_bytes), the written
+    bytes (io.stat or blkio.throttle.io_service_bytes) and the network counters (/proc/<pid>/net/dev). Note that the
+    disk_bytes metric of this backend is the number of the written bytes instead of the size of the container's layer.
+    """
+
+    V1_CONTROLLERS = {'cpu': ('cpuacct', 'cpu,cpuacct'), 'memory': ('memory',), 'io': ('blkio',)}
+
+    def __init__(self, project, client=None, container_registry: ContainerRegistry = None,
+                 proc_path=os.environ.get('NAMESPACE_PATH') or '/proc/',
+                 cgroup_path=os.environ.get('CGROUP_PATH') or '/sys/fs/cgroup'):
+        StatsHandler.__init__(self, project, client, container_registry)
+        self.proc_path = proc_path
+        self.cgroup_path = cgroup_path
+        self.cgroups = {}  # container id -> (pid, {controller: cgroup directory})
+        self.retrieve_machine_info()
+
+    def retrieve_machine_info(self):
+        self.machine = {'memory_capacity': 0}
+        try:
+            with open(os.path.join(self.proc_path, 'meminfo')) as meminfo:
+                for line in meminfo:
+                    if line.startswith('MemTotal:'):
+                        self.machine['memory_capacity'] = int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            logger.warning("The host's memory capacity is not available", exc_info=True)
+
+    def retrieve_docker_metrics(self, containers: list = None):
+        containers = self.list_fogify_containers() if containers is None else containers
+        res = {}
+        for container in containers:
+            try:
+                res[container.id] = self.container_info(container, [self.get_stats(container)])
+            except Exception:
+                logger.warning("Monitoring agent did not capture the metrics of %s this time" % container.name)
+                self.cgroups.pop(container.id, None)
+        self.metrics = res
+        for container_id in set(self.cgroups) - {container.id for container in containers}:
+            del self.cgroups[container_id]
+
+    def get_stats(self, container) -> dict:
+        """ Returns the last stats of a container in the form of a cAdvisor's stats object """
+        directories = self.get_cgroup_directories(container)
+        written_bytes = self.read_written_bytes(directories['io'])
+        return {"timestamp": datetime.now(timezone.utc),
+                "cpu": {"usage": {"total": self.read_cpu_usage(directories['cpu'])}},
+                "memory": {"usage": self.read_memory_usage(directories['memory'])},
+                "filesystem": [{"usage": written_bytes}],
+                "diskio": {"io_service_bytes": [{"stats": {"Write": written_bytes}}]},
+                "network": {"interfaces": self.read_network_interfaces(container.pid)}}
+
+    def get_last_stats_datetime(self):
+        return self.get_last_stats()['timestamp']
+
+    def get_cgroup_directories(self, container) -> dict:
+        cached = self.cgroups.get(container.id)
+        if cached and cached[0] == container.pid: return cached[1]
+        with open(os.path.join(self.proc_path, str(container.pid), 'cgroup')) as cgroup_file:
+            lines = [line.strip().split(':', 2) for line in cgroup_file if line.strip()]
+        directories, unified_path = {}, None
+        for hierarchy, controllers, path in lines:
+            if hierarchy == '0' and controllers == '':  # cgroup v2 (unified hierarchy)
+                unified_path = path
+                continue
+            for controller, names in self.V1_CONTROLLERS.items():
+                if set(controllers.split(',')) & set(names):
+                    directories[controller] = self.__existing_directory(path, container.id,
+                                                                        [controllers] + list(names))
+        # hybrid hosts list the (controller-less) unified hierarchy along with the v1 controllers
+        if unified_path is not None and (not directories or self.is_unified()):
+            directory = self.__existing_directory(unified_path, container.id, [''])
+            directories = {controller: directory for controller in self.V1_CONTROLLERS}
+        if set(directories) != set(self.V1_CONTROLLERS):
+            raise FileNotFoundError("The cgroups of the container %s are not found" % container.id)
+        self.cgroups[container.id] = (container.pid, directories)
+        return directories
+
+    def is_unified(self) -> bool:
+        """ Whether the host mounts only the cgroup v2 (unified) hierarchy """
+        return exists(os.path.join(self.cgroup_path, 'cgroup.controllers'))
+
+    def __existing_directory(self, path: str, container_id: str, hierarchies: list):
+        """
+        Returns the first existing cgroup directory of a container. The containers with a private cgroup namespace
+        report their cgroup as "/", so the default cgroup paths of docker are also checked.
+        """
+        paths = [path.strip('/')] if path.strip('/') else []
+        paths += ['system.slice/docker-%s.scope' % container_id, 'docker/%s' % container_id]
+        for hierarchy in hierarchies:
+            for path in paths:
+                directory = os.path.join(self.cgroup_path, hierarchy, path)
+                if os.path.isdir(directory): return directory
+        raise FileNotFoundError("The cgroup of the container %s is not found" % container_id)
+
+    @staticmethod
+    def read_cpu_usage(directory: str) -> float:
+        """ The cumulative cpu time in nanoseconds """
+        v1_file = os.path.join(directory, 'cpuacct.usage')
+        if exists(v1_file):
+            with open(v1_file) as usage:
+                return float(usage.read())
+        with open(os.path.join(directory, 'cpu.stat')) as stat:
+            for line in stat:
+                key, value = line.split()
+                if key == 'usage_usec': return float(value) * 1000
+        return 0.0
+
+    @staticmethod
+    def read_memory_usage(directory: str) -> float:
+        for name in ('memory.current', 'memory.usage_in_bytes'):
+            path = os.path.join(directory, name)
+            if exists(path):
+                with open(path) as usage:
+                    return float(usage.read())
+        return 0.0
 
     @staticmethod
-    def clean_cache_ip():
-        Status.query.filter(Status.name.like("%monitoring_network_cache:%")).delete(synchronize_session='fetch')
-        db.session.commit()
+    def read_written_bytes(directory: str) -> float:
+        """ The cumulative bytes that the container wrote to the block devices """
+        total = 0.0
+        v2_file = os.path.join(directory, 'io.stat')
+        if exists(v2_file):
+            with open(v2_file) as stat:
+                for line in stat:
+                    for field in line.split()[1:]:
+                        key, _, value = field.partition('=')
+                        if key == 'wbytes': total += float(value)
+            return total
+        v1_file = os.path.join(directory, 'blkio.throttle.io_service_bytes')
+        if exists(v1_file):
+            with open(v1_file) as stat:
+                for line in stat:
+                    fields = line.split()
+                    if len(fields) == 3 and fields[1] == 'Write': total += float(fields[2])
+        return total
+
+    def read_network_interfaces(self, pid) -> list:
+        """ The counters of the container's interfaces in the form of cAdvisor's network interfaces """
+        interfaces = []
+        with open(os.path.join(self.proc_path, str(pid), 'net', 'dev')) as dev:
+            for line in list(dev)[2:]:
+                name, _, counters = line.partition(':')
+                name, counters = name.strip(), counters.split()
+                if name == 'lo' or len(counters) < 9: continue
+                interfaces.append({"name": name, "rx_bytes": int(counters[0]), "tx_bytes": int(counters[8])})
+        return interfaces
+
+
+def get_stats_handler(agent_ip: str, container_registry: ContainerRegistry = None) -> StatsHandler:
+    """
+    Returns the statistics backend of the agent based on its environment variables (MONITORING_BACKEND as cadvisor or
+    cgroup, and MONITORING_COLLECTION_MODE and MONITORING_POOL_SIZE for cadvisor)
+    """
+    backend = (os.environ.get('MONITORING_BACKEND') or 'cadvisor').lower()
+    if backend == 'cgroup':
+        return CgroupHandler('fogify', container_registry=container_registry)
+    collection_mode = os.environ.get('MONITORING_COLLECTION_MODE', '').lower()
+    pool_size = os.environ.get('MONITORING_POOL_SIZE', '')
+    return cAdvisorHandler(agent_ip, '9090', 'fogify', collection_mode=collection_mode or None,
+                           pool_size=int(pool_size) if pool_size.isnumeric() and int(pool_size) > 0 else None,
+                           container_registry=container_registry)
+
+
+class MonitoringSchedule(object):
+    """
+    A hashed timer wheel of the monitored instances. Every instance has the sampling rule of its service (see the
+    monitoring section of the Fogify model) and, at every tick of the wheel, only the instances that are due are
+    sampled. The tick is the greatest common divisor of the rules' intervals. The adaptive rules double the interval
+    of an instance (up to its max_interval) while its values are stable and reset it when they change.
+    """
+
+    WHEEL_SIZE = 64
+    ADAPTIVE_METRICS = ['cpu_util', 'memory_util']
+
+    def __init__(self, interval: int = 5):
+        self.default = {'interval': interval, 'adaptive': False, 'max_interval': interval * 6, 'threshold': 0.1,
+                        'metrics': self.ADAPTIVE_METRICS}
+        self.lock = threading.Lock()
+        self.set_rules({})
+
+    def set_rules(self, rules: dict):
+        """
+        Replaces the sampling rules and restarts the wheel, i.e., all instances are sampled at the next tick
+        :param rules: {"default": <rule>, "services": {<service>: <rule>}}
+        """
+        with self.lock:
+            self.default_rule = dict(self.default, **rules.get('default', {}))
+            self.rules = {service: dict(self.default_rule, **rule) for service, rule in
+                          rules.get('services', {}).items()}
+            for rule in [self.default_rule] + list(self.rules.values()):
+                rule['max_interval'] = max(rule['max_interval'], rule['interval'])
+            intervals = [self.default_rule['interval']]
+            for rule in self.rules.values():
+                intervals.append(rule['interval'])
+                if rule['adaptive']: intervals.append(rule['max_interval'])
+            self.tick = reduce(math.gcd, intervals)
+            self.slots = [{} for _ in range(self.WHEEL_SIZE)]  # slot -> {instance: remaining rounds}
+            self.position = 0
+            self.instances = {}  # instance -> {"rule": ..., "interval": ..., "slot": ..., "values": ...}
+
+    def rule_of(self, service: str) -> dict:
+        return self.rules.get(service, self.default_rule)
+
+    def due(self, services: dict) -> list:
+        """
+        Advances the wheel by one tick
+        :param services: The running instances and their services ({<instance name>: <service>})
+        :return: The names of the instances that should be sampled at this tick (the new instances are always due)
+        """
+        with self.lock:
+            for instance_name in [i for i in self.instances if i not in services]:
+                self.__unschedule(instance_name)
+            slot = self.slots[self.position]
+            res = [instance_name for instance_name, rounds in slot.items() if rounds == 0]
+            self.slots[self.position] = {instance_name: rounds - 1 for instance_name, rounds in slot.items() if
+                                         rounds > 0}
+            for instance_name, service in services.items():
+                if instance_name in self.instances: continue
+                rule = self.rule_of(service)
+                self.instances[instance_name] = {'rule': rule, 'interval': rule['interval'], 'values': {}}
+                res.append(instance_name)
+            for instance_name in res:
+                self.__schedule(instance_name)
+            self.position = (self.position + 1) % self.WHEEL_SIZE
+            return res
+
+    def update(self, instance_name: str, metrics: dict):
+        """ Adapts the interval of an instance that was sampled at the last tick based on its new values """
+        with self.lock:
+            instance = self.instances.get(instance_name)
+            if not instance or not instance['rule']['adaptive']: return
+            rule, previous = instance['rule'], instance['values']
+            values = {metric: metrics[metric] for metric in rule['metrics'] if metric in metrics}
+            stable = bool(previous) and all(
+                metric in previous and
+                abs(value - previous[metric]) <= rule['threshold'] * max(abs(previous[metric]), 1)
+                for metric, value in values.items())
+            instance['values'] = values
+            interval = min(instance['interval'] * 2, rule['max_interval']) if stable else rule['interval']
+            if interval == instance['interval']: return
+            instance['interval'] = interval
+            self.__unschedule(instance_name, forget=False)
+            self.__schedule(instance_name, (self.position - 1) % self.WHEEL_SIZE)
+
+    def __schedule(self, instance_name: str, position: int = None):
+        ticks = max(self.instances[instance_name]['interval'] // self.tick, 1)
+        slot = ((self.position if position is None else position) + ticks) % self.WHEEL_SIZE
+        self.slots[slot][instance_name] = (ticks - 1) // self.WHEEL_SIZE
+        self.instances[instance_name]['slot'] = slot
+
+    def __unschedule(self, instance_name: str, forget: bool = True):
+        instance = self.instances[instance_name]
+        self.slots[instance['slot']].pop(instance_name, None)
+        if forget: del self.instances[instance_name]
+
 
-    def set_cache_ip(self, ip, container_name, network_name):
-        Status.update_config(ip, "monitoring_network_cache:" + container_name + "|" + network_name + "|")
+class MetricCollector(object):
+
+    RULES_FILE = "monitoring.json"
+
+    def __init__(self, container_registry: ContainerRegistry = None, storage: 'MetricStorage' = None,
+                 statsd_listener: StatsdListener = None, publisher: MetricPublisher = None):
+        self.container_registry = container_registry if container_registry else ContainerRegistry()
+        if storage is None:
+            # the storage (and the agent's models) is imported when the collector is created, after the agent's database
+            from agent.storage import DatabaseMetricStorage
+            storage = DatabaseMetricStorage()
+        self.storage = storage
+        self.statsd_listener = statsd_listener
+        self.publisher = publisher
+        self.schedule = MonitoringSchedule()
+        self.rules = {}
+        self.latest_samples = {}  # instance name -> (service, timestamp, metrics) of the last sample
+
+    def get_custom_metrics(self, instance):
+        path = self.container_registry.get(instance['id']).merged_dir
+        metrics = {}
 
-    def get_ip(self, container, cadv_net):
-        old_ip = self.get_cache_ip(container.name, cadv_net["name"])
-        if old_ip: return old_ip
-        with ContainerNetworkNamespace(container.id):
-            eth_ip = get_container_ip_property(cadv_net["name"])
+        if not (path and exists(path + "/fogify/metrics")): return {}
 
-        if not eth_ip: return
+        with open(path + "/fogify/metrics") as json_file:
+            data = json.load(json_file)
+            for i in data:
+                try:
+                    metrics[i] = float(data[i])
+                except (TypeError, ValueError):
+                    continue
 
-        ip = eth_ip[eth_ip.find("inet ") + len("inet "):eth_ip.rfind("/")]
-        self.set_cache_ip(ip, container.name, cadv_net["name"])
-        return ip
+        return metrics
 
     def get_default_metrics(self, cAdvisor_handler):
-        cpu_util = Metric(metric_name="cpu_util", value=cAdvisor_handler.get_last_stats_cpu_util())
-        cpu = Metric(metric_name="cpu", value=cAdvisor_handler.get_last_stats_cpu_usage())
-        memory = Metric(metric_name="memory", value=cAdvisor_handler.get_last_stats_memory_usage())
-        memory_util = Metric(metric_name="memory_util", value=cAdvisor_handler.get_last_stats_memory_util())
-        disk = Metric(metric_name="disk_bytes", value=cAdvisor_handler.get_last_stats_disk_usage())
-        return [cpu_util, cpu, memory, memory_util, disk]
-
-    def get_network_metrics(self, cAdvisor_handler: cAdvisorHandler):
-        current_container = docker.from_env().containers.get(cAdvisor_handler.current_instance["id"])
-        nets = self.get_ips_to_networks_dict(current_container)
-        res = []
+        res = {"cpu_util": cAdvisor_handler.get_last_stats_cpu_util(),
+               "cpu": cAdvisor_handler.get_last_stats_cpu_usage(),
+               "memory": cAdvisor_handler.get_last_stats_memory_usage(),
+               "memory_util": cAdvisor_handler.get_last_stats_memory_util(),
+               "disk_bytes": cAdvisor_handler.get_last_stats_disk_usage()}
+        disk_write_rate = cAdvisor_handler.get_last_stats_disk_write_rate()
+        if disk_write_rate is not None: res["disk_write_rate"] = disk_write_rate
+        return res
+
+    def get_network_metrics(self, cAdvisor_handler: StatsHandler):
+        current_container = self.container_registry.get(cAdvisor_handler.current_instance["id"])
+        nets = current_container.ips_to_networks
+        res = {}
         for cadv_net in cAdvisor_handler.get_last_stats_networks():
-            ip = self.get_ip(current_container, cadv_net)
+            ip = current_container.get_interface_ip(cadv_net["name"])
             if not (ip in nets and nets[ip] != 'ingress'): continue
-            res.append(Metric(metric_name="network_rx_" + nets[ip], value=int(cadv_net['rx_bytes'])))
-            res.append(Metric(metric_name="network_tx_" + nets[ip], value=int(cadv_net['tx_bytes'])))
+            res["network_rx_" + nets[ip]] = int(cadv_net['rx_bytes'])
+            res["network_tx_" + nets[ip]] = int(cadv_net['tx_bytes'])
+            rx_rate, tx_rate = cAdvisor_handler.get_last_stats_network_rates(cadv_net)
+            if rx_rate is not None: res["network_rx_rate_" + nets[ip]] = rx_rate
+            if tx_rate is not None: res["network_tx_rate_" + nets[ip]] = tx_rate
         return res
 
-    def get_ips_to_networks_dict(self, container):
-        nets = {}
-        for network in container.attrs["NetworkSettings"]["Networks"]:
-            ip = get_ip_from_network_object(container.attrs["NetworkSettings"]["Networks"][network])
-            nets[ip] = network
-        return nets
+    def set_rules(self, rules: dict, path: str = None):
+        """
+        Replaces the sampling rules of the monitoring schedule
+        :param rules: {"default": <rule>, "services": {<service>: <rule>}}
+        :param path: If it is set, the rules are saved in this directory (next to the network rules), thus they are
+        restored when the agent restarts
+        """
+        self.rules = rules
+        self.schedule.set_rules(rules)
+        if path is None: return
+        if not os.path.exists(path): os.mkdir(path)
+        with open(os.path.join(path, self.RULES_FILE), 'w') as f:
+            json.dump(rules, f)
+
+    def load_rules(self, path: str):
+        """ Restores the sampling rules that are saved in a directory (see set_rules) """
+        file_name = os.path.join(path, self.RULES_FILE)
+        if not exists(file_name): return
+        try:
+            with open(file_name) as f:
+                self.set_rules(json.load(f))
+            logger.info("The monitoring rules are restored")
+        except (OSError, ValueError):
+            logger.warning("The monitoring rules are not restored.", exc_info=True)
 
     def start_monitoring(self, agent_ip, connector, interval):
         self.shoud_run = True
         logger.info("Monitoring Agent Instantiation")
-        cAdvisor_handler = cAdvisorHandler(agent_ip, '9090', 'fogify')
+        cAdvisor_handler = get_stats_handler(agent_ip, self.container_registry)
+        if interval != self.schedule.default['interval']:
+            self.schedule = MonitoringSchedule(interval)
+            self.schedule.set_rules(self.rules)
+        self.load_rules(connector.path)
+        next_tick = time()
         while (self.shoud_run):
-            count = Status.query.filter_by(name="counter").first()
-            count = 0 if count is None else int(count.value)
-            count += 1
-            cAdvisor_handler.retrieve_docker_metrics()
-            metrics = cAdvisor_handler.get_metrics()
-            self.store_metrics(cAdvisor_handler, connector, count, metrics)
-            Status.update_config(str(count))
-            sleep(interval)
+            started = time()
+            instrumentation.set_gauge('fogify_monitoring_tick_delay_seconds', max(started - next_tick, 0))
+            next_tick = started + self.schedule.tick
+            containers = {connector.instance_name(container.name): container for container in
+                          cAdvisor_handler.list_fogify_containers()}
+            due = self.schedule.due({instance_name: connector.get_service_from_name(instance_name)
+                                     for instance_name in containers})
+            instrumentation.set_gauge('fogify_monitoring_sampled_instances', len(due))
+            if due:
+                count = self.storage.get_counter() + 1
+                with instrumentation.timer('fogify_monitoring_stage_duration_seconds', stage='fetch'):
+                    cAdvisor_handler.retrieve_docker_metrics([containers[instance_name] for instance_name in due])
+                metrics = cAdvisor_handler.get_metrics()
+                self.store_metrics(cAdvisor_handler, connector, count, metrics, list(containers))
+            sleep(max(self.schedule.tick - (time() - started), 0))
 
     def start_monitoring_thread(self, agent_ip, connector, interval):
         self.running_thread = AsyncTask(self, 'start_monitoring', [agent_ip, connector, interval])
@@ -242,28 +707,59 @@ class MetricCollector(object):
             self.shoud_run = False
             self.running_thread.stop()
 
-    def store_metrics(self, cAdvisor_handler, connector, count, metrics):
+    def store_metrics(self, cAdvisor_handler, connector, count, metrics, running_instances: list = None):
+        """
+        Computes the metrics of the sampled instances of a monitoring tick and persists them,
+        along with the tick's counter, in a single transaction
+        :param running_instances: The names of all running instances (by default, the sampled ones), whose state is kept
+        """
+        with instrumentation.timer('fogify_monitoring_stage_duration_seconds', stage='compute'):
+            instance_names, samples = self.compute_samples(cAdvisor_handler, connector, count, metrics)
+        running_instances = instance_names if running_instances is None else running_instances
+        self.update_latest_samples(connector, samples, running_instances)
+        cAdvisor_handler.remove_previous_samples(running_instances)
+        if self.statsd_listener: self.statsd_listener.remove(running_instances)
+        with instrumentation.timer('fogify_monitoring_stage_duration_seconds', stage='store'):
+            self.storage.store(samples, count)
+        if self.publisher: self.publisher.publish(count, samples)
+
+    def update_latest_samples(self, connector, samples: list, running_instances: list):
+        """ Keeps the last sample of every running instance (e.g. for the Prometheus exposition of the agent) """
+        running_instances = set(running_instances)
+        latest_samples = {instance_name: sample for instance_name, sample in self.latest_samples.items()
+                          if instance_name in running_instances}
+        for instance_name, _, timestamp, metrics in samples:
+            latest_samples[instance_name] = (connector.get_service_from_name(instance_name), timestamp, metrics)
+        self.latest_samples = latest_samples
+
+    def compute_samples(self, cAdvisor_handler, connector, count, metrics):
+        """
+        Computes the metrics of the sampled instances
+        :return: The names of the sampled instances and their samples
+        """
+        instances = {}
         for i in metrics:
+            cAdvisor_handler.set_current_instance(metrics[i])
+            alias = cAdvisor_handler.return_project_alias()
+            if alias: instances[connector.instance_name(alias)] = metrics[i]
+        samples = []
+        pushed_metrics = self.statsd_listener.flush(list(instances)) if self.statsd_listener else {}
+        for instance_name, current_instance in instances.items():
             try:
-                current_instance = metrics[i]
-                cAdvisor_handler.set_current_instance(metrics[i])
-                alias = cAdvisor_handler.return_project_alias()
-                if not alias: continue
-
-                instance_name = connector.instance_name(alias)
-
+                cAdvisor_handler.set_current_instance(current_instance)
                 cAdvisor_handler.set_current_instance_name(instance_name)
 
-                r = Record(timestamp=p.parse(cAdvisor_handler.get_last_stats_timestamp()), count=count,
-                           instance_name=instance_name)
-
-                r.metrics.extend(self.get_default_metrics(cAdvisor_handler))
-                r.metrics.extend(self.get_network_metrics(cAdvisor_handler))
-                r.metrics.extend(self.get_custom_metrics(current_instance, connector))
+                instance_metrics = self.get_default_metrics(cAdvisor_handler)
+                instance_metrics.update(self.get_network_metrics(cAdvisor_handler))
+                instance_metrics.update(self.get_custom_metrics(current_instance))
+                instance_metrics.update(pushed_metrics.get(instance_name, {}))
+                cAdvisor_handler.save_current_sample()
+                self.schedule.update(instance_name, instance_metrics)
 
-                db.session.merge(r)
-                db.session.commit()
+                samples.append((instance_name, count, cAdvisor_handler.get_last_stats_datetime(), instance_metrics))
             except Exception:
                 logger.warning("An error occurred in monitoring agent. The metrics will not be stored at this time.",
                               exc_info=True)
+                instrumentation.increment('fogify_monitoring_errors_total')
                 continue
+        return list(instances), samples
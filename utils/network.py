@@ -2,6 +2,7 @@ import copy
 import json
 import os
 import subprocess
+import threading
 import time
 
 import docker
@@ -11,8 +12,10 @@ from iptc import IPTCError
 
 from connectors import BasicConnector
 from utils import Cache
+from utils.container_registry import ContainerRegistry, is_fogify_event
 from utils.docker_manager import ContainerNetworkNamespace, \
     get_ip_from_network_object, get_container_ip_property
+from utils.instrumentation import metrics as instrumentation
 from utils.inter_communication import Communicator
 from utils.logging import FogifyLogger
 from utils.sniffer import SnifferHandler
@@ -33,9 +36,11 @@ class NetworkController:
     """
     __cached_rules = None
 
-    def __init__(self, connector: BasicConnector, sniffer: SnifferHandler = SnifferHandler()):
+    def __init__(self, connector: BasicConnector, sniffer: SnifferHandler = SnifferHandler(),
+                 container_registry: ContainerRegistry = None):
         self.connector = connector
         self.sniffer = sniffer
+        self.container_registry = container_registry
 
     def save_network_rules(self, data):
         """
@@ -63,24 +68,30 @@ class NetworkController:
             self.communicate_with_controller(network_rules)
 
     def execute_network_commands(self, service_name: str, container_id: str, network_rules: dict):
-        with ContainerNetworkNamespace(container_id):
+        instrumentation.increment('fogify_qos_applications_total', service=service_name)
+        pid = self.container_registry.pid_of(container_id) if self.container_registry else None
+        with ContainerNetworkNamespace(container_id, pid):
             for network, rules in network_rules.items():
-                eth, ifb = NetworkController.get_adapters(container_id, network)  # TODO FIX PERFORMANCE
+                with instrumentation.timer('fogify_qos_stage_duration_seconds', stage='adapters'):
+                    eth, ifb = NetworkController.get_adapters(container_id, network)  # TODO FIX PERFORMANCE
                 # apply general network QoS
                 downlink_rules, uplink_rules = rules['downlink'].replace("  ", " "), rules['uplink'].replace("  ", " ")
-                NetworkController.apply_general_network_rules(eth, ifb, uplink_rules, downlink_rules)
+                with instrumentation.timer('fogify_qos_stage_duration_seconds', stage='general_rules'):
+                    NetworkController.apply_general_network_rules(eth, ifb, uplink_rules, downlink_rules)
                 # apply link QoS between the containers
-                ips_to_rules = self.ips_to_link_rules(service_name, network, rules)  # TODO FIX PERFORMANCE
+                with instrumentation.timer('fogify_qos_stage_duration_seconds', stage='link_commands'):
+                    ips_to_rules = self.ips_to_link_rules(service_name, network, rules)  # TODO FIX PERFORMANCE
 
-                commands = self.get_link_commands(eth, 'ifb' + ifb, ips_to_rules)
+                    commands = self.get_link_commands(eth, 'ifb' + ifb, ips_to_rules)
 
-                subprocess.Popen(SH, stdin=subprocess.PIPE).communicate(commands.encode())
+                    subprocess.Popen(SH, stdin=subprocess.PIPE).communicate(commands.encode())
                 is_packet_monitoring_enabled = str(rules.get('packet_level_monitoring', 'false')).lower() == 'true'
 
-                self.apply_firewall_rules(eth, network, rules.get('firewall_rules'))
+                with instrumentation.timer('fogify_qos_stage_duration_seconds', stage='firewall'):
+                    self.apply_firewall_rules(eth, network, rules.get('firewall_rules'))
 
                 if is_packet_monitoring_enabled:
-                    self.sniffer.start_thread_for_sniffing(container_id, service_name, eth, network)
+                    self.sniffer.start_thread_for_sniffing(container_id, service_name, eth, network, pid)
 
     def apply_firewall_rules(self, interface, network, rules=[]):
         try:
@@ -250,28 +261,41 @@ class NetworkController:
 
     def listen(self):
         """
-        The long-running method for observing the events of docker socket
-        and applying both network QoS and sniffer on new created containers.
+        Observes the events of docker socket and applies both network QoS and sniffer on new created containers.
+        If the agent has a container registry, the controller listens its events instead of the docker socket.
         :return: None
         """
-        connector = self.connector
-
         self.sniffer.start_thread_for_sniffing_storage()
 
+        if self.container_registry:
+            self.container_registry.add_listener(self.handle_event)
+            logger.info("Network Controller listens the events of the container registry.")
+            return
+
         client = docker.from_env()
         logger.info("Network Controller listens docker socket.")
         for event in client.events(decode=True):
             try:
-                if not self.check_starting_condition(event):
-                    continue
-                info = connector.event_attr_to_information(event)
-                network_rules = self.read_network_rules
-                self.apply_network_qos_for_event(info, network_rules)
-
+                self.handle_event(event)
             except Exception:
                 logger.error("An error occurred in container listener.", exc_info=True)
                 continue
 
+    def handle_event(self, event):
+        """
+        Applies the network QoS (in a separate thread) if the event is a starting container event. With a container
+        registry, the container's information is taken from the registry instead of inspecting the container again.
+        """
+        if not self.check_starting_condition(event): return
+        if self.container_registry:
+            if not is_fogify_event(event): return
+            container = self.container_registry.get(event['id'])
+            if container is None: return
+            info = dict(service_name=container.service, container_id=container.id, container_name=container.name)
+        else:
+            info = self.connector.event_attr_to_information(event)
+        threading.Thread(target=self.apply_network_qos_for_event, args=(info, self.read_network_rules)).start()
+
     def apply_network_qos_for_event(self, info, network_rules, inform_controller=True):
         if info['service_name'] and info['container_id'] and info['container_name']:
             self.start_thread_for_qos(**info, network_rules=network_rules, inform_controller=inform_controller)
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+
+from utils.logging import FogifyLogger
+
+logger = FogifyLogger(__name__)
+
+
+class PlacementIndex(object):
+    """
+    The controller's index of the nodes that host each service and instance, built from the connector's
+    `get_all_instances`. The queries that are filtered by a service are sent only to the agents of these nodes. The
+    index is invalidated when the topology is deployed or scaled, and it is rebuilt at most every `ttl` seconds in
+    order to follow the replicas that the orchestrator moves to other nodes. A rebuild keeps the nodes that hosted a
+    service before, since their agents still store the history of its instances, and the index is reset only when the
+    topology is undeployed.
+    """
+
+    def __init__(self, ttl: float = 30):
+        self.ttl = ttl
+        self.instances = None  # node -> [container names], as returned by get_all_instances
+        self.nodes = {}  # service or instance name -> {node names that host or hosted it}
+        self.built_at = 0
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.instances = None
+
+    def reset(self):
+        """ Forgets the nodes that hosted the services, e.g., when the topology is undeployed """
+        with self.lock:
+            self.instances, self.nodes = None, {}
+
+    def build(self, connector) -> dict:
+        """
+        Returns the containers of each node, the index is rebuilt if it is invalidated or expired
+        :param connector: The connector of the running deployment
+        :return: A dictionary of node name to the names of its containers
+        """
+        with self.lock:
+            if self.instances is not None and time.time() - self.built_at < self.ttl: return self.instances
+            return self.__update(connector, connector.get_all_instances())
+
+    def update(self, connector, instances: dict):
+        """
+        Rebuilds the index from the containers of each node that the caller has already retrieved
+        :param connector: The connector of the running deployment
+        :param instances: A dictionary of node name to the names of its containers (see get_all_instances)
+        """
+        with self.lock:
+            self.__update(connector, instances)
+
+    def __update(self, connector, instances: dict) -> dict:
+        for node, names in instances.items():
+            for name in names:
+                for key in (connector.instance_name(name), connector.get_service_from_name(name)):
+                    self.nodes.setdefault(key, set()).add(node)
+        self.instances, self.built_at = instances, time.time()
+        logger.info("The placement index of %s services and instances is built" % len(self.nodes))
+        return instances
+
+    def nodes_of(self, connector, service: str, exact: bool = True):
+        """
+        Returns the nodes that host (or hosted) a service or an instance. The name is matched exactly and, otherwise, as a part
+        of the services' and instances' names (like the agents' filters)
+        :param connector: The connector of the running deployment
+        :param service: The name of a service or an instance
+        :param exact: If it is False, the name is only matched as a part of the names, e.g., for the packets' filter
+        (`ilike('%service%')`) that selects every service whose name contains the name of an exact match as well
+        :return: The names of the nodes or None if no node is known to host it
+        """
+        self.build(connector)
+        with self.lock:
+            if exact and service in self.nodes: return set(self.nodes[service])
+            service = service.lower()
+            nodes = set()
+            for name, hosts in self.nodes.items():
+                if service in name.lower(): nodes |= hosts
+            return nodes if nodes else None
+
+
+def get_placement_index():
+    """ Returns the placement index of the controller based on its environment variables (PLACEMENT_INDEX_TTL) """
+    ttl = os.environ.get('PLACEMENT_INDEX_TTL', '')
+    return PlacementIndex(ttl=int(ttl) if ttl.isnumeric() else 30)
@@ -7,6 +7,7 @@ from datetime import datetime
 import pyshark
 
 from utils.docker_manager import ContainerNetworkNamespace
+from utils.instrumentation import metrics as instrumentation
 from utils.logging import FogifyLogger
 
 buffer = deque()
@@ -28,9 +29,9 @@ class SnifferHandler(object):
         t2 = threading.Thread(target=storage.store_data)
         t2.start()
 
-    def start_thread_for_sniffing(self, container_id, container_name, eth, network):
+    def start_thread_for_sniffing(self, container_id, container_name, eth, network, pid=None):
         def network_sniffing(_buffer, container_id, container_name, eth, network):
-            with ContainerNetworkNamespace(container_id):
+            with ContainerNetworkNamespace(container_id, pid):
                 sniffer = Sniffer(_buffer, container_name, eth, network)
                 sniffer.sniff()
                 logger.info(
@@ -99,16 +100,15 @@ class SniffingStorage(object):
         return res
 
     def save_packets_to_db(self, res: {}):
-        from agent.models import Packet, db
+        from agent.models import Packet
         new_res = []
         for i in res:
             vals = i.split("|")
             new_res.append(
-                Packet(service_id=vals[0], src_ip=vals[1], dest_ip=vals[2], protocol=vals[3], network=vals[4],
-                       src_port=vals[5], dest_port=vals[6], timestamp=datetime.now(), size=res[i]["size"],
-                       count=res[i]["count"], ))
-        db.session.bulk_save_objects(new_res)
-        db.session.commit()
+                dict(service_id=vals[0], src_ip=vals[1], dest_ip=vals[2], protocol=vals[3], network=vals[4],
+                     src_port=vals[5], dest_port=vals[6], timestamp=datetime.now(), size=res[i]["size"],
+                     count=res[i]["count"], ))
+        Packet.bulk_insert(new_res)
 
     # Sniffs and stores the traffic
     def store_data(self):
@@ -119,9 +119,12 @@ class SniffingStorage(object):
                 time.sleep(delay)
             start = datetime.now()
 
-            res = self.retrieve_packets_from_buffer()
+            instrumentation.set_gauge('fogify_sniffer_buffer_depth', len(self.buffer))
+            with instrumentation.timer('fogify_sniffer_flush_duration_seconds'):
+                res = self.retrieve_packets_from_buffer()
 
-            self.save_packets_to_db(res)
+                self.save_packets_to_db(res)
+            instrumentation.increment('fogify_sniffer_flushed_packets_total', sum(i['count'] for i in res.values()))
 
             end = datetime.now()
             delay = self.periodicity - (end - start).total_seconds()
@@ -0,0 +1,151 @@
+import os
+import socket
+import threading
+
+from utils.logging import FogifyLogger
+
+logger = FogifyLogger(__name__)
+
+
+class PushedMetrics(object):
+    """
+    The in-memory aggregation of the metrics that an instance pushed during a monitoring tick. Counters are summed
+    (and reset at every tick), gauges keep their last value and timers are summarized by their count, mean and max.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+
+    def add(self, name: str, value: float, metric_type: str, sample_rate: float = 1.0, delta: bool = False):
+        if metric_type == 'c':
+            self.counters[name] = self.counters.get(name, 0.0) + value / sample_rate
+        elif metric_type == 'g':
+            self.gauges[name] = self.gauges.get(name, 0.0) + value if delta else value
+        elif metric_type in ('ms', 'h'):
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1 / sample_rate, value, value]
+            else:
+                timer[0] += 1 / sample_rate
+                timer[1] += value
+                timer[2] = max(timer[2], value)
+
+    def flush(self) -> dict:
+        """ Returns the metrics of the tick and resets the counters and the timers """
+        res = dict(self.gauges)
+        res.update(self.counters)
+        for name, (count, total, maximum) in self.timers.items():
+            res[name + "_count"] = count
+            res[name + "_mean"] = total / count
+            res[name + "_max"] = maximum
+        self.counters = dict.fromkeys(self.counters, 0.0)
+        self.timers = {}
+        return res
+
+
+class StatsdListener(object):
+    """
+    A UDP listener of statsd lines (<name>:<value>|<c|g|ms|h>[|@<sample rate>][|#instance:<instance name>]), through
+    which the emulated services push their custom metrics to the agent without writing files. The instance of a
+    metric is defined by the `instance` tag or, otherwise, by the sender's IP in the emulated networks.
+    """
+
+    TYPES = ('c', 'g', 'ms', 'h')
+
+    def __init__(self, container_registry, instance_name=lambda name: name, host: str = '0.0.0.0', port: int = 8125):
+        self.container_registry = container_registry
+        self.instance_name = instance_name
+        self.address = (host, port)
+        self.instances = {}
+        self.ips_to_instances = {}
+        self.lock = threading.Lock()
+
+    def listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind(self.address)
+        logger.info("The statsd listener is bound to %s:%s" % self.address)
+        while True:
+            try:
+                data, (ip, _) = sock.recvfrom(65535)
+                self.handle(data, ip)
+            except Exception:
+                logger.warning("The statsd packet was not parsed", exc_info=True)
+
+    def handle(self, data: bytes, ip: str = None):
+        for line in data.decode('utf-8', 'ignore').splitlines():
+            parsed = self.parse(line)
+            if parsed is None: continue
+            name, value, metric_type, sample_rate, delta, instance = parsed
+            instance = instance if instance else self.__instance_of(ip)
+            if not instance: continue
+            with self.lock:
+                metrics = self.instances.get(instance)
+                if metrics is None: metrics = self.instances[instance] = PushedMetrics()
+                metrics.add(name, value, metric_type, sample_rate, delta)
+
+    @classmethod
+    def parse(cls, line: str):
+        """
+        Parses a statsd line
+        :return: A tuple of (name, value, type, sample rate, is gauge delta, instance) or None if the line is invalid
+        """
+        line = line.strip()
+        if not line or ':' not in line: return None
+        name, _, rest = line.partition(':')
+        parts = rest.split('|')
+        if len(parts) < 2 or parts[1] not in cls.TYPES: return None
+        try:
+            value = float(parts[0])
+        except ValueError:
+            return None
+        sample_rate, instance = 1.0, None
+        for part in parts[2:]:
+            if part.startswith('@'):
+                try:
+                    sample_rate = float(part[1:]) or 1.0
+                except ValueError:
+                    pass
+            elif part.startswith('#'):
+                for tag in part[1:].split(','):
+                    key, _, tag_value = tag.partition(':')
+                    if key == 'instance': instance = tag_value
+        return name, value, parts[1], sample_rate, parts[0][:1] in ('+', '-'), instance
+
+    def __instance_of(self, ip: str):
+        if ip is None: return None
+        if ip not in self.ips_to_instances:
+            container_and_network = self.container_registry.find_by_ip(ip)
+            if not container_and_network: return None
+            self.ips_to_instances[ip] = self.instance_name(container_and_network[0].name)
+        return self.ips_to_instances[ip]
+
+    def flush(self, instance_names: list = None) -> dict:
+        """
+        Returns the aggregated metrics of the current monitoring tick
+        :param instance_names: The instances that are sampled at this tick (by default, all instances)
+        :return: A dictionary of instance name to {metric name: value}
+        """
+        with self.lock:
+            return {instance: metrics.flush() for instance, metrics in self.instances.items()
+                    if instance_names is None or instance in instance_names}
+
+    def remove(self, instance_names: list):
+        """ Forgets the instances that are not running anymore """
+        with self.lock:
+            removed = [instance for instance in self.instances if instance not in instance_names]
+            for instance in removed:
+                del self.instances[instance]
+            if removed: self.ips_to_instances = {}
+
+
+def get_statsd_listener(container_registry, instance_name):
+    """
+    Returns the statsd listener based on the agent's environment variables (STATSD_PORT=0 disables it)
+    """
+    port = os.environ.get('STATSD_PORT', '')
+    port = int(port) if port.isnumeric() else 8125
+    if port == 0: return None
+    return StatsdListener(container_registry, instance_name, port=port)
@@ -0,0 +1,169 @@
+import fnmatch
+import json
+import os
+import queue
+import threading
+import time
+
+import requests
+
+from utils.aggregation import service_of
+from utils.inter_communication import Communicator
+from utils.logging import FogifyLogger
+
+logger = FogifyLogger(__name__)
+
+
+def put_latest(messages: queue.Queue, message):
+    """ Enqueues a message without blocking, the oldest message is dropped if the queue is full """
+    while True:
+        try:
+            messages.put_nowait(message)
+            return
+        except queue.Full:
+            try:
+                messages.get_nowait()
+            except queue.Empty:
+                pass
+
+
+class MetricPublisher(object):
+    """
+    Pushes the samples of every monitoring tick of an agent to the controller's stream (POST /monitorings/stream/).
+    The ticks wait in a bounded queue, so a slow or unreachable controller never blocks the monitoring loop (the
+    oldest ticks are dropped). While the controller has no subscribers, the agent pushes at most one tick per
+    `idle_interval` seconds in order to learn when a subscriber connects.
+    """
+
+    def __init__(self, url: str, node: str, queue_size: int = 100, timeout: float = 5, idle_interval: float = 5):
+        self.url = url
+        self.node = node
+        self.ticks = queue.Queue(maxsize=queue_size)
+        self.timeout = timeout
+        self.idle_interval = idle_interval
+        self.session = requests.Session()
+        self.idle_until = 0
+
+    def publish(self, count: int, samples: list):
+        """
+        Enqueues the samples of a monitoring tick
+        :param count: The counter of the tick
+        :param samples: A list of (instance name, count, timestamp, {metric: value}) tuples
+        """
+        if not samples or time.time() < self.idle_until: return
+        put_latest(self.ticks, {'node': self.node, 'count': count,
+                                'samples': [{'instance': instance_name,
+                                             'record': dict(metrics, count=sample_count,
+                                                            timestamp=timestamp.timestamp())}
+                                            for instance_name, sample_count, timestamp, metrics in samples]})
+
+    def run(self):
+        while True:
+            tick = self.ticks.get()
+            try:
+                response = self.session.post(self.url, data=json.dumps(tick),
+                                             headers={'Content-Type': 'application/json'}, timeout=self.timeout)
+                subscribers = response.json().get('subscribers', 0) if response.ok else 0
+                self.idle_until = 0 if subscribers else time.time() + self.idle_interval
+            except Exception:
+                logger.warning("The samples of the tick %s were not pushed to the controller" % tick['count'])
+                self.idle_until = time.time() + self.idle_interval
+
+
+def get_metric_broker():
+    """
+    Returns the broker of the controller based on its environment variables (MONITORING_STREAM_MAX_SUBSCRIBERS)
+    """
+    max_subscribers = os.environ.get('MONITORING_STREAM_MAX_SUBSCRIBERS', '')
+    return MetricBroker(int(max_subscribers) if max_subscribers.isnumeric() else 4)
+
+
+def get_metric_publisher():
+    """
+    Returns the publisher of the agent based on its environment variables (MONITORING_PUSH=false disables it)
+    """
+    controller_ip = os.environ.get('CONTROLLER_IP')
+    if not controller_ip or os.environ.get('MONITORING_PUSH', 'true').lower() == 'false': return None
+    queue_size = os.environ.get('MONITORING_PUSH_QUEUE_SIZE', '')
+    return MetricPublisher(Communicator.URLs.controller_metric_stream.value % controller_ip,
+                           os.environ.get('HOST_IP') or os.uname().nodename,
+                           queue_size=int(queue_size) if queue_size.isnumeric() and int(queue_size) > 0 else 100)
+
+
+class Subscription(object):
+    """ A subscriber of the controller's stream with its own bounded queue and filters """
+
+    def __init__(self, service: str = None, metrics: list = None, queue_size: int = 1000):
+        self.service = service
+        self.metrics = metrics
+        self.messages = queue.Queue(maxsize=queue_size)
+
+    def accepts(self, instance_name: str) -> bool:
+        return not self.service or self.service in (instance_name, service_of(instance_name))
+
+    def select(self, record: dict) -> dict:
+        if not self.metrics: return record
+        return {name: value for name, value in record.items()
+                if name in ('count', 'timestamp') or any(fnmatch.fnmatchcase(name, metric) for metric in self.metrics)}
+
+
+class MetricBroker(object):
+    """
+    Multiplexes the ticks that the agents push to the subscribers of the controller's stream. Every subscriber has a
+    bounded queue, thus a slow subscriber loses its oldest samples instead of delaying the others. A subscriber holds
+    a worker thread of the controller while it is connected, thus the subscribers are limited to `max_subscribers` in
+    order to keep threads for the agents' pushes and the rest of the API.
+    """
+
+    HEARTBEAT = 15  # seconds between the keep-alive comments of an idle stream
+
+    def __init__(self, max_subscribers: int = 4):
+        self.max_subscribers = max_subscribers
+        self.subscriptions = []
+        self.lock = threading.Lock()
+
+    @property
+    def subscribers(self) -> int:
+        return len(self.subscriptions)
+
+    def publish(self, tick: dict):
+        """
+        Forwards the samples of an agent's tick to the subscribers
+        :param tick: {"node": ..., "count": ..., "samples": [{"instance": ..., "record": {...}}]}
+        """
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            for sample in tick.get('samples', []):
+                if not subscription.accepts(sample['instance']): continue
+                put_latest(subscription.messages, {'node': tick.get('node'), 'instance': sample['instance'],
+                                                   'record': subscription.select(sample['record'])})
+
+    def subscribe(self, service: str = None, metrics: list = None) -> Subscription:
+        """ Returns the new subscription or None if the broker has already `max_subscribers` subscribers """
+        subscription = Subscription(service, metrics)
+        with self.lock:
+            if len(self.subscriptions) >= self.max_subscribers: return None
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            if subscription in self.subscriptions: self.subscriptions.remove(subscription)
+
+    def stream(self, subscription: Subscription):
+        """
+        Yields the samples of a subscription as server-sent events (one event of {"node", "instance", "record"} per
+        sample) until the client disconnects
+        """
+        try:
+            yield "retry: 1000\n\n"
+            while True:
+                try:
+                    message = subscription.messages.get(timeout=self.HEARTBEAT)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield "data: %s\n\n" % json.dumps(message, separators=(',', ':'))
+        finally:
+            self.unsubscribe(subscription)
@@ -0,0 +1,89 @@
+import gzip
+import json
+
+from flask import Response, request
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK = 'application/x-msgpack'
+COLUMNAR_JSON = 'application/vnd.fogify.columnar+json'
+MIN_COMPRESSED_SIZE = 1024
+
+
+def accepted_columnar_format(accept: str):
+    """
+    Returns the columnar format that the client accepts (msgpack is preferred when it is installed)
+    :param accept: The Accept header of the request
+    :return: The mimetype of the format, or None if the client expects the json records
+    """
+    accept = accept or ''
+    if MSGPACK in accept and msgpack is not None: return MSGPACK
+    if COLUMNAR_JSON in accept: return COLUMNAR_JSON
+    return None
+
+
+def requested_formats() -> str:
+    """ The Accept header of a request that prefers the columnar formats """
+    return ", ".join(([MSGPACK] if msgpack is not None else []) + [COLUMNAR_JSON, 'application/json;q=0.5'])
+
+
+class Columns(object):
+    """
+    The monitoring records of each instance in columnar form, i.e., {instance: {"count": [...], "timestamp": [...],
+    "metrics": {name: [...]}}}. The names of the metrics appear once per instance, the timestamps are epochs and the
+    missing values are None.
+    """
+
+    def __init__(self, columns: dict = None):
+        self.columns = columns if columns is not None else {}
+
+    def append(self, instance_name: str, count: int, timestamp: float, metrics: dict):
+        instance = self.columns.get(instance_name)
+        if instance is None:
+            instance = self.columns[instance_name] = {'count': [], 'timestamp': [], 'metrics': {}}
+        size = len(instance['count'])
+        instance['count'].append(count)
+        instance['timestamp'].append(timestamp)
+        for name, column in instance['metrics'].items():
+            column.append(metrics.get(name))
+        for name, value in metrics.items():
+            if name not in instance['metrics']:
+                instance['metrics'][name] = [None] * size + [value]
+
+    def update(self, other):
+        """ Merges the columns of other instances (e.g. of another agent) """
+        self.columns.update(other.columns)
+        return self
+
+
+def dumps(obj: dict, mimetype: str) -> bytes:
+    if mimetype == MSGPACK: return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def loads(content: bytes, mimetype: str) -> dict:
+    if mimetype and mimetype.startswith(MSGPACK): return msgpack.unpackb(content, raw=False)
+    return json.loads(content)
+
+
+def columnar_response(obj: dict, mimetype: str) -> Response:
+    return Response(dumps(obj, mimetype), mimetype=mimetype)
+
+
+def compress_response(response: Response, accept_encoding: str) -> Response:
+    """ Compresses (gzip) the large responses of the clients that accept it. It is registered as an after_request hook """
+    if 'gzip' not in (accept_encoding or '') or response.direct_passthrough or response.is_streamed: return response
+    if response.status_code != 200 or 'Content-Encoding' in response.headers: return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESSED_SIZE: return response
+    response.set_data(gzip.compress(data, compresslevel=5))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def install_compression(app):
+    app.after_request(lambda response: compress_response(response, request.headers.get('Accept-Encoding')))